@@ -0,0 +1,141 @@
+"""
+SQL-side queries behind the admin metrics API.
+
+Everything here is aggregated by SQLite (``GROUP BY`` / ``ORDER BY ... LIMIT``)
+and paged with keyset cursors (``WHERE (sort key, id) after the cursor``), so a
+page costs the same whether it's the first or the thousandth and nothing ever
+loads a whole table into Python. Exports walk the table in keyset chunks and
+yield as they go.
+"""
+import csv
+import io
+import json
+
+import db
+
+AD_COLUMNS = ("id", "title", "category", "owner", "is_active", "image_url", "ctr", "clicks", "impressions",
+              "start_date", "end_date")
+USER_COLUMNS = ("id", "username", "role")
+AD_SORTS = ("id", "ctr", "clicks", "impressions")
+MAX_PAGE = 500
+EXPORT_CHUNK = 1000
+
+
+class BadCursor(ValueError):
+    pass
+
+
+def _ad_dict(row):
+    return dict(zip(AD_COLUMNS, row))
+
+
+def ads_page(path, sort="id", after=None, limit=50):
+    """One page of ads ordered by ``sort`` (descending, id ascending for ties),
+    plus the cursor of the next page (``None`` on the last one)."""
+    if sort not in AD_SORTS:
+        raise ValueError(f"sort must be one of {', '.join(AD_SORTS)}")
+    cols = ", ".join(AD_COLUMNS)
+    if sort == "id":
+        where, params, order = "", [], "id"
+        if after:
+            try:
+                where, params = "WHERE id > ?", [int(after)]
+            except ValueError:
+                raise BadCursor(after)
+    else:
+        key = f"COALESCE({sort}, 0)"
+        where, params, order = "", [], f"{key} DESC, id"
+        if after:
+            try:
+                value, last_id = after.rsplit(":", 1)
+                value, last_id = float(value), int(last_id)
+            except ValueError:
+                raise BadCursor(after)
+            where, params = f"WHERE {key} < ? OR ({key} = ? AND id > ?)", [value, value, last_id]
+    rows = db.query(path, f"SELECT {cols} FROM ads {where} ORDER BY {order} LIMIT ?", params + [limit + 1])
+    items = [_ad_dict(r) for r in rows[:limit]]
+    nxt = None
+    if len(rows) > limit:
+        last = items[-1]
+        nxt = str(last["id"]) if sort == "id" else f"{float(last[sort] or 0)!r}:{last['id']}"
+    return items, nxt
+
+
+def users_page(path, after=None, limit=50):
+    """One page of ``users`` by id (never includes passwords)."""
+    try:
+        after = int(after) if after else 0
+    except ValueError:
+        raise BadCursor(after)
+    rows = db.query(path, "SELECT id, username, role FROM users WHERE id > ? ORDER BY id LIMIT ?", (after, limit + 1))
+    items = [dict(zip(USER_COLUMNS, r)) for r in rows[:limit]]
+    return items, (str(items[-1]["id"]) if len(rows) > limit else None)
+
+
+def owner_summaries(path, owners):
+    """``{owner: {"ads", "active_ads", "clicks", "impressions"}}`` for the given owners."""
+    owners = list(owners)
+    if not owners:
+        return {}
+    rows = db.query(path, f"""
+        SELECT owner, COUNT(*), SUM(COALESCE(is_active, 1)), SUM(COALESCE(clicks, 0)), SUM(COALESCE(impressions, 0))
+        FROM ads WHERE owner IN ({','.join('?' * len(owners))}) GROUP BY owner
+    """, owners)
+    return {r[0]: {"ads": r[1], "active_ads": r[2], "clicks": r[3], "impressions": r[4]} for r in rows}
+
+
+def category_totals(path):
+    rows = db.query(path, """
+        SELECT COALESCE(NULLIF(TRIM(category), ''), '(none)') AS cat, COUNT(*),
+               SUM(COALESCE(is_active, 1)), SUM(COALESCE(clicks, 0)), SUM(COALESCE(impressions, 0))
+        FROM ads GROUP BY cat ORDER BY SUM(COALESCE(clicks, 0)) DESC, cat
+    """)
+    return [{"category": r[0], "ads": r[1], "active_ads": r[2], "clicks": r[3], "impressions": r[4],
+             "ctr": r[3] / r[4] if r[4] else 0.0} for r in rows]
+
+
+def top_ads(path, by="clicks", limit=10):
+    return ads_page(path, sort=by, limit=limit)[0]
+
+
+def totals(ads_path, users_path):
+    ads, active, clicks, impressions = db.query_one(ads_path, """
+        SELECT COUNT(*), SUM(COALESCE(is_active, 1)), SUM(COALESCE(clicks, 0)), SUM(COALESCE(impressions, 0)) FROM ads
+    """)
+    users = db.query_one(users_path, "SELECT COUNT(*) FROM users")[0]
+    clicks, impressions = clicks or 0, impressions or 0
+    return {"users": users, "ads": ads, "active_ads": active or 0, "clicks": clicks, "impressions": impressions,
+            "ctr": clicks / impressions if impressions else 0.0}
+
+
+# --- streamed exports ---
+def _chunks(path, table, columns):
+    last = 0
+    cols = ", ".join(columns)
+    while True:
+        rows = db.query(path, f"SELECT {cols} FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (last, EXPORT_CHUNK))
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def export_csv(path, table, columns):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(columns)
+    for rows in _chunks(path, table, columns):
+        w.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0); buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def export_json(path, table, columns):
+    yield "["
+    sep = ""
+    for rows in _chunks(path, table, columns):
+        yield sep + ",".join(json.dumps(dict(zip(columns, r)), ensure_ascii=False) for r in rows)
+        sep = ","
+    yield "]"
@@ -1,11 +1,30 @@
 import random
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
-import sqlite3, os, json, time
+import numpy as np
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash, g, Response, stream_with_context
+import sqlite3, os, time
 from pathlib import Path
-from csv import DictReader, writer
+from csv import writer
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 
+import db
+import metrics
+from metrics import span
+from catalog import Catalog, AD_SELECT, AD_FIELDS
+from content_index import ContentIndex, ad_document
+from user_store import UserStore, Preferences
+from personalization import AdFeatures, AffinityVectors, RankedListCache, session_jitter
+from inverted_index import InvertedIndex
+from ingest import EventQueue, validate_events, MAX_EVENTS
+from rollups import RollupStore, HOUR, DAY
+import admin_metrics
+import migrations
+from images import ImagePipeline
+from scheduling import ActiveSchedule
+from similar import SimilarAds
+from response_cache import ResponseCache, make_etag, content_etag
+import compression
+
 app = Flask(__name__, template_folder="templates", static_folder="static")
 app.secret_key = "dev-secret-change-this"
 
@@ -17,138 +36,148 @@ BASE_DIR = Path(__file__).resolve().parent
 ADS_DB = str(BASE_DIR / "ads.db")
 USERS_DB = str(BASE_DIR / "users.db")
 USERS_FOLDER = BASE_DIR / "users"                  # for JSON and data files
-STATIC_UPLOAD_ROOT = BASE_DIR / "static" / "users" # for web-served images
 AD_CSV = str(BASE_DIR / "ad_inventory.csv")
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 
+# Pooled per-thread connections (WAL mode); don't close() them, see db.py
 def open_ads_db():
-    return sqlite3.connect(ADS_DB)
+    return db.connect(ADS_DB)
 
 def open_users_db():
-    return sqlite3.connect(USERS_DB)
+    return db.connect(USERS_DB)
+
+@app.teardown_appcontext
+def release_db_connections(exc):
+    db.release_thread()
+
+# Per-ad engagement in minute/hour/day buckets (windowed CTR), see rollups.py
+rollups = RollupStore(ADS_DB)
+
+# --- Request timing (see /metrics) ---
+@app.before_request
+def start_request_timer():
+    g.request_t0 = time.perf_counter()
+
+@app.teardown_request
+def record_request_time(exc):
+    t0 = g.pop("request_t0", None)
+    if t0 is not None:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - t0, endpoint=request.endpoint or "unknown")
+
+# --- Ad catalog snapshot (ranking reads only from memory) ---
+def load_ad_rows(ad_ids=None):
+    conn = open_ads_db(); c = conn.cursor()
+    if ad_ids is None:
+        c.execute(AD_SELECT)
+        rows = c.fetchall()
+    else:
+        rows = []
+        for i in range(0, len(ad_ids), 500):
+            chunk = ad_ids[i:i + 500]
+            c.execute(AD_SELECT + f" WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            rows.extend(c.fetchall())
+    return rows
+
+catalog = Catalog(load_ad_rows)
+
+# --- Content-based similarity (TF-IDF over title/keywords/category/details) ---
+content_index = ContentIndex()
+
+def snapshot_document(snap, i):
+    return ad_document(snap.titles[i], snap.keywords[i], snap.categories[i], snap.details[i])
+
+# Precomputed top-k neighbors per ad, for /ad/<id>/similar
+similar_ads = SimilarAds(content_index, k=20)
+
+@catalog.subscribe
+def sync_content_index(snap, changed_ids, removed_ids):
+    if changed_ids is None or content_index.needs_refit:
+        content_index.fit(snap.ids.tolist(), [snapshot_document(snap, i) for i in range(len(snap))])
+        similar_ads.request_rebuild()
+        return
+    reindexed = []  # click/impression swaps leave the text alone; skip those
+    for ad_id in changed_ids:
+        i = snap.index.get(ad_id)
+        if i is not None and content_index.add(ad_id, snapshot_document(snap, i)):
+            reindexed.append(ad_id)
+    for ad_id in removed_ids:
+        content_index.remove(ad_id)
+    if reindexed or removed_ids:
+        similar_ads.update(reindexed, removed_ids)
+
+# --- Candidate generation (token -> ad ids, plus a top-CTR fallback) ---
+inverted_index = InvertedIndex(fallback_size=50)
+
+@catalog.subscribe
+def sync_inverted_index(snap, changed_ids, removed_ids):
+    if changed_ids is None:
+        inverted_index.build(snap.ids.tolist(), snap.keywords, snap.categories, snap.target_pages, snap.ctr.tolist())
+        return
+    for ad_id in changed_ids:
+        i = snap.index.get(ad_id)
+        if i is not None:
+            inverted_index.add(ad_id, snap.keywords[i], snap.categories[i], snap.target_pages[i], float(snap.ctr[i]))
+    for ad_id in removed_ids:
+        inverted_index.remove(ad_id)
+
+# --- Scheduling (is_active / start_date / end_date -> servable ads) ---
+schedule = ActiveSchedule()
+
+@catalog.subscribe
+def sync_schedule(snap, changed_ids, removed_ids):
+    if changed_ids is None:
+        schedule.rebuild(snap, time.time())
+    else:
+        schedule.update(snap, changed_ids, removed_ids, time.time())
+
+# --- User folder prefs helpers (cached in memory, written through to disk) ---
+user_store = UserStore(USERS_FOLDER)
 
-# --- User folder prefs helpers ---
 def get_user_folder(username):
     return USERS_FOLDER / username
 
-def load_user_preferences(username):
-    folder = get_user_folder(username)
-    prefs_file = folder / "preferences.json"
-    if prefs_file.exists():
-        try:
-            with open(prefs_file, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return {"likes": [], "dislikes": []}
-    return {"likes": [], "dislikes": []}
+def load_user_preferences(username) -> Preferences:
+    return user_store.preferences(username)
 
 def save_user_preferences(username, prefs):
-    folder = get_user_folder(username)
-    os.makedirs(folder, exist_ok=True)
-    prefs_file = folder / "preferences.json"
-    with open(prefs_file, "w", encoding="utf-8") as f:
-        json.dump(prefs, f)
+    return user_store.set_preferences(username, prefs.get("likes", []), prefs.get("dislikes", []))
 
 # --- Profile helpers (save JSON under users/<username>/profile.json) ---
 def load_user_profile(username):
-    folder = get_user_folder(username)
-    os.makedirs(folder, exist_ok=True)
-    path = folder / "profile.json"
-    if path.exists():
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return {}
-    return {}
+    return user_store.profile(username)
 
 def save_user_profile(username, data):
-    folder = get_user_folder(username)
-    os.makedirs(folder, exist_ok=True)
-    path = folder / "profile.json"
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    user_store.save_profile(username, data)
 
-# --- Upload helpers (save images under static/users/<username>/...) ---
+# --- Upload helpers (stored under static/media/<hh>/<content hash>.<ext>, see images.py) ---
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def ensure_user_upload_dir(username: str) -> Path:
-    user_dir = STATIC_UPLOAD_ROOT / username
-    os.makedirs(user_dir, exist_ok=True)
-    return user_dir
+# Uploads are stored once per content hash; WebP card/modal derivatives are
+# rendered in the background (see images.py)
+image_pipeline = ImagePipeline(BASE_DIR / "static")
 
-def save_uploaded_image(file_storage, username: str, prefix: str) -> str:
+def save_uploaded_image(file_storage) -> str:
     """
-    Saves an uploaded image for user and returns the web path like:
-    /static/users/<username>/<saved_filename>
+    Saves an uploaded image (deduplicated by content) and returns the web path like:
+    /static/media/<hh>/<content hash>.<ext>
     """
     if not file_storage or file_storage.filename.strip() == "":
         return ""
     filename = secure_filename(file_storage.filename)
     if not allowed_file(filename):
         raise ValueError("Unsupported file type. Allowed: png, jpg, jpeg, gif, webp")
-    user_dir = ensure_user_upload_dir(username)
-    ts = int(time.time())
     root, ext = os.path.splitext(filename)
-    saved_name = f"{prefix}_{ts}{ext.lower()}"
-    saved_path = user_dir / saved_name
-    file_storage.save(saved_path)
-    # return web path
-    return f"/static/users/{username}/{saved_name}"
+    return image_pipeline.store_upload(file_storage.read(), ext)
 
 # --- DB migrations / initializers ---
-def ensure_links_column_and_populate():
-    conn = open_ads_db(); c = conn.cursor()
-    c.execute("PRAGMA table_info(ads)")
-    cols = [r[1] for r in c.fetchall()]
-    if "link" not in cols:
-        try:
-            c.execute("ALTER TABLE ads ADD COLUMN link TEXT")
-            conn.commit()
-        except Exception:
-            pass
-
-    # Populate from CSV if missing
-    if os.path.exists(AD_CSV):
-        try:
-            by_title = {}
-            with open(AD_CSV, "r", encoding="utf-8") as f:
-                reader = DictReader(f)
-                for row in reader:
-                    t = (row.get("title") or "").strip()
-                    if t:
-                        by_title[t.lower()] = (row.get("link") or "").strip()
-            c.execute("SELECT id, title, link FROM ads")
-            for ad_id, title, link in c.fetchall():
-                if title and (not link or link.strip() == ""):
-                    cand = by_title.get(title.strip().lower(), "")
-                    if cand:
-                        c.execute("UPDATE ads SET link=? WHERE id=?", (cand, ad_id))
-            conn.commit()
-        except Exception:
-            pass
-    conn.close()
-
-def ensure_publish_columns():
-    """Add columns needed for user-published ads."""
-    conn = open_ads_db(); c = conn.cursor()
-    c.execute("PRAGMA table_info(ads)")
-    cols = [r[1] for r in c.fetchall()]
-
-    to_add = []
-    if "owner" not in cols: to_add.append(("owner", "TEXT"))
-    if "is_active" not in cols: to_add.append(("is_active", "INTEGER DEFAULT 1"))
-    if "start_date" not in cols: to_add.append(("start_date", "TEXT"))
-    if "end_date" not in cols: to_add.append(("end_date", "TEXT"))
-    if "created_at" not in cols: to_add.append(("created_at", "TEXT"))
-    for name, typ in to_add:
-        try:
-            c.execute(f"ALTER TABLE ads ADD COLUMN {name} {typ}")
-        except Exception:
-            pass
-    conn.commit(); conn.close()
+def migrate_databases():
+    """Bring ads.db and users.db up to the current schema version (see migrations.py)."""
+    for path, steps in ((ADS_DB, migrations.ads_steps(AD_CSV)), (USERS_DB, migrations.USERS_STEPS)):
+        applied = migrations.migrate(db.connect(path), steps)
+        if applied:
+            print(f"Migrated {os.path.basename(path)}: {', '.join(applied)}")
 
 def ensure_csv_header():
     if not os.path.exists(AD_CSV):
@@ -174,9 +203,8 @@ def register():
             c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
             conn.commit()
         except sqlite3.IntegrityError:
-            conn.close()
+            conn.rollback()
             return render_template("register.html", error="Username already taken")
-        conn.close()
 
         folder = get_user_folder(username)
         os.makedirs(folder, exist_ok=True)
@@ -198,7 +226,6 @@ def login():
         c = conn.cursor()
         c.execute("SELECT id, username, password, role FROM users WHERE username=?", (username,))
         row = c.fetchone()
-        conn.close()
 
         if not row:
             return render_template("login.html", error="No account found. Please register first.")
@@ -228,90 +255,259 @@ def index():
     return render_template("index.html", user=session["user"])
 
 # --- Ads API ---
+# Stronger scoring so rank visibly changes
+LIKE_BOOST = 15.0
+DISLIKE_PENALTY = 15.0
+CAT_LIKE_BOOST = 7.0
+CAT_DISLIKE_PENALTY = 7.0
+KEYWORD_LIKE_BOOST = 3.0  # scaled by the share of an ad's keywords the user liked / disliked
+KEYWORD_DISLIKE_PENALTY = 3.0
+CONTENT_BOOST = 8.0
+SESSION_JITTER = 3.0  # +/- per ad, fixed for the session
+FULL_SCAN_MAX = 200  # below this many ads, score everything (exact and cheap)
+
+ad_features = AdFeatures()
+user_affinity = AffinityVectors(ad_features, user_store, CAT_LIKE_BOOST, CAT_DISLIKE_PENALTY,
+                                KEYWORD_LIKE_BOOST, KEYWORD_DISLIKE_PENALTY)
+ranked_cache = RankedListCache(ttl=300.0)  # per-session ranked lists; see rank_ads
+response_cache = ResponseCache()
+compressed_cache = ResponseCache(max_entries=512)
+
+# ?fields= for /get_ads: catalog fields plus "score" and "image" (image_url + derivative URLs)
+LISTING_FIELDS = frozenset(AD_FIELDS) | {"score", "image"}
+COMPACT_FIELDS = ("id", "title", "category", "image", "ctr", "score")
+
+def listing_fields():
+    """Fields requested via ?fields=a,b or ?compact=1; None means the full ad."""
+    raw = request.args.get("fields")
+    if raw is None:
+        return COMPACT_FIELDS if request.args.get("compact") in ("1", "true") else None
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(",") if f.strip()))
+    unknown = [f for f in fields if f not in LISTING_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}" if unknown else "no fields requested")
+    return fields
+
+# --- Metrics (Prometheus text format) ---
+def _db_stat(field):
+    return lambda: {(("db", name),): totals[field] for name, totals in db.stats().items()}
+
+metrics.register_collector("ads_db_queries_total", "counter", "SQL statements executed.", _db_stat(0))
+metrics.register_collector("ads_db_rows_returned_total", "counter", "Rows fetched from SQLite.", _db_stat(1))
+metrics.register_collector("ads_db_vm_steps_total", "counter",
+                           "SQLite VM instructions executed (approximate; proxy for rows scanned).", _db_stat(2))
+metrics.register_cache("affinity", lambda: (user_affinity.hits, user_affinity.misses))
+metrics.register_cache("user_store", lambda: (user_store.hits, user_store.misses))
+metrics.register_cache("get_ads_response", lambda: (response_cache.hits, response_cache.misses))
+metrics.register_cache("ranked_lists", lambda: (ranked_cache.hits, ranked_cache.misses))
+metrics.register_cache("compressed_json", lambda: (compressed_cache.hits, compressed_cache.misses))
+metrics.register_collector("ads_catalog_version", "gauge", "Catalog snapshot version.", lambda: {(): catalog.version})
+metrics.register_collector("ads_catalog_ads", "gauge", "Ads in the current catalog snapshot.",
+                           lambda: {(): len(catalog.snapshot())})
+metrics.register_collector("ads_similar_table_ads", "gauge", "Ads with a precomputed similar-ads list.",
+                           lambda: {(): len(similar_ads)})
+metrics.register_collector("ads_similar_rebuilds_total", "counter", "Full rebuilds of the similar-ads table.",
+                           lambda: {(): similar_ads.rebuilds})
+metrics.register_collector("ads_servable", "gauge", "Ads active and inside their start/end window.",
+                           lambda: {(): len(schedule)})
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def rank_ads(snap, username, prefs, ad_seed):
+    """Top 10 ``(score, row)`` of the servable ads for ``username`` (None: anonymous)."""
+    # Personalization sources
+    with span("get_ads.personalize"):
+        affinity = None
+        if prefs is not None:
+            # category/keyword affinity: one sparse matrix-vector product over the catalog
+            affinity = user_affinity.get(username, prefs, snap)
+            affinity_term = user_affinity.scores(affinity, snap)
+        else:
+            prefs = Preferences()
+
+    # Candidates: ads sharing a keyword/category token with the user's likes,
+    # the liked ads themselves and the global top-CTR set
+    with span("get_ads.candidates"):
+        serving = schedule.serving(snap)  # servable now, deduped by title (keep highest CTR)
+        serving_rows = serving.rows
+        if len(serving_rows) <= FULL_SCAN_MAX:
+            rows = serving_rows
+        else:
+            keep = np.zeros(len(snap), dtype=bool)
+            keep[snap.rows_of(inverted_index.matching_array(user_affinity.tokens(affinity) if affinity else ()))] = True
+            keep[snap.rows_of(np.fromiter(prefs.likes, dtype=np.int64, count=len(prefs.likes)))] = True
+            # the top-CTR fallback comes from the servable rows, so there are always
+            # at least a page's worth of candidates when that many ads are servable
+            keep[schedule.top_by_ctr(snap, max(inverted_index.fallback_size, 10))] = True
+            rows = serving_rows[keep[serving_rows]]  # keep serving order for ties
+        if affinity is not None:
+            affinity_term = affinity_term[rows]
+
+    # Content similarity of every candidate to the centroid of the user's liked ads
+    content_sim = None
+    if prefs.likes:
+        with span("get_ads.content"):
+            query = content_index.query_from_ads(prefs.likes)
+            if query is not None:
+                content_sim = content_index.similarities(query, content_index.slots_for(snap.ids)[rows])
+
+    # All candidates are scored at once; the sort is stable, so ties keep serving order
+    with span("get_ads.score"):
+        ids = snap.ids[rows]
+        scores = snap.ctr[rows] * 100.0  # base on CTR percent for visibility
+        if username is not None:
+            if prefs.likes:
+                scores += LIKE_BOOST * np.isin(ids, list(prefs.likes))
+            if prefs.dislikes:
+                scores -= DISLIKE_PENALTY * np.isin(ids, list(prefs.dislikes))
+            scores += affinity_term
+            if content_sim is not None:
+                scores += CONTENT_BOOST * np.asarray(content_sim, dtype=np.float64)
+            # session-stable nudge so order differs after each login; CTR/likes dominate
+            scores += session_jitter(ad_seed, ids, SESSION_JITTER)
+        top = np.arange(len(scores))
+        if len(scores) > 10:
+            # only scores tied with or above the 10th best need the stable sort
+            top = np.flatnonzero(scores >= -np.partition(-scores, 9)[9])
+        top = top[np.argsort(-scores[top], kind="stable")][:10]
+        return [(float(scores[k]), int(rows[k])) for k in top.tolist()]
+
 @app.route("/get_ads")
 def get_ads():
-    conn = open_ads_db(); c = conn.cursor()
-    c.execute("""SELECT id, title, category, keywords, target_page, image_url, ctr, clicks, impressions, details, link
-                 FROM ads""")
-    rows = c.fetchall()
-    conn.close()
-
-    ads = []
-    for r in rows:
-        ads.append({
-            "id": int(r[0]),
-            "title": r[1] or "",
-            "category": r[2] or "",
-            "keywords": r[3] or "",
-            "target_page": r[4] or "",
-            "image_url": r[5] or "",
-            "ctr": float(r[6] or 0.0),
-            "clicks": int(r[7] or 0),
-            "impressions": int(r[8] or 0),
-            "details": r[9] or "No details available.",
-            "link": r[10] or ""
-        })
-
-    # Dedupe by title (keep highest CTR)
-    dedup_map = {}
-    for ad in ads:
-        title = (ad.get("title") or "").strip()
-        key = title.lower() if title else f"id-{ad['id']}"
-        if key not in dedup_map or ad["ctr"] > dedup_map[key]["ctr"]:
-            dedup_map[key] = ad
-    ads = list(dedup_map.values())
-
-    # Personalization sources
-    prefs = {"likes": [], "dislikes": []}
-    liked_categories = set()
-    disliked_categories = set()
-    if "user" in session:
-        username = session["user"]["username"]
-        prefs = load_user_preferences(username)
-        conn = open_ads_db(); c = conn.cursor()
-        for ad_id in prefs.get("likes", []):
-            c.execute("SELECT category FROM ads WHERE id=?", (ad_id,))
-            row = c.fetchone()
-            if row and row[0]: liked_categories.add(row[0])
-        for ad_id in prefs.get("dislikes", []):
-            c.execute("SELECT category FROM ads WHERE id=?", (ad_id,))
-            row = c.fetchone()
-            if row and row[0]: disliked_categories.add(row[0])
-        conn.close()
-
-    # Stronger scoring already present above (LIKE_BOOST etc.)
-
-    def session_jitter(ad_id: int) -> float:
-        """
-        Stable jitter per session to vary initial ranking after each login.
-        Keeps order consistent during the session but different across logins.
-        """
-        seed = f"{session.get('ad_seed', 0)}:{ad_id}"
-        rng = random.Random(seed)
-        return rng.uniform(-3.0, 3.0)  # small nudge; CTR/likes dominate
-    
-    # Stronger scoring so rank visibly changes
-    LIKE_BOOST = 15.0
-    DISLIKE_PENALTY = 15.0
-    CAT_LIKE_BOOST = 7.0
-    CAT_DISLIKE_PENALTY = 7.0
-
-    def score(ad):
-        s = ad["ctr"] * 100.0  # base on CTR percent for visibility
-        if "user" in session:
-            if ad["id"] in prefs.get("likes", []): s += LIKE_BOOST
-            if ad["id"] in prefs.get("dislikes", []): s -= DISLIKE_PENALTY
-            if ad["category"] in liked_categories: s += CAT_LIKE_BOOST
-            if ad["category"] in disliked_categories: s -= CAT_DISLIKE_PENALTY
-        # NEW: session-stable jitter so order differs after each login
-            s += session_jitter(ad["id"])
-        return s
-
-    for ad in ads:
-        ad["score"] = score(ad)
-
-    ads.sort(key=lambda a: a["score"], reverse=True)
-    return jsonify(ads[:10])
+    try:
+        fields = listing_fields()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    snap = catalog.snapshot()
+    schedule.advance(time.time())  # start/expire ads whose time has come
+    serving_version = schedule.serving(snap).version
+    username = session["user"]["username"] if "user" in session else None
+    with span("get_ads.preferences"):
+        prefs = load_user_preferences(username) if username else None
+
+    # The list only changes with the ranking inputs (not every counter bump; see
+    # CatalogSnapshot.ranking_version), the served rows, the user's prefs, the
+    # session seed and which image derivatives exist, so those (and the field
+    # set) make the ETag
+    etag = make_etag(snap.ranking_version, serving_version, username, prefs.version if prefs else 0,
+                     session.get("ad_seed", 0), image_pipeline.version, fields)
+    if request.if_none_match.contains_weak(etag):
+        return get_ads_response(b"", etag, 304)
+    body = response_cache.get(etag)
+    if body is not None:
+        return get_ads_response(body, etag)
+
+    # The ranking itself depends on fewer inputs than the body (not on fields or
+    # image versions), so it is cached separately per user and session
+    ad_seed = session.get("ad_seed", 0)
+    versions = (snap.ranking_version, serving_version, prefs.version if prefs else 0)
+    scored = ranked_cache.get(username, ad_seed, versions)
+    if scored is None:
+        scored = rank_ads(snap, username, prefs, ad_seed)
+        ranked_cache.put(username, ad_seed, versions, scored)
+
+    # Only the winners are materialized as dicts
+    with span("get_ads.serialize"):
+        if fields is None:
+            ad_fields, want_score, want_images = None, True, True
+        else:
+            ad_fields = [f for f in fields if f in AD_FIELDS]
+            if "image" in fields and "image_url" not in ad_fields:
+                ad_fields.append("image_url")
+            want_score, want_images = "score" in fields, "image" in fields
+        ads = []
+        for s, i in scored:
+            ad = snap.ad(i, ad_fields)
+            if want_score:
+                ad["score"] = s
+            if want_images:
+                ad.update(image_pipeline.urls(snap.image_urls[i]))  # srcset once derivatives exist
+            ads.append(ad)
+        body = jsonify(ads).get_data()
+    response_cache.put(etag, body)
+    return get_ads_response(body, etag)
+
+def get_ads_response(body, etag, status=200):
+    resp = Response(body, status=status, mimetype="application/json")
+    resp.set_etag(etag)
+    # personalized: browsers may keep it, but must revalidate every time
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.vary.add("Cookie")
+    return resp
+
+# --- Ad details (cacheable; the listing can omit details/link) ---
+@app.route("/ad/<int:ad_id>")
+def ad_details(ad_id):
+    snap = catalog.snapshot()
+    i = snap.index.get(ad_id)
+    if i is None:
+        return jsonify({"error": "not found"}), 404
+    key = make_etag("ad", ad_id, snap.version, image_pipeline.version)
+    cached = response_cache.get(key)
+    if cached is None:
+        ad = snap.ad(i)
+        ad.update(image_pipeline.urls(ad["image_url"]))
+        body = jsonify(ad).get_data()
+        cached = (body, content_etag(body))  # unchanged ads keep their ETag across versions
+        response_cache.put(key, cached)
+    body, etag = cached
+    if request.if_none_match.contains_weak(etag):
+        body, status = b"", 304
+    else:
+        status = 200
+    resp = Response(body, status=status, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "public, max-age=60"
+    return resp
+
+@app.route("/ad/<int:ad_id>/similar")
+def similar_ads_endpoint(ad_id):
+    snap = catalog.snapshot()
+    if ad_id not in snap.index:
+        return jsonify({"error": "not found"}), 404
+    limit = max(1, min(request.args.get("limit", 6, type=int) or 6, similar_ads.k))
+    out = []
+    with span("similar.lookup"):
+        for other, score in similar_ads.neighbors(ad_id):
+            i = snap.index.get(other)
+            if i is None or other not in schedule:
+                continue
+            ad = snap.ad(i, ("id", "title", "category", "image_url"))
+            ad.update(image_pipeline.urls(ad["image_url"]))
+            ad["score"] = round(score, 4)
+            out.append(ad)
+            if len(out) == limit:
+                break
+    resp = jsonify({"ad_id": ad_id, "similar": out})
+    resp.headers["Cache-Control"] = "public, max-age=60"
+    return resp
+
+# --- JSON compression (gzip, or brotli when installed) ---
+@app.after_request
+def compress_json(resp):
+    if (not app.config.get("COMPRESS_JSON", True) or resp.status_code != 200 or resp.direct_passthrough
+            or resp.is_streamed or resp.mimetype != "application/json" or "Content-Encoding" in resp.headers):
+        return resp
+    encoding = compression.choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return resp
+    body = resp.get_data()
+    if len(body) < compression.MIN_SIZE:
+        return resp
+    etag, _ = resp.get_etag()
+    data = compressed_cache.get((etag, encoding)) if etag else None
+    if data is None:
+        data = compression.compress(body, encoding)
+        if etag:
+            compressed_cache.put((etag, encoding), data)
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    if etag:
+        resp.set_etag(etag, weak=True)  # same ETag across encodings, so it can only be weak
+    return resp
 
 # --- Engagement ---
 @app.route("/like/<int:ad_id>", methods=["POST"])
@@ -319,12 +515,11 @@ def like_ad(ad_id):
     if "user" not in session:
         return jsonify({"error": "not logged in"}), 403
     username = session["user"]["username"]
-    prefs = load_user_preferences(username)
-    if ad_id not in prefs.get("likes", []):
-        prefs["likes"].append(ad_id)
-    if ad_id in prefs.get("dislikes", []):
-        prefs["dislikes"].remove(ad_id)
-    save_user_preferences(username, prefs)
+    with span("like.preferences"):
+        before = user_store.preferences(username)
+        after = user_store.like(username, ad_id)
+        user_affinity.apply(username, before, after, [ad_id], catalog.snapshot())
+    ranked_cache.invalidate(username)  # only this user's lists depend on their likes
     return jsonify({"status": "ok"})
 
 @app.route("/dislike/<int:ad_id>", methods=["POST"])
@@ -332,37 +527,112 @@ def dislike_ad(ad_id):
     if "user" not in session:
         return jsonify({"error": "not logged in"}), 403
     username = session["user"]["username"]
-    prefs = load_user_preferences(username)
-    if ad_id not in prefs.get("dislikes", []):
-        prefs["dislikes"].append(ad_id)
-    if ad_id in prefs.get("likes", []):
-        prefs["likes"].remove(ad_id)
-    save_user_preferences(username, prefs)
+    with span("dislike.preferences"):
+        before = user_store.preferences(username)
+        after = user_store.dislike(username, ad_id)
+        user_affinity.apply(username, before, after, [ad_id], catalog.snapshot())
+    ranked_cache.invalidate(username)
 
     # optional CTR penalty
-    conn = open_ads_db(); c = conn.cursor()
-    c.execute("SELECT ctr FROM ads WHERE id=?", (ad_id,))
-    row = c.fetchone()
+    with span("dislike.ctr_update"):
+        conn = open_ads_db(); c = conn.cursor()
+        c.execute("SELECT ctr FROM ads WHERE id=?", (ad_id,))
+        row = c.fetchone()
+        if row:
+            old_ctr = float(row[0] or 0.0)
+            new_ctr = max(0.0, old_ctr - 0.4)
+            c.execute("UPDATE ads SET ctr = ? WHERE id=?", (new_ctr, ad_id))
+            rollups.record(conn, [(ad_id, time.time(), 0, 0, 1)])
+            conn.commit()
     if row:
-        old_ctr = float(row[0] or 0.0)
-        new_ctr = max(0.0, old_ctr - 0.4)
-        c.execute("UPDATE ads SET ctr = ? WHERE id=?", (new_ctr, ad_id))
-        conn.commit()
-    conn.close()
+        with span("dislike.catalog_refresh"):
+            catalog.refresh_ads([ad_id])
     return jsonify({"status": "ok"})
 
 @app.route("/click/<int:ad_id>", methods=["POST"])
 def click_ad(ad_id):
-    conn = open_ads_db(); c = conn.cursor()
-    c.execute("UPDATE ads SET clicks = clicks + 1 WHERE id=?", (ad_id,))
-    c.execute("""
-        UPDATE ads
-        SET ctr = CAST(clicks AS FLOAT) / CASE WHEN impressions = 0 THEN 1 ELSE impressions END
-        WHERE id=?
-    """, (ad_id,))
-    conn.commit(); conn.close()
+    with span("click.update"):
+        conn = open_ads_db(); c = conn.cursor()
+        c.execute("UPDATE ads SET clicks = clicks + 1 WHERE id=?", (ad_id,))
+        c.execute("""
+            UPDATE ads
+            SET ctr = CAST(clicks AS FLOAT) / CASE WHEN impressions = 0 THEN 1 ELSE impressions END
+            WHERE id=?
+        """, (ad_id,))
+        if c.rowcount:
+            rollups.record(conn, [(ad_id, time.time(), 0, 1, 0)])
+        conn.commit()
+    with span("click.catalog_refresh"):
+        catalog.refresh_ads([ad_id])
     return jsonify({"status": "ok"})
 
+# --- Batched engagement events (POST /events, applied by a background queue) ---
+def apply_event_batch(batch):
+    """Apply queued ``(username, type, ad_id, ts)`` events: preference changes per
+    user, then all ad counter updates in one transaction and one catalog refresh."""
+    feedback = {}
+    impressions, clicks, dislikes = {}, {}, {}
+    for username, kind, ad_id, ts in batch:
+        if kind in ("like", "dislike"):
+            feedback.setdefault(username, []).append((ad_id, kind))
+        if kind == "impression":
+            impressions[ad_id] = impressions.get(ad_id, 0) + 1
+        elif kind == "click":
+            clicks[ad_id] = clicks.get(ad_id, 0) + 1
+        elif kind == "dislike":
+            dislikes[ad_id] = dislikes.get(ad_id, 0) + 1
+
+    with span("events.apply"):
+        snap = catalog.snapshot()
+        for username, items in feedback.items():
+            before = user_store.preferences(username)
+            after = user_store.apply_feedback(username, items)
+            user_affinity.apply(username, before, after, [ad_id for ad_id, _ in items], snap)
+            ranked_cache.invalidate(username)
+        counted = impressions.keys() | clicks.keys()
+        with db.transaction(ADS_DB) as conn:
+            conn.executemany("""
+                UPDATE ads
+                SET impressions = impressions + ?, clicks = clicks + ?,
+                    ctr = CAST(clicks + ? AS FLOAT) / CASE WHEN impressions + ? = 0 THEN 1 ELSE impressions + ? END
+                WHERE id=?
+            """, [(impressions.get(a, 0), clicks.get(a, 0), clicks.get(a, 0),
+                   impressions.get(a, 0), impressions.get(a, 0), a) for a in counted])
+            # same CTR penalty as /dislike, once per dislike
+            conn.executemany("UPDATE ads SET ctr = MAX(0.0, ctr - 0.4 * ?) WHERE id=?",
+                             [(n, a) for a, n in dislikes.items()])
+            rollups.record(conn, [(ad_id, ts, int(kind == "impression"), int(kind == "click"), int(kind == "dislike"))
+                                  for _, kind, ad_id, ts in batch if kind != "like"])
+        changed = counted | dislikes.keys()
+        if changed:
+            catalog.refresh_ads(sorted(changed))
+    db.release_thread()
+
+event_queue = EventQueue(apply_event_batch)
+metrics.register_collector("ads_event_queue_depth", "gauge", "Events waiting to be applied.",
+                           lambda: {(): len(event_queue)})
+metrics.register_collector("ads_events_applied_total", "counter", "Events applied from /events.",
+                           lambda: {(): event_queue.applied})
+
+@app.route("/events", methods=["POST"])
+def ingest_events():
+    payload = request.get_json(force=True, silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get("events")
+    if not isinstance(payload, list):
+        return jsonify({"error": "expected a JSON array of events"}), 400
+    if len(payload) > MAX_EVENTS:
+        return jsonify({"error": f"at most {MAX_EVENTS} events per request"}), 413
+
+    with span("events.validate"):
+        snap = catalog.snapshot()
+        user = session.get("user")
+        events, errors = validate_events(payload, snap.index.__contains__, user is not None)
+    if events:
+        event_queue.put(user["username"] if user else None, events)
+    status = 202 if events or not payload else 400
+    return jsonify({"accepted": len(events), "rejected": errors}), status
+
 # --- Publish Ads (with image upload) ---
 @app.route("/publish", methods=["GET", "POST"])
 def publish():
@@ -383,7 +653,7 @@ def publish():
         owner = session["user"]["username"]
 
         try:
-            image_url = save_uploaded_image(image_file, owner, prefix="ad")
+            image_url = save_uploaded_image(image_file)
         except ValueError as ve:
             flash(str(ve), "danger")
             return redirect(url_for("publish"))
@@ -400,7 +670,7 @@ def publish():
                    link, owner, 1, start_dt.isoformat(), end_dt.isoformat(), created_at.isoformat()))
         conn.commit()
         new_id = c.lastrowid
-        conn.close()
+        catalog.refresh_ads([new_id])
 
         # CSV export/backup (optional)
         ensure_csv_header()
@@ -425,7 +695,6 @@ def my_ads():
     c.execute("""SELECT id, title, category, image_url, clicks, impressions, ctr, is_active, start_date, end_date, created_at
                  FROM ads WHERE owner=? ORDER BY id DESC""", (owner,))
     rows = c.fetchall()
-    conn.close()
     ads = []
     for r in rows:
         ads.append({
@@ -445,11 +714,11 @@ def toggle_ad(ad_id):
     c.execute("SELECT owner, is_active FROM ads WHERE id=?", (ad_id,))
     row = c.fetchone()
     if not row or row[0] != owner:
-        conn.close()
         return jsonify({"error": "not found or unauthorized"}), 404
-    new_state = 0 if int(row[1] or 1) == 1 else 1
+    new_state = 0 if row[1] is None or int(row[1]) == 1 else 1  # NULL means active
     c.execute("UPDATE ads SET is_active=? WHERE id=?", (new_state, ad_id))
-    conn.commit(); conn.close()
+    conn.commit()
+    catalog.refresh_ads([ad_id])
     return jsonify({"status": "ok", "is_active": new_state})
 
 @app.route("/ad/delete/<int:ad_id>", methods=["POST"])
@@ -461,10 +730,11 @@ def delete_ad(ad_id):
     c.execute("SELECT owner FROM ads WHERE id=?", (ad_id,))
     row = c.fetchone()
     if not row or row[0] != owner:
-        conn.close()
         return jsonify({"error": "not found or unauthorized"}), 404
     c.execute("DELETE FROM ads WHERE id=?", (ad_id,))
-    conn.commit(); conn.close()
+    rollups.remove_ad(conn, ad_id)
+    conn.commit()
+    catalog.remove_ads([ad_id])
     return jsonify({"status": "ok"})
 
 # --- Profile (with photo upload saved per user) ---
@@ -491,7 +761,7 @@ def profile():
         photo_file = request.files.get("photo_file")
         if photo_file and photo_file.filename.strip():
             try:
-                profile["photo_url"] = save_uploaded_image(photo_file, username, prefix="profile")
+                profile["photo_url"] = save_uploaded_image(photo_file)
             except ValueError as ve:
                 flash(str(ve), "danger")
                 return redirect(url_for("profile"))
@@ -503,7 +773,10 @@ def profile():
     current = load_user_profile(username)
     return render_template("profile.html", profile=current)
 
-# --- Admin (unchanged) ---
+# --- Admin ---
+def is_admin():
+    return "user" in session and session["user"].get("role") == "admin"
+
 @app.route("/admin-login", methods=["GET", "POST"])
 def admin_login():
     if request.method == "POST":
@@ -518,56 +791,92 @@ def admin_login():
 
 @app.route("/admin")
 def admin():
-    if "user" not in session or session["user"].get("role") != "admin":
+    if not is_admin():
         return redirect(url_for("admin_login"))
-
-    conn = open_users_db(); c = conn.cursor()
-    c.execute("SELECT id, username, password, role FROM users")
-    users = c.fetchall()
-    conn.close()
-
-    conn = open_ads_db(); c = conn.cursor()
-    c.execute("SELECT id, title, category, image_url, ctr, clicks, impressions FROM ads")
-    ads = c.fetchall()
-    conn.close()
-
-    return render_template("admin.html", users=users, ads=ads)
+    # the page loads its data from /admin/api/* (paginated, aggregated in SQL)
+    return render_template("admin.html")
+
+# --- Admin metrics API ---
+def page_limit():
+    return min(max(request.args.get("limit", 50, type=int), 1), admin_metrics.MAX_PAGE)
+
+@app.route("/admin/api/summary")
+def admin_summary():
+    if not is_admin():
+        return jsonify({"error": "admin only"}), 403
+    by = request.args.get("by", "clicks")
+    if by not in admin_metrics.AD_SORTS:
+        return jsonify({"error": f"by must be one of {', '.join(admin_metrics.AD_SORTS)}"}), 400
+    return jsonify({
+        "totals": admin_metrics.totals(ADS_DB, USERS_DB),
+        "categories": admin_metrics.category_totals(ADS_DB),
+        "top_ads": admin_metrics.top_ads(ADS_DB, by=by),
+    })
+
+@app.route("/admin/api/ads")
+def admin_ads():
+    if not is_admin():
+        return jsonify({"error": "admin only"}), 403
+    sort = request.args.get("sort", "id")
+    if sort not in admin_metrics.AD_SORTS:
+        return jsonify({"error": f"sort must be one of {', '.join(admin_metrics.AD_SORTS)}"}), 400
+    try:
+        items, nxt = admin_metrics.ads_page(ADS_DB, sort, request.args.get("after"), page_limit())
+    except admin_metrics.BadCursor:
+        return jsonify({"error": "bad cursor"}), 400
+    return jsonify({"items": items, "next": nxt})
+
+@app.route("/admin/api/users")
+def admin_users():
+    if not is_admin():
+        return jsonify({"error": "admin only"}), 403
+    try:
+        items, nxt = admin_metrics.users_page(USERS_DB, request.args.get("after"), page_limit())
+    except admin_metrics.BadCursor:
+        return jsonify({"error": "bad cursor"}), 400
+    owned = admin_metrics.owner_summaries(ADS_DB, [u["username"] for u in items])
+    for u in items:
+        prefs = load_user_preferences(u["username"])
+        u["likes"], u["dislikes"] = len(prefs.likes), len(prefs.dislikes)
+        u.update(owned.get(u["username"], {"ads": 0, "active_ads": 0, "clicks": 0, "impressions": 0}))
+    return jsonify({"items": items, "next": nxt})
+
+EXPORTS = {"ads": (lambda: ADS_DB, admin_metrics.AD_COLUMNS), "users": (lambda: USERS_DB, admin_metrics.USER_COLUMNS)}
+
+@app.route("/admin/api/export/<table>.<fmt>")
+def admin_export(table, fmt):
+    if not is_admin():
+        return jsonify({"error": "admin only"}), 403
+    if table not in EXPORTS or fmt not in ("csv", "json"):
+        return jsonify({"error": "not found"}), 404
+    path, columns = EXPORTS[table]
+    rows = (admin_metrics.export_csv if fmt == "csv" else admin_metrics.export_json)(path(), table, columns)
+    mimetype = "text/csv" if fmt == "csv" else "application/json"
+    return Response(stream_with_context(rows), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={table}.{fmt}"})
+
+CTR_WINDOWS = {"hour": HOUR, "day": DAY, "week": 7 * DAY, "month": 30 * DAY}
+
+@app.route("/admin/api/ctr")
+def admin_windowed_ctr():
+    """Windowed engagement per ad from the rollup buckets: ?window=hour|day|week|month."""
+    if not is_admin():
+        return jsonify({"error": "admin only"}), 403
+    window = request.args.get("window", "day")
+    if window not in CTR_WINDOWS:
+        return jsonify({"error": f"window must be one of {', '.join(CTR_WINDOWS)}"}), 400
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    totals = rollups.window(CTR_WINDOWS[window])
+    rows = [{"ad_id": a, "impressions": i, "clicks": c, "dislikes": d, "ctr": c / i if i else 0.0}
+            for a, (i, c, d) in totals.items()]
+    rows.sort(key=lambda r: (-r["ctr"], -r["impressions"], r["ad_id"]))
+    return jsonify({"window": window, "ads": rows[:limit]})
 
 # --- Startup ---
 if __name__ == "__main__":
     os.makedirs(USERS_FOLDER, exist_ok=True)
-    os.makedirs(STATIC_UPLOAD_ROOT, exist_ok=True)
 
-    if not os.path.exists(ADS_DB):
-        conn = open_ads_db(); c = conn.cursor()
-        c.execute("""CREATE TABLE IF NOT EXISTS ads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            category TEXT,
-            keywords TEXT,
-            target_page TEXT,
-            image_url TEXT,
-            ctr REAL DEFAULT 0,
-            clicks INTEGER DEFAULT 0,
-            impressions INTEGER DEFAULT 0,
-            details TEXT
-        )""")
-        conn.commit(); conn.close()
-        print("Initialized ads.db")
-
-    if not os.path.exists(USERS_DB):
-        conn = open_users_db(); c = conn.cursor()
-        c.execute("""CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            password TEXT,
-            role TEXT DEFAULT 'user'
-        )""")
-        conn.commit(); conn.close()
-        print("Initialized users.db")
-
-    ensure_links_column_and_populate()
-    ensure_publish_columns()
+    migrate_databases()
     ensure_csv_header()
 
     app.run(debug=True)
\ No newline at end of file
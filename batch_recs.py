@@ -0,0 +1,160 @@
+"""
+Offline precompute of context-free recommendations for every user.
+
+``precompute(recommender)`` ranks the top ``top_n`` ads for each user the way
+``AdRecommender.recommend(user, "", "")`` would, and stores them in the
+``user_recs`` table as packed ``REC_DTYPE`` records (20 bytes per ad). Online,
+``recommend`` serves a request without page or interests from that table and
+falls back to live scoring when the entry is missing or stale. Stale means
+another catalog, older than ``recs_max_age``, or the user's preferences or
+dislikes changed since.
+
+Users are split into chunks across a process pool. The catalog-wide inputs
+(CTR, global dislikes and the TF-IDF matrix) are written once to ``.npy``
+files and every worker maps them read-only, so they are shared through the
+page cache instead of being pickled per task. Per-user inputs (likes,
+dislikes) are small and travel with each chunk.
+
+    python batch_recs.py --ads ad_inventory.csv --db metrics.db --users users
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+import db
+from content_index import ContentIndex
+from models import (AdRecommender, CONTENT_WEIGHT, FULL_SCAN_MAX, REC_DTYPE, expand_candidates, final_scores,
+                    read_preferences_likes, select_winners)
+
+DEFAULT_TOP_N = 20
+CHUNK_SIZE = 256
+
+UPSERT = "INSERT OR REPLACE INTO user_recs (user_id, catalog, computed_at, depth, recs) VALUES (?, ?, ?, ?, ?)"
+
+_worker = {}  # per-process state set by _init_worker
+
+
+def _init_worker(array_dir, matrix_shape, rows_by_id, users_root, fallback_k, top_n):
+    load = lambda name: np.load(os.path.join(array_dir, name + ".npy"), mmap_mode="r")
+    ctr, dislikes = load("ctr"), load("dislikes")
+    content_index = ContentIndex()
+    if matrix_shape is not None:
+        matrix = sparse.csr_matrix((load("data"), load("indices"), load("indptr")), shape=matrix_shape, copy=False)
+        content_index = ContentIndex.from_matrix(matrix)
+    _worker.update(ctr=ctr, dislikes=dislikes, content_index=content_index, rows_by_id=rows_by_id,
+                   users_root=users_root, fallback_k=fallback_k, top_n=top_n)
+
+
+def rank_user(user_id, user_dislikes):
+    """Top ``top_n`` for one user as a ``REC_DTYPE`` array (runs in a worker)."""
+    w = _worker
+    ctr, dislikes, content_index = w["ctr"], w["dislikes"], w["content_index"]
+    n = len(ctr)
+    liked = [i for ad_id in read_preferences_likes(w["users_root"], user_id)
+             for i in w["rows_by_id"].get(str(ad_id), ())]
+    query = content_index.query_from_ads(liked)
+    if n <= FULL_SCAN_MAX:
+        cand = np.arange(n)
+    else:
+        cand = expand_candidates(set(), ctr, content_index, query, w["fallback_k"])
+    score = np.zeros(len(cand), dtype=np.float64)
+    if query is not None:
+        score += CONTENT_WEIGHT * content_index.similarities(query, cand)
+    final_score = final_scores(n, cand, score, ctr, dislikes, user_dislikes)
+    winners = select_winners(final_score, cand, user_dislikes, w["top_n"])
+    recs = np.empty(len(winners), dtype=REC_DTYPE)
+    recs["row"] = winners
+    recs["score"] = final_score[winners]
+    recs["ctr"] = ctr[winners]
+    recs["dislikes"] = dislikes[winners]
+    recs["user_dislikes"] = user_dislikes[winners]
+    return recs
+
+
+def _rank_chunk(chunk):
+    n = len(_worker["ctr"])
+    out = []
+    for user_id, disliked in chunk:
+        user_dislikes = np.zeros(n, dtype=np.int64)
+        for row, count in disliked:
+            user_dislikes[row] = count
+        out.append((user_id, rank_user(user_id, user_dislikes).tobytes()))
+    return out
+
+
+def _user_dislikes(recommender):
+    """``{user_id: [(row, dislikes), ...]}`` for every user with any dislike."""
+    out = {}
+    rows_by_id = recommender._rows_by_id
+    for user_id, ad_id, dislikes in db.query(recommender.db_path,
+                                             "SELECT user_id, ad_id, dislikes FROM user_metrics WHERE dislikes > 0"):
+        for i in rows_by_id.get(str(ad_id), ()):
+            out.setdefault(str(user_id), []).append((i, dislikes))
+    return out
+
+
+def precompute(recommender, users=None, top_n=DEFAULT_TOP_N, processes=None, chunk_size=CHUNK_SIZE):
+    """Rank and store the top ``top_n`` for ``users`` (default: every row of the
+    ``users`` table); returns the number of users written."""
+    r = recommender
+    r.counters.flush()  # workers read metrics as of now
+    if users is None:
+        users = [u for (u,) in db.query(r.db_path, "SELECT username FROM users ORDER BY id")]
+    users = [str(u) for u in users]
+    computed_at = time.time()
+    ctr, dislikes = r.global_metrics()
+    disliked = _user_dislikes(r)
+    chunks = [[(u, disliked.get(u, ())) for u in users[i:i + chunk_size]] for i in range(0, len(users), chunk_size)]
+    matrix = r.content_index.matrix()
+    written = 0
+    with tempfile.TemporaryDirectory(prefix="batch_recs-") as array_dir:
+        arrays = {"ctr": ctr, "dislikes": dislikes}
+        if matrix is not None:
+            arrays.update(data=matrix.data, indices=matrix.indices, indptr=matrix.indptr)
+        for name, arr in arrays.items():
+            np.save(os.path.join(array_dir, name + ".npy"), np.ascontiguousarray(arr))
+        initargs = (array_dir, matrix.shape if matrix is not None else None, r._rows_by_id, r.users_root,
+                    r.token_index.fallback_size, top_n)
+        if processes == 1 or len(chunks) <= 1:
+            _init_worker(*initargs)
+            results = map(_rank_chunk, chunks)
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=initargs)
+            results = pool.map(_rank_chunk, chunks)
+        try:
+            for ranked in results:
+                db.executemany(r.db_path, UPSERT,
+                               [(u, r.catalog_fingerprint, computed_at, top_n, blob) for u, blob in ranked])
+                written += len(ranked)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ads", default="ad_inventory.csv", help="catalog CSV")
+    parser.add_argument("--db", default="metrics.db", help="AdRecommender metrics database")
+    parser.add_argument("--users", default="users", help="users folder (preferences.json per user)")
+    parser.add_argument("--top-n", type=int, default=DEFAULT_TOP_N)
+    parser.add_argument("--processes", type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+    t0 = time.perf_counter()
+    recommender = AdRecommender(args.ads, args.db, args.users)
+    try:
+        n = precompute(recommender, top_n=args.top_n, processes=args.processes)
+    finally:
+        recommender.counters.close()
+        recommender.events.close()
+    print(f"precomputed {n} users in {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Benchmark the ranking and engagement paths on synthetic catalogs.
+
+    python benchmarks/run.py --ads 1000 10000 100000 --users 200 --requests 2000
+    python benchmarks/run.py --ads 1000 --out new.json --compare old.json
+
+For every catalog size a fresh workspace is generated (see ``synthetic.py``),
+the Flask app is pointed at it, and these operations are timed:
+
+    http.get_ads / http.like / http.dislike / http.click    through the test client
+    direct.recommend / direct.record_click / direct.record_dislike
+                                                            on AdRecommender
+
+Results (throughput and p50/p95/p99 latency per operation) are printed and
+written as JSON; ``--compare`` flags operations whose p95 or throughput got
+worse than a previous results file by more than ``--threshold``.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.synthetic import build_workspace  # noqa: E402
+
+HTTP_MIX = [("get_ads", 0.7), ("like", 0.1), ("dislike", 0.05), ("click", 0.15)]
+PAGES = ["homepage", "nutrition", "tech", "fashion", "travel"]
+INTERESTS = ["", "running shoes", "coffee", "laptop headphones", "vegan pizza", "yoga"]
+
+
+class Recorder:
+    """Collects per-operation latencies (ns)."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, name, fn, *args, **kwargs):
+        t0 = time.perf_counter_ns()
+        out = fn(*args, **kwargs)
+        self.samples.setdefault(name, []).append(time.perf_counter_ns() - t0)
+        return out
+
+    def summary(self):
+        out = {}
+        for name, samples in sorted(self.samples.items()):
+            ms = np.asarray(samples, dtype=np.float64) / 1e6
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            out[name] = {
+                "count": len(ms),
+                "throughput_per_s": round(len(ms) / (ms.sum() / 1000), 2) if ms.sum() else None,
+                "mean_ms": round(float(ms.mean()), 4),
+                "p50_ms": round(float(p50), 4),
+                "p95_ms": round(float(p95), 4),
+                "p99_ms": round(float(p99), 4),
+                "max_ms": round(float(ms.max()), 4),
+            }
+        return out
+
+
+def _pick(rng, weighted):
+    names, weights = zip(*weighted)
+    return rng.choices(names, weights=weights)[0]
+
+
+def point_app_at(app_module, paths):
+    """Re-target the app's module globals at a synthetic workspace, rebuilding
+    every singleton that holds a path, another singleton or cached state from
+    the repo's own data."""
+    from images import ImagePipeline
+    from personalization import AdFeatures, AffinityVectors, RankedListCache
+    from response_cache import ResponseCache
+    from rollups import RollupStore
+    from user_store import UserStore
+
+    a = app_module
+    a.ADS_DB = paths["ads_db"]
+    a.USERS_DB = paths["users_db"]
+    a.USERS_FOLDER = Path(paths["users_folder"])
+    a.AD_CSV = paths["ad_csv"]
+    a.migrate_databases()
+    a.user_store.close()
+    a.user_store = UserStore(paths["users_folder"])
+    a.rollups.close()
+    a.rollups = RollupStore(paths["ads_db"])
+    # uploads and WebP derivatives go to the workspace, not the repo's static/
+    a.image_pipeline = ImagePipeline(Path(paths["root"]) / "static")
+    a.ad_features = AdFeatures()
+    a.user_affinity = AffinityVectors(a.ad_features, a.user_store, a.CAT_LIKE_BOOST, a.CAT_DISLIKE_PENALTY,
+                                      a.KEYWORD_LIKE_BOOST, a.KEYWORD_DISLIKE_PENALTY)
+    a.ranked_cache = RankedListCache(max_entries=a.ranked_cache.max_entries, ttl=a.ranked_cache.ttl)
+    a.response_cache = ResponseCache(max_entries=a.response_cache.max_entries)
+    a.compressed_cache = ResponseCache(max_entries=a.compressed_cache.max_entries)
+    a.catalog.reload()  # the listeners rebuild the content, token and schedule indexes
+
+
+def bench_http(rec, paths, n_requests, rng):
+    import app as app_module
+
+    point_app_at(app_module, paths)
+    app_module.app.config["TESTING"] = True
+    n_ads = len(app_module.catalog.snapshot())
+    clients = {}
+
+    def client_for(username):
+        client = clients.get(username)
+        if client is None:
+            client = clients[username] = app_module.app.test_client()
+            resp = client.post("/login", data={"username": username, "password": "pw"})
+            assert resp.status_code == 302, f"login failed for {username}"
+        return client
+
+    usernames = paths["usernames"]
+    # Warm up: one request per user logs them in and fills the caches
+    for u in usernames[: min(len(usernames), 50)]:
+        client_for(u).get("/get_ads")
+
+    for _ in range(n_requests):
+        client = client_for(rng.choice(usernames))
+        op = _pick(rng, HTTP_MIX)
+        if op == "get_ads":
+            resp = rec.time("http.get_ads", client.get, "/get_ads")
+        else:
+            ad_id = rng.randint(1, n_ads)
+            resp = rec.time(f"http.{op}", client.post, f"/{op}/{ad_id}")
+        assert resp.status_code < 500, f"{op} -> {resp.status_code}"
+    app_module.user_store.flush()
+
+
+def bench_direct(rec, paths, n_requests, rng):
+    from models import AdRecommender
+
+    rec.time("direct.init", AdRecommender, paths["ad_csv"], paths["metrics_db"], paths["users_folder"])
+    model = AdRecommender(paths["ad_csv"], paths["metrics_db"], paths["users_folder"])
+    for phase, seconds in model.startup_timings.items():
+        rec.samples.setdefault(f"direct.init.{phase}", []).append(int(seconds * 1e9))
+    n_ads = len(model)
+    usernames = paths["usernames"]
+    for _ in range(n_requests):
+        user = rng.choice(usernames)
+        r = rng.random()
+        if r < 0.7:
+            rec.time("direct.recommend", model.recommend, user, rng.choice(PAGES), rng.choice(INTERESTS))
+        elif r < 0.9:
+            rec.time("direct.record_click", model.record_click, rng.randint(1, n_ads), user)
+        else:
+            rec.time("direct.record_dislike", model.record_dislike, rng.randint(1, n_ads), user)
+    model.counters.close()
+    model.events.close()
+
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """Print a side-by-side of two result files; return the regressions."""
+    regressions = []
+    for size, ops in new["runs"].items():
+        for name, cur in ops.items():
+            prev = old.get("runs", {}).get(size, {}).get(name)
+            if not prev or name.startswith("setup."):
+                continue
+            p95_delta = cur["p95_ms"] / prev["p95_ms"] - 1 if prev["p95_ms"] else 0.0
+            tput_delta = (cur["throughput_per_s"] or 0) / prev["throughput_per_s"] - 1 if prev["throughput_per_s"] else 0.0
+            flag = p95_delta > threshold or tput_delta < -threshold
+            print(f"{size:>8} {name:<24} p95 {prev['p95_ms']:9.3f} -> {cur['p95_ms']:9.3f} ms ({p95_delta:+.1%})"
+                  f"  tput {tput_delta:+.1%}{'  REGRESSION' if flag else ''}")
+            if flag:
+                regressions.append((size, name))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--ads", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=1000, help="timed operations per path and size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--skip-direct", action="store_true")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="previous results file to diff against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative slowdown")
+    parser.add_argument("--keep", action="store_true", help="keep the generated workspaces")
+    args = parser.parse_args(argv)
+
+    results = {
+        "created_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "git_rev": _git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"users": args.users, "requests": args.requests, "seed": args.seed},
+        "runs": {},
+    }
+    for n_ads in args.ads:
+        root = tempfile.mkdtemp(prefix=f"adbench-{n_ads}-")
+        rec = Recorder()
+        try:
+            paths = rec.time("setup.generate", build_workspace, root, n_ads, args.users, seed=args.seed)
+            rng = random.Random(args.seed)
+            if not args.skip_http:
+                bench_http(rec, paths, args.requests, rng)
+            if not args.skip_direct:
+                bench_direct(rec, paths, args.requests, rng)
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+        summary = results["runs"][str(n_ads)] = rec.summary()
+        print(f"\n== {n_ads} ads, {args.users} users ==")
+        for name, s in summary.items():
+            print(f"{name:<24} n={s['count']:<6} {s['throughput_per_s'] or 0:>10.1f}/s"
+                  f"  p50 {s['p50_ms']:8.3f}  p95 {s['p95_ms']:8.3f}  p99 {s['p99_ms']:8.3f} ms")
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nwrote {args.out}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            old = json.load(f)
+        print(f"\n== compared with {args.compare} ({old.get('git_rev')}) ==")
+        if compare(old, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
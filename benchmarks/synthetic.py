@@ -0,0 +1,156 @@
+"""
+Synthetic catalogs and user populations for the benchmarks.
+
+``build_workspace(root, n_ads, n_users)`` writes a self-contained copy of the
+app's data layout under ``root``:
+
+    ads.db                      ads table (same columns as the real one)
+    users.db                    users table
+    ad_inventory.csv            catalog for AdRecommender
+    metrics.db                  AdRecommender's metrics database (created lazily)
+    users/<name>/preferences.json
+
+Ad popularity is Zipf-like and every user favours one or two categories, so
+likes/dislikes cluster the way real preferences do.
+"""
+import csv
+import json
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+CATEGORIES = [
+    "Sports", "Food", "Electronics", "Fashion", "Travel", "Home", "Fitness",
+    "Entertainment", "Books", "Beauty", "Auto", "Finance", "Games", "Music",
+]
+WORDS = [
+    "running", "shoes", "protein", "snack", "phone", "bike", "coffee", "yoga",
+    "chair", "bag", "jacket", "laptop", "headphones", "camera", "watch", "tea",
+    "lamp", "sofa", "novel", "guitar", "console", "lipstick", "tyres", "loan",
+    "flight", "hotel", "pizza", "vegan", "organic", "discount", "premium", "kids",
+]
+PAGES = ["homepage", "nutrition", "tech", "fashion", "travel", "blog", ""]
+
+ADS_SCHEMA = """CREATE TABLE IF NOT EXISTS ads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ad_id INTEGER,
+    title TEXT,
+    category TEXT,
+    keywords TEXT,
+    target_page TEXT,
+    image_url TEXT,
+    ctr REAL DEFAULT 0,
+    clicks INTEGER DEFAULT 0,
+    impressions INTEGER DEFAULT 0,
+    details TEXT,
+    link TEXT,
+    owner TEXT,
+    is_active INTEGER DEFAULT 1,
+    start_date TEXT,
+    end_date TEXT,
+    created_at TEXT
+)"""
+
+USERS_SCHEMA = """CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    role TEXT DEFAULT 'user'
+)"""
+
+
+def synthetic_ads(n_ads, rng):
+    """Yield ad rows: (title, category, keywords, target_page, image_url, ctr,
+    clicks, impressions, details, link, owner, is_active, start, end, created)."""
+    now = datetime.utcnow()
+    for i in range(n_ads):
+        category = rng.choice(CATEGORIES)
+        words = rng.sample(WORDS, 3)
+        impressions = int(rng.paretovariate(1.2) * 20)
+        clicks = int(impressions * rng.betavariate(2, 12))
+        start = now - timedelta(days=rng.randint(0, 30))
+        end = start + timedelta(days=rng.randint(1, 60))
+        yield (
+            f"{words[0].title()} {words[1]} offer #{i}",
+            category,
+            ", ".join(words),
+            rng.choice(PAGES),
+            f"/static/images/synthetic/{i % 50}.webp",
+            round(clicks / impressions, 4) if impressions else 0.0,
+            clicks,
+            impressions,
+            f"{' '.join(rng.choices(WORDS, k=30))}.",
+            f"https://example.com/ads/{i}",
+            f"owner{i % 97}",
+            1 if rng.random() > 0.05 else 0,
+            start.isoformat(),
+            end.isoformat(),
+            start.isoformat(),
+        )
+
+
+def synthetic_preferences(n_ads, ad_categories, rng):
+    """Likes/dislikes for one user: mostly from one or two favourite categories."""
+    favourites = set(rng.sample(CATEGORIES, rng.randint(1, 2)))
+    likes, dislikes = set(), set()
+    n_likes = min(n_ads, int(rng.expovariate(1 / 12)))
+    n_dislikes = min(n_ads, int(rng.expovariate(1 / 6)))
+    attempts = 0
+    while len(likes) < n_likes and attempts < n_likes * 20:
+        attempts += 1
+        ad_id = min(n_ads, int(rng.paretovariate(0.8)))  # popular ads get liked more
+        ad_id = rng.randint(1, n_ads) if rng.random() < 0.5 else ad_id
+        if ad_categories[ad_id - 1] in favourites or rng.random() < 0.1:
+            likes.add(ad_id)
+    while len(dislikes) < n_dislikes:
+        ad_id = rng.randint(1, n_ads)
+        if ad_id not in likes:
+            dislikes.add(ad_id)
+    return {"likes": sorted(likes), "dislikes": sorted(dislikes)}
+
+
+def build_workspace(root, n_ads, n_users, seed=0):
+    """Create the data files under ``root`` and return a dict of their paths."""
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    paths = {
+        "root": root,
+        "ads_db": os.path.join(root, "ads.db"),
+        "users_db": os.path.join(root, "users.db"),
+        "metrics_db": os.path.join(root, "metrics.db"),
+        "ad_csv": os.path.join(root, "ad_inventory.csv"),
+        "users_folder": os.path.join(root, "users"),
+    }
+
+    ads = list(synthetic_ads(n_ads, rng))
+    conn = sqlite3.connect(paths["ads_db"])
+    conn.execute(ADS_SCHEMA)
+    conn.executemany(
+        """INSERT INTO ads (title, category, keywords, target_page, image_url, ctr, clicks, impressions,
+                            details, link, owner, is_active, start_date, end_date, created_at)
+           VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", ads)
+    conn.commit(); conn.close()
+
+    with open(paths["ad_csv"], "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["ad_id", "title", "category", "keywords", "target_page", "image_url",
+                    "ctr", "clicks", "impressions", "details", "link"])
+        for i, a in enumerate(ads, start=1):
+            w.writerow([i, *a[:10]])
+
+    usernames = [f"user{i}" for i in range(n_users)]
+    conn = sqlite3.connect(paths["users_db"])
+    conn.execute(USERS_SCHEMA)
+    conn.executemany("INSERT INTO users (username, password, role) VALUES (?,?,?)",
+                     [(u, "pw", "user") for u in usernames])
+    conn.commit(); conn.close()
+
+    categories = [a[1] for a in ads]
+    for u in usernames:
+        folder = os.path.join(paths["users_folder"], u)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "preferences.json"), "w", encoding="utf-8") as f:
+            json.dump(synthetic_preferences(n_ads, categories, rng), f)
+    paths["usernames"] = usernames
+    return paths
@@ -0,0 +1,284 @@
+"""
+In-memory, versioned snapshot of the ``ads`` table.
+
+The serving path (``/get_ads``) reads ads only from the current snapshot.
+Writers (publish, toggle, delete, click, dislike) ask the catalog to rebuild
+the affected rows; the new snapshot is swapped in atomically and gets a new
+version number that other layers can use as a cache key.
+"""
+import threading
+
+import numpy as np
+
+# Column order used by loaders: one tuple per ad in this order.
+AD_COLUMNS = (
+    "id", "title", "category", "keywords", "target_page", "image_url",
+    "ctr", "clicks", "impressions", "details", "link", "is_active", "start_date", "end_date",
+)
+
+AD_SELECT = """SELECT id, title, category, keywords, target_page, image_url, ctr, clicks, impressions, details, link,
+                      is_active, start_date, end_date
+               FROM ads"""
+
+
+def title_key(title, ad_id):
+    """De-duplication key: the normalized title, or the id for untitled ads."""
+    title = (title or "").strip()
+    return title.lower() if title else f"id-{ad_id}"
+
+
+def _frozen(arr):
+    arr.flags.writeable = False
+    return arr
+
+
+# Largest CTR drift of any ad (vs. the last ranking_version) before cached
+# rankings are considered stale; 0.01 is one score point, under the session jitter
+RANKING_CTR_TOLERANCE = 0.01
+
+# (attribute, position in the row tuple, value from the raw column)
+_TEXT_COLUMNS = (
+    ("titles", 1, lambda v: v or ""), ("categories", 2, lambda v: v or ""), ("keywords", 3, lambda v: v or ""),
+    ("target_pages", 4, lambda v: v or ""), ("image_urls", 5, lambda v: v or ""), ("details", 9, lambda v: v or ""),
+    ("links", 10, lambda v: v or ""), ("start_dates", 12, lambda v: v), ("end_dates", 13, lambda v: v),
+)
+# (attribute, position in the row tuple, dtype, value from the raw column)
+_NUMERIC_COLUMNS = (
+    ("ctr", 6, np.float64, lambda v: float(v or 0.0)),
+    ("clicks", 7, np.int64, lambda v: int(v or 0)),
+    ("impressions", 8, np.int64, lambda v: int(v or 0)),
+    ("active_flags", 11, np.int8, lambda v: 1 if v is None else int(v)),
+)
+
+
+class CatalogSnapshot:
+    """
+    Immutable column-wise view of the ads table.
+
+    Numeric columns are NumPy arrays, text columns are tuples, and ``index``
+    maps an ad id to its row. ``category_codes[i]`` indexes ``category_names``.
+    Scheduling columns (``active_flags``, ``start_dates``, ``end_dates``) are
+    kept raw; ``scheduling.ActiveSchedule`` decides what is servable.
+    ``ranking_version`` is the version of the last snapshot whose ranking
+    inputs differ materially from this one's (see ``with_rows``); caches of
+    ranked lists key on it instead of ``version``.
+    """
+
+    __slots__ = (
+        "version", "ids", "titles", "categories", "keywords", "target_pages",
+        "image_urls", "ctr", "clicks", "impressions", "details", "links",
+        "active_flags", "start_dates", "end_dates", "index", "id_order", "category_names", "category_codes",
+        "ranking_version", "ranked_ctr",
+    )
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.ids = _frozen(np.array([int(r[0]) for r in rows], dtype=np.int64))
+        for name, k, value in _TEXT_COLUMNS:
+            setattr(self, name, tuple(value(r[k]) for r in rows))
+        for name, k, dtype, value in _NUMERIC_COLUMNS:
+            setattr(self, name, _frozen(np.array([value(r[k]) for r in rows], dtype=dtype)))
+        self.index = {int(ad_id): i for i, ad_id in enumerate(self.ids.tolist())}
+        self.id_order = _frozen(np.argsort(self.ids, kind="stable"))  # rows by ascending id, for rows_of
+        self._encode_categories()
+        self.ranking_version = version
+        self.ranked_ctr = self.ctr
+
+    def _encode_categories(self):
+        # Categories as small integer codes, so per-category terms are one gather
+        names, codes = np.unique(np.array(self.categories, dtype=str), return_inverse=True)
+        self.category_names = tuple(names.tolist())
+        self.category_codes = _frozen(codes.astype(np.int32).reshape(-1))
+
+    def with_rows(self, version, updates):
+        """Copy of this snapshot as ``version`` with existing rows replaced
+        (``{row: row tuple}``). Numeric columns are copied and patched; text
+        columns, the id index and the category codes are shared unless an
+        update actually changes them, so a counter refresh is O(columns)
+        array copies rather than a rebuild of every row."""
+        snap = object.__new__(CatalogSnapshot)
+        snap.version = version
+        snap.ids = self.ids
+        snap.index = self.index
+        snap.id_order = self.id_order
+        pos = np.fromiter(updates, dtype=np.int64, count=len(updates))
+        rows = list(updates.values())
+        for name, k, value in _TEXT_COLUMNS:
+            col = getattr(self, name)
+            new = [(i, value(r[k])) for i, r in zip(pos.tolist(), rows)]
+            if any(col[i] != v for i, v in new):
+                col = list(col)
+                for i, v in new:
+                    col[i] = v
+                col = tuple(col)
+            setattr(snap, name, col)
+        for name, k, dtype, value in _NUMERIC_COLUMNS:
+            col = getattr(self, name).copy()
+            col[pos] = [value(r[k]) for r in rows]
+            setattr(snap, name, _frozen(col))
+        if snap.categories is self.categories:
+            snap.category_names, snap.category_codes = self.category_names, self.category_codes
+        elif all(snap.categories[i] in self.category_names for i in pos.tolist()):
+            codes = self.category_codes.copy()
+            codes[pos] = [self.category_names.index(snap.categories[i]) for i in pos.tolist()]
+            snap.category_names, snap.category_codes = self.category_names, _frozen(codes)
+        else:
+            snap._encode_categories()
+        # Rankings computed at ranking_version stay good enough until some ad's
+        # text changes or its CTR moves more than RANKING_CTR_TOLERANCE
+        text_changed = any(getattr(snap, name) is not getattr(self, name) for name, _, _ in _TEXT_COLUMNS)
+        if text_changed or np.any(np.abs(snap.ctr[pos] - self.ranked_ctr[pos]) > RANKING_CTR_TOLERANCE):
+            snap.ranking_version, snap.ranked_ctr = version, snap.ctr
+        else:
+            snap.ranking_version, snap.ranked_ctr = self.ranking_version, self.ranked_ctr
+        return snap
+
+    def __len__(self):
+        return len(self.titles)
+
+    def rows_of(self, ad_ids):
+        """Rows of ``ad_ids`` (an int64 array), skipping ids not in this snapshot."""
+        if not len(self.ids):
+            return np.zeros(0, dtype=np.int64)
+        pos = np.searchsorted(self.ids, ad_ids, sorter=self.id_order)
+        rows = self.id_order[np.minimum(pos, len(self.ids) - 1)]
+        return rows[self.ids[rows] == ad_ids]
+
+    def row_tuple(self, i):
+        return (
+            int(self.ids[i]), self.titles[i], self.categories[i], self.keywords[i],
+            self.target_pages[i], self.image_urls[i], float(self.ctr[i]),
+            int(self.clicks[i]), int(self.impressions[i]), self.details[i], self.links[i],
+            int(self.active_flags[i]), self.start_dates[i], self.end_dates[i],
+        )
+
+    def dedupe_by_title(self, mask=None):
+        """``(rows, pos)``: the rows (only where ``mask``, if given) left after
+        de-duplicating by title, highest CTR wins, in table order; ``pos[i]`` is
+        row ``i``'s position in ``rows``, -1 if it isn't one of them."""
+        best = {}
+        for i, title in enumerate(self.titles):
+            if mask is not None and not mask[i]:
+                continue
+            key = title_key(title, self.ids[i])
+            if key not in best or self.ctr[i] > self.ctr[best[key]]:
+                best[key] = i
+        rows = _frozen(np.fromiter(best.values(), dtype=np.int64, count=len(best)))
+        pos = np.full(len(self.titles), -1, dtype=np.int64)
+        pos[rows] = np.arange(len(rows))
+        return rows, _frozen(pos)
+
+    def ad(self, i, fields=None):
+        """Materialize row ``i`` as the dict shape returned by ``/get_ads``
+        (only ``fields``, in that order, when given)."""
+        if fields is None:
+            fields = AD_FIELDS
+        return {f: AD_FIELDS[f](self, i) for f in fields}
+
+
+# field name -> getter(snapshot, row); the full /get_ads ad shape, in order
+AD_FIELDS = {
+    "id": lambda s, i: int(s.ids[i]),
+    "title": lambda s, i: s.titles[i],
+    "category": lambda s, i: s.categories[i],
+    "keywords": lambda s, i: s.keywords[i],
+    "target_page": lambda s, i: s.target_pages[i],
+    "image_url": lambda s, i: s.image_urls[i],
+    "ctr": lambda s, i: float(s.ctr[i]),
+    "clicks": lambda s, i: int(s.clicks[i]),
+    "impressions": lambda s, i: int(s.impressions[i]),
+    "details": lambda s, i: s.details[i] or "No details available.",
+    "link": lambda s, i: s.links[i],
+}
+
+
+class Catalog:
+    """
+    Process-wide holder of the current ``CatalogSnapshot``.
+
+    ``load_rows(ad_ids)`` must return row tuples in ``AD_COLUMNS`` order; it is
+    called with ``None`` for a full load and with a list of ids when only some
+    ads changed. Readers never take the lock: they grab ``snapshot()`` once and
+    keep using that object for the whole request. A new snapshot becomes
+    visible only after every listener has processed it.
+    """
+
+    def __init__(self, load_rows):
+        self._load_rows = load_rows
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = 0
+        self._listeners = []
+
+    @property
+    def version(self):
+        return self.snapshot().version
+
+    def snapshot(self):
+        snap = self._snapshot
+        if snap is None:
+            with self._lock:
+                snap = self._snapshot or self._swap(self._load_rows(None), None, ())  # first load, once
+        return snap
+
+    def subscribe(self, fn):
+        """Call ``fn(snapshot, changed_ids, removed_ids)`` for every new snapshot,
+        before it is published. ``changed_ids`` is ``None`` after a full reload."""
+        self._listeners.append(fn)
+        return fn
+
+    def reload(self):
+        """Rebuild the snapshot from a full table scan."""
+        with self._lock:
+            rows = self._load_rows(None)
+            return self._swap(rows, None, ())
+
+    def refresh_ads(self, ad_ids):
+        """Re-read only ``ad_ids`` and swap in a snapshot with those rows updated
+        (rows that no longer exist are dropped)."""
+        ad_ids = [int(a) for a in ad_ids]
+        with self._lock:
+            old = self._snapshot
+            if old is None:
+                return self._swap(self._load_rows(None), None, ())
+            fresh = {int(r[0]): r for r in self._load_rows(ad_ids)}
+            removed = [a for a in ad_ids if a not in fresh]
+            if all(a in old.index for a in fresh) and not any(a in old.index for a in removed):
+                # Same ads, same order (e.g. counters or flags changed): patch the rows in place
+                self._version += 1
+                snap = old.with_rows(self._version, {old.index[a]: r for a, r in fresh.items()})
+                return self._publish(snap, [a for a in ad_ids if a in fresh], removed)
+            rows = []
+            for i in range(len(old)):
+                ad_id = int(old.ids[i])
+                if ad_id in fresh:
+                    rows.append(fresh.pop(ad_id))
+                elif ad_id not in removed:
+                    rows.append(old.row_tuple(i))
+            rows.extend(fresh.values())  # newly inserted ads go at the end, like the table
+            changed = [a for a in ad_ids if a not in removed]
+            return self._swap(rows, changed, removed)
+
+    def remove_ads(self, ad_ids):
+        """Drop ``ad_ids`` from the snapshot without touching the database."""
+        removed = {int(a) for a in ad_ids}
+        with self._lock:
+            old = self._snapshot
+            if old is None:
+                # first load: listeners must see a full build (changed_ids None)
+                rows = [r for r in self._load_rows(None) if int(r[0]) not in removed]
+                return self._swap(rows, None, ())
+            rows = [old.row_tuple(i) for i in range(len(old)) if int(old.ids[i]) not in removed]
+            return self._swap(rows, [], sorted(removed))
+
+    def _swap(self, rows, changed_ids, removed_ids):
+        self._version += 1
+        return self._publish(CatalogSnapshot(self._version, rows), changed_ids, removed_ids)
+
+    def _publish(self, snap, changed_ids, removed_ids):
+        # Listeners catch up first, so a reader that sees ``snap`` also sees
+        # the indexes and schedule built for it
+        for fn in self._listeners:
+            fn(snap, changed_ids, removed_ids)
+        self._snapshot = snap
+        return snap
@@ -0,0 +1,31 @@
+"""
+Optional gzip / brotli compression of JSON responses.
+
+Brotli is used when the client accepts it and the ``brotli`` package is
+installed; gzip otherwise. Small bodies are sent as-is.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_SIZE = 512  # bytes; below this the headers cost more than they save
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+
+
+def choose_encoding(accept_encodings):
+    """``"br"``, ``"gzip"`` or ``None`` for a werkzeug ``Accept-Encoding`` header."""
+    if brotli is not None and accept_encodings.quality("br") > 0:
+        return "br"
+    if accept_encodings.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
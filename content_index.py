@@ -0,0 +1,295 @@
+"""
+TF-IDF content index over ads (title, keywords, category, details).
+
+Each ad is one L2-normalized sparse row, so the cosine similarity between a
+query and every ad is a single sparse matrix-vector product. New or edited
+ads are transformed with the already fitted vocabulary and appended, instead
+of refitting the whole corpus; ``needs_refit`` turns true once enough ads
+were added that the IDF weights are worth recomputing.
+
+Fitting is deferred to the first query: ``fit`` only records the corpus, so
+building an index (and the process around it) does not pay for importing
+sklearn until similarities are actually needed.
+"""
+import threading
+
+import numpy as np
+from scipy import sparse
+
+
+def normalize(m):
+    # sklearn (and the pandas it drags in) costs seconds to import; only pay
+    # for it once an index is actually built
+    from sklearn.preprocessing import normalize
+    return normalize(m)
+
+
+def _fit_tfidf(docs):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    vectorizer = TfidfVectorizer(stop_words="english", sublinear_tf=True, dtype=np.float32)
+    try:
+        return vectorizer, vectorizer.fit_transform(docs).tocsr()
+    except ValueError:  # empty corpus / empty vocabulary
+        return None, None
+
+
+def ad_document(title, keywords, category, details):
+    """Text used to index one ad. Title, keywords and category are repeated
+    so they outweigh the long free-text details."""
+    head = " ".join(str(v or "") for v in (title, keywords, category))
+    return f"{head} {head} {details or ''}"
+
+
+class ContentIndex:
+    def __init__(self, refit_ratio=0.25):
+        self.refit_ratio = refit_ratio
+        self._lock = threading.Lock()
+        self._fit_lock = threading.Lock()
+        self._vectorizer = None
+        self._matrix = None          # consolidated CSR, one row per slot
+        self._pending = []           # rows appended since the last consolidation
+        self._alive = np.zeros(0, dtype=bool)
+        self._keys = []              # slot -> ad key
+        self._row_of = {}            # ad key -> slot
+        self._docs = {}              # ad key -> indexed text, the whole corpus
+        self._stale = False          # _docs changed since the matrix was built: fit on next use
+        self._corpus_version = 0     # bumped by every change to _docs while stale
+        self._fitted_count = 0
+        self._added_since_fit = 0
+        self.generation = 0          # bumped by every fit: vectors from older fits are incomparable
+        self._aligned = None         # (ids, row_of, slots) from the last slots_for()
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """Read-only index over an already built ``matrix`` with keys ``range(n)``.
+        It has no vocabulary, so only ad-based queries work (batch workers)."""
+        index = cls()
+        n = matrix.shape[0]
+        index._matrix = matrix
+        index._alive = np.ones(n, dtype=bool)
+        index._keys = list(range(n))
+        index._row_of = {i: i for i in range(n)}
+        index._fitted_count = n
+        return index
+
+    def __len__(self):
+        return len(self._docs) if self._stale else len(self._row_of)
+
+    def matrix(self):
+        """The consolidated CSR matrix (``None`` before a successful fit)."""
+        return self._consolidated()[0]
+
+    @property
+    def needs_refit(self):
+        return self._added_since_fit > max(1, self._fitted_count) * self.refit_ratio
+
+    def fit(self, keys, docs):
+        """Replace the corpus. The vocabulary, IDF weights and matrix are rebuilt
+        from scratch by the next query (see ``_materialize``)."""
+        docs = dict(zip(keys, docs))
+        with self._lock:
+            self._docs = docs
+            self._stale = True
+            self._corpus_version += 1
+            self.generation += 1
+
+    def refit(self):
+        with self._lock:
+            keys = list(self._docs)
+            docs = list(self._docs.values())
+        self.fit(keys, docs)
+
+    def add(self, key, doc):
+        """Index (or re-index) a single ad using the current vocabulary; returns
+        ``False`` when ``doc`` is unchanged and nothing was done."""
+        with self._lock:
+            if self._stale or self._vectorizer is None:
+                # no usable vocabulary yet: fold the ad into the pending fit
+                if self._docs.get(key) == doc:
+                    return False
+                self._docs[key] = doc
+                self._corpus_version += 1
+                if not self._stale:
+                    self._stale = True
+                    self.generation += 1
+                return True
+        if self._docs.get(key) == doc:
+            return False
+        row = normalize(self._vectorizer.transform([doc])).astype(np.float32)
+        # Writers replace the containers instead of mutating them, so readers
+        # holding the previous references never see a half-applied update.
+        with self._lock:
+            alive = np.append(self._alive, True)
+            old = self._row_of.get(key)
+            if old is not None:
+                alive[old] = False
+            row_of = dict(self._row_of)
+            row_of[key] = len(self._keys)
+            self._keys = self._keys + [key]
+            self._row_of = row_of
+            self._alive = alive
+            self._docs[key] = doc
+            self._pending.append(row)
+            self._added_since_fit += 1
+        return True
+
+    def remove(self, key):
+        with self._lock:
+            if self._docs.pop(key, None) is not None and self._stale:
+                self._corpus_version += 1
+            slot = self._row_of.get(key)
+            if slot is None:
+                return
+            row_of = dict(self._row_of)
+            del row_of[key]
+            alive = self._alive.copy()
+            alive[slot] = False
+            self._row_of, self._alive = row_of, alive
+
+    def _materialize(self):
+        """Run the fit that ``fit``/``add`` deferred, if any. The first caller
+        fits outside ``_lock``; concurrent callers wait for it on ``_fit_lock``."""
+        if not self._stale:
+            return
+        with self._fit_lock:
+            while self._stale:
+                with self._lock:
+                    keys = list(self._docs)
+                    docs = list(self._docs.values())
+                    version = self._corpus_version
+                vectorizer, matrix = _fit_tfidf(docs)
+                with self._lock:
+                    if version != self._corpus_version:
+                        continue  # the corpus changed while fitting
+                    if matrix is None:
+                        keys = []
+                    self._vectorizer = vectorizer
+                    self._matrix = matrix
+                    self._pending = []
+                    self._alive = np.ones(len(keys), dtype=bool)
+                    self._keys = keys
+                    self._row_of = {k: i for i, k in enumerate(keys)}
+                    self._fitted_count = len(keys)
+                    self._added_since_fit = 0
+                    self._stale = False
+
+    def _consolidated(self):
+        self._materialize()
+        with self._lock:
+            if self._pending:
+                self._matrix = sparse.vstack([self._matrix] + self._pending, format="csr")
+                self._pending = []
+            return self._matrix, self._alive, self._row_of, self._keys
+
+    # --- queries ---
+    def query_from_text(self, text):
+        """Sparse query vector for free text such as a user's interests."""
+        self._materialize()
+        if self._vectorizer is None or not text:
+            return None
+        q = self._vectorizer.transform([text])
+        return normalize(q) if q.nnz else None
+
+    def query_from_ads(self, keys):
+        """Centroid of the given ads' rows, e.g. everything a user liked."""
+        matrix, alive, row_of, _ = self._consolidated()
+        slots = [row_of[k] for k in keys if k in row_of]
+        if matrix is None or not slots:
+            return None
+        q = sparse.csr_matrix(matrix[slots].sum(axis=0))
+        return normalize(q) if q.nnz else None
+
+    def slots_for(self, ids):
+        """Slot of each key in ``ids`` (an int64 array), ``-1`` where not indexed.
+        The result for the last ``ids`` array is kept until the index changes, so
+        pass the catalog snapshot's ``ids`` as is and index it by snapshot row."""
+        matrix, alive, row_of, all_keys = self._consolidated()
+        aligned = self._aligned
+        if aligned is not None and aligned[0] is ids and aligned[1] is row_of:
+            return aligned[2]
+        live = np.flatnonzero(alive)
+        live_keys = np.asarray(all_keys, dtype=np.int64)[live]
+        order = np.argsort(live_keys, kind="stable")
+        sorted_keys = live_keys[order]
+        pos = np.minimum(np.searchsorted(sorted_keys, ids), max(len(sorted_keys) - 1, 0))
+        found = sorted_keys[pos] == ids if len(sorted_keys) else np.zeros(len(ids), dtype=bool)
+        slots = np.where(found, live[order][pos] if len(live) else 0, -1)
+        self._aligned = (ids, row_of, slots)
+        return slots
+
+    def similarities(self, query, slots=None):
+        """Cosine similarity of ``query`` to every slot, or only to ``slots`` in that
+        order (see ``slots_for``; 0.0 where a slot is ``-1``)."""
+        matrix, alive, row_of, all_keys = self._consolidated()
+        n = len(all_keys) if slots is None else len(slots)
+        if query is None or matrix is None:
+            return np.zeros(n, dtype=np.float32)
+        if slots is None:
+            sims = (matrix @ query.T).toarray().ravel()
+            return np.where(alive, sims, 0.0).astype(np.float32)
+        sims = np.zeros(n, dtype=np.float32)
+        known = slots >= 0
+        sims[known] = (matrix[slots[known]] @ query.T).toarray().ravel()
+        return sims
+
+    def vector(self, key):
+        """The indexed (normalized) row of ``key``, usable as a query; ``None`` if unknown."""
+        matrix, alive, row_of, _ = self._consolidated()
+        slot = row_of.get(key)
+        if matrix is None or slot is None:
+            return None
+        return matrix[slot]
+
+    def similarities_by_key(self, query):
+        """``(keys, sims)`` over every live ad, keys as an int64 array."""
+        matrix, alive, row_of, all_keys = self._consolidated()
+        if query is None or matrix is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        live = np.flatnonzero(alive)
+        sims = (matrix @ query.T).toarray().ravel()
+        return np.asarray(all_keys, dtype=np.int64)[live], sims[live].astype(np.float32)
+
+    def all_neighbors(self, k, block=256):
+        """``(keys, neighbor_keys, sims)`` for every live ad: its ``k`` most similar
+        other live ads (``-1`` / ``0.0`` padding when fewer share any term), best
+        first. Computed ``block`` rows at a time against the whole matrix."""
+        matrix, alive, row_of, all_keys = self._consolidated()
+        live = np.flatnonzero(alive)
+        keys = np.asarray(all_keys, dtype=np.int64)
+        nbr = np.full((len(live), k), -1, dtype=np.int64)
+        out = np.zeros((len(live), k), dtype=np.float32)
+        if matrix is None or not len(live) or k <= 0:
+            return keys[live], nbr, out
+        m = matrix[live]
+        mt = m.T.tocsc()
+        for start in range(0, len(live), block):
+            sims = (m[start:start + block] @ mt).toarray()
+            rows = np.arange(sims.shape[0])
+            sims[rows, start + rows] = 0.0  # not its own neighbor
+            kk = min(k, sims.shape[1])
+            top = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+            top_sims = np.take_along_axis(sims, top, axis=1)
+            order = np.argsort(-top_sims, axis=1, kind="stable")
+            top, top_sims = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_sims, order, axis=1)
+            found = top_sims > 0
+            nbr[start:start + len(rows), :kk] = np.where(found, keys[live][top], -1)
+            out[start:start + len(rows), :kk] = np.where(found, top_sims, 0.0)
+        return keys[live], nbr, out
+
+    def top_k(self, query, k, exclude=()):
+        """Return ``[(key, similarity), ...]`` for the ``k`` most similar live ads."""
+        matrix, alive, row_of, all_keys = self._consolidated()
+        if query is None or matrix is None or k <= 0:
+            return []
+        sims = (matrix @ query.T).toarray().ravel()
+        sims[~alive] = -np.inf  # sims is a fresh array, safe to modify
+        for key in exclude:
+            slot = row_of.get(key)
+            if slot is not None:
+                sims[slot] = -np.inf
+        k = min(k, int(np.isfinite(sims).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return [(all_keys[i], float(sims[i])) for i in top]
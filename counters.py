@@ -0,0 +1,214 @@
+"""
+Write-behind buffer for impression / click / dislike counters.
+
+Increments are summed in memory per ``ad_id`` and per ``(user_id, ad_id)``
+and written to ``ad_metrics`` / ``user_metrics`` in a single transaction of
+``executemany`` upserts. A flush happens when ``max_pending`` keys are dirty,
+every ``flush_interval`` seconds, on ``flush()`` and at interpreter exit.
+Until its transaction commits, the batch being written still counts as
+pending, so readers adding ``pending_*()`` to the tables never miss it.
+
+With ``journal_path`` set, every increment is also appended to a journal file
+before it is acknowledged. On startup leftover journals are replayed; each
+flushed batch is recorded in ``counter_batches`` inside the same transaction,
+so a batch is never applied twice.
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+import db
+
+AD_UPSERT = """INSERT INTO ad_metrics(ad_id, impressions, clicks, dislikes, last_updated) VALUES (?,?,?,?,?)
+               ON CONFLICT(ad_id) DO UPDATE SET
+                   impressions = impressions + excluded.impressions,
+                   clicks = clicks + excluded.clicks,
+                   dislikes = dislikes + excluded.dislikes,
+                   last_updated = excluded.last_updated"""
+
+USER_UPSERT = """INSERT INTO user_metrics(user_id, ad_id, impressions, clicks, dislikes, last_updated) VALUES (?,?,?,?,?,?)
+                 ON CONFLICT(user_id, ad_id) DO UPDATE SET
+                     impressions = impressions + excluded.impressions,
+                     clicks = clicks + excluded.clicks,
+                     dislikes = dislikes + excluded.dislikes,
+                     last_updated = excluded.last_updated"""
+
+
+def _merge(target, key, delta):
+    acc = target.setdefault(key, [0, 0, 0])
+    for i, v in enumerate(delta):
+        acc[i] += v
+
+
+class CounterBuffer:
+    def __init__(self, db_path, flush_interval=2.0, max_pending=500, journal_path=None, fsync=False):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.journal_path = journal_path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._ads = {}    # ad_id -> [impressions, clicks, dislikes]
+        self._users = {}  # (user_id, ad_id) -> [impressions, clicks, dislikes]
+        self._inflight_ads, self._inflight_users = {}, {}  # batch being written by flush()
+        self._journal = None
+        self._batch_seq = 0
+        self._wake = threading.Event()
+        self._closed = False
+
+        if journal_path:
+            self._replay_journals()
+            self._journal = open(journal_path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="counter-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- writes ---
+    def add(self, ad_id, user_id=None, impressions=0, clicks=0, dislikes=0):
+        ad_id = str(ad_id)
+        delta = (impressions, clicks, dislikes)
+        with self._lock:
+            if self._journal is not None:
+                self._journal.write(f"{ad_id}\t{'' if user_id is None else user_id}\t{impressions}\t{clicks}\t{dislikes}\n")
+                self._journal.flush()
+                if self.fsync:
+                    os.fsync(self._journal.fileno())
+            self._apply(ad_id, user_id, delta)
+            dirty = len(self._ads) + len(self._users)
+        if dirty >= self.max_pending:
+            self._wake.set()
+
+    def _apply(self, ad_id, user_id, delta):
+        _merge(self._ads, ad_id, delta)
+        if user_id is not None:
+            _merge(self._users, (str(user_id), ad_id), delta)
+
+    # --- reads of not-yet-flushed deltas ---
+    def pending_ads(self):
+        """``{ad_id: (impressions, clicks, dislikes)}`` not yet committed to ``ad_metrics``."""
+        with self._lock:
+            out = {}
+            for source in (self._inflight_ads, self._ads):
+                for k, v in source.items():
+                    _merge(out, k, v)
+        return {k: tuple(v) for k, v in out.items()}
+
+    def pending_user(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            out = {}
+            for source in (self._inflight_users, self._users):
+                for (uid, ad_id), v in source.items():
+                    if uid == user_id:
+                        _merge(out, ad_id, v)
+        return {k: tuple(v) for k, v in out.items()}
+
+    # --- flushing ---
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._ads and not self._users:
+                    return 0
+                ads, users = self._ads, self._users
+                self._inflight_ads, self._inflight_users = ads, users
+                self._ads, self._users = {}, {}
+                batch, batch_file = self._rotate_journal()
+            try:
+                self._write(ads, users, batch)
+            except Exception:
+                # Put the deltas (and their journal lines) back so the next flush retries them
+                with self._lock:
+                    for ad_id, v in ads.items():
+                        _merge(self._ads, ad_id, v)
+                    for key, v in users.items():
+                        _merge(self._users, key, v)
+                    self._inflight_ads, self._inflight_users = {}, {}
+                    if batch_file:
+                        with open(batch_file, "r", encoding="utf-8") as f:
+                            self._journal.write(f.read())
+                        self._journal.flush()
+                        os.remove(batch_file)
+                raise
+            with self._lock:
+                self._inflight_ads, self._inflight_users = {}, {}
+            if batch_file:
+                os.remove(batch_file)
+            return len(ads) + len(users)
+
+    def _write(self, ads, users, batch=None):
+        now = int(time.time())
+        with db.transaction(self.db_path) as conn:
+            if batch is not None:
+                conn.execute("CREATE TABLE IF NOT EXISTS counter_batches (batch TEXT PRIMARY KEY, applied_at INTEGER)")
+                conn.execute("INSERT INTO counter_batches(batch, applied_at) VALUES (?,?)", (batch, now))
+            conn.executemany(AD_UPSERT, [(ad_id, *v, now) for ad_id, v in ads.items()])
+            conn.executemany(USER_UPSERT, [(uid, ad_id, *v, now) for (uid, ad_id), v in users.items()])
+
+    def _rotate_journal(self):
+        """Move the live journal aside as the file backing the batch being flushed."""
+        if self._journal is None:
+            return None, None
+        self._batch_seq += 1
+        batch = f"{os.getpid()}-{int(time.time() * 1000)}-{self._batch_seq}"
+        self._journal.close()
+        batch_file = f"{self.journal_path}.{batch}"
+        os.replace(self.journal_path, batch_file)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        return batch, batch_file
+
+    def _replay_journals(self):
+        folder = os.path.dirname(os.path.abspath(self.journal_path))
+        base = os.path.basename(self.journal_path)
+        leftovers = sorted(fn for fn in os.listdir(folder) if fn.startswith(base + "."))
+        if os.path.exists(self.journal_path):
+            self._batch_seq += 1
+            batch = f"{os.getpid()}-{int(time.time() * 1000)}-{self._batch_seq}"
+            os.replace(self.journal_path, f"{self.journal_path}.{batch}")
+            leftovers.append(f"{base}.{batch}")
+        db.execute(self.db_path, "CREATE TABLE IF NOT EXISTS counter_batches (batch TEXT PRIMARY KEY, applied_at INTEGER)")
+        applied = {r[0] for r in db.query(self.db_path, "SELECT batch FROM counter_batches")}
+        for fn in leftovers:
+            path = os.path.join(folder, fn)
+            batch = fn[len(base) + 1:]
+            if batch not in applied:
+                ads, users = {}, {}
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        parts = line.rstrip("\n").split("\t")
+                        try:
+                            ad_id, user_id, *delta = parts
+                            delta = [int(x) for x in delta]
+                        except ValueError:
+                            continue  # torn write at crash time
+                        if len(delta) != 3:
+                            continue
+                        _merge(ads, ad_id, delta)
+                        if user_id:
+                            _merge(users, (user_id, ad_id), delta)
+                if ads or users:
+                    self._write(ads, users, batch)
+            os.remove(path)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass  # retried on the next tick
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+        atexit.unregister(self.close)
@@ -0,0 +1,202 @@
+"""
+Shared SQLite connection layer.
+
+Each thread is bound to at most one connection per database file. The
+connection is configured once (WAL journal, ``synchronous=NORMAL``,
+``busy_timeout``, mmap) and keeps sqlite3's prepared-statement cache warm,
+so the same SQL text is only compiled once per connection. Request threads
+hand their connections back with ``release_thread()`` (wired to Flask's
+teardown in app.py); the next thread picks them up from the idle pool instead
+of opening a new file handle.
+
+Callers must not ``close()`` connections obtained here.
+
+Every connection counts the statements it runs, the rows it hands back and
+(through SQLite's progress handler) the VM instructions it executes, which is
+the closest proxy for rows scanned that sqlite3 exposes. The counters are per
+connection, so the hot path takes no lock; ``stats()`` sums them per file.
+"""
+import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+
+BUSY_TIMEOUT_MS = 5000
+MMAP_SIZE = 256 * 1024 * 1024
+STATEMENT_CACHE = 256
+MAX_IDLE_PER_DB = 16
+PROGRESS_STEPS = 1000  # VM instructions per progress-handler callback
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+_idle = {}  # path -> [connection, ...]
+_live = weakref.WeakSet()
+_retired = {}  # path -> [queries, rows, vm steps] of closed connections
+
+
+class _Cursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        self.connection.queries += 1
+        return super().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        self.connection.queries += 1
+        return super().executemany(sql, seq)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.connection.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = super().fetchmany(*args)
+        self.connection.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.connection.rows += len(rows)
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self.connection.rows += 1
+        return row
+
+
+class _Connection(sqlite3.Connection):
+    """sqlite3 connection that keeps its own statement/row/VM-step counters."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = str(args[0] if args else kwargs["database"])
+        self.queries = self.rows = self.steps = 0
+        self.set_progress_handler(self._progress, PROGRESS_STEPS)
+
+    def _progress(self):
+        self.steps += PROGRESS_STEPS
+        return 0
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    # Connection.execute() would bypass cursor(), so route it through _Cursor
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def close(self):
+        with _pool_lock:
+            totals = _retired.setdefault(self.path, [0, 0, 0])
+            totals[0] += self.queries; totals[1] += self.rows; totals[2] += self.steps
+            self.queries = self.rows = self.steps = 0
+        super().close()
+
+
+def _configure(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+
+
+def connect(path):
+    """Return this thread's connection to ``path``, creating or reusing one."""
+    path = str(path)
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is not None:
+        return conn
+    with _pool_lock:
+        idle = _idle.get(path)
+        conn = idle.pop() if idle else None
+    if conn is None:
+        # check_same_thread=False: a pooled connection moves between threads,
+        # but is only ever bound to one thread at a time.
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, factory=_Connection,
+                               cached_statements=STATEMENT_CACHE, check_same_thread=False)
+        _configure(conn)
+        with _pool_lock:
+            _live.add(conn)
+    conns[path] = conn
+    return conn
+
+
+def release_thread():
+    """Return the calling thread's connections to the idle pool."""
+    conns = getattr(_local, "conns", None)
+    if not conns:
+        return
+    _local.conns = {}
+    for path, conn in conns.items():
+        if conn.in_transaction:
+            conn.rollback()
+        with _pool_lock:
+            idle = _idle.setdefault(path, [])
+            if len(idle) < MAX_IDLE_PER_DB:
+                idle.append(conn)
+                continue
+        conn.close()
+
+
+def close_all():
+    """Close every idle connection and the calling thread's own (tests, shutdown)."""
+    release_thread()
+    with _pool_lock:
+        conns = [c for idle in _idle.values() for c in idle]
+        _idle.clear()
+    for conn in conns:
+        conn.close()
+
+
+def stats():
+    """``{db file name: (queries, rows returned, VM steps)}`` since process start."""
+    with _pool_lock:
+        totals = {p: list(t) for p, t in _retired.items()}
+        conns = list(_live)
+    for conn in conns:
+        t = totals.setdefault(conn.path, [0, 0, 0])
+        t[0] += conn.queries; t[1] += conn.rows; t[2] += conn.steps
+    out = {}
+    for path, t in totals.items():
+        name = os.path.basename(path)
+        prev = out.get(name, (0, 0, 0))
+        out[name] = tuple(a + b for a, b in zip(prev, t))
+    return out
+
+
+# --- statement helpers (same SQL text -> cached prepared statement) ---
+def query(path, sql, params=()):
+    return connect(path).execute(sql, params).fetchall()
+
+
+def query_one(path, sql, params=()):
+    return connect(path).execute(sql, params).fetchone()
+
+
+def execute(path, sql, params=()):
+    """Run one write statement in its own transaction; returns the cursor."""
+    conn = connect(path)
+    with conn:
+        return conn.execute(sql, params)
+
+
+def executemany(path, sql, seq):
+    conn = connect(path)
+    with conn:
+        return conn.executemany(sql, seq)
+
+
+@contextmanager
+def transaction(path):
+    """``with transaction(path) as conn:`` commits on success, rolls back on error."""
+    conn = connect(path)
+    with conn:
+        yield conn
@@ -0,0 +1,182 @@
+"""
+Append-only per-user engagement log.
+
+Every impression / click / dislike is one line appended to
+``users/<user>/events.log`` (O(1), no read-modify-write). A background
+compactor periodically folds the log into the ``users/<user>/ads.csv``
+summary, which keeps its original columns
+(ad_id, impressions, clicks, dislikes, last_updated).
+
+``totals(user)`` returns the current per-ad counts. The first call for a
+user reads the summary plus the un-compacted log once; after that the totals
+are kept up to date in memory by ``append`` (LRU-bounded by ``max_users``).
+"""
+import csv
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+FIELDS = ("impressions", "clicks", "dislikes")
+SUMMARY_HEADER = ["ad_id", "impressions", "clicks", "dislikes", "last_updated"]
+LOG_NAME = "events.log"
+COMPACTING_NAME = "events.log.compacting"
+SUMMARY_NAME = "ads.csv"
+
+
+class UserEventLog:
+    def __init__(self, users_root, compact_interval=30.0, compact_min_events=500, max_users=1024):
+        self.users_root = users_root
+        self.compact_interval = compact_interval
+        self.compact_min_events = compact_min_events
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._user_locks = {}
+        self._totals = OrderedDict()  # user -> {ad_id: [impressions, clicks, dislikes, last_updated]}
+        self._uncompacted = {}        # user -> events appended since the last compaction
+        self._stop = threading.Event()
+        self._thread = None
+        if compact_interval:
+            self._thread = threading.Thread(target=self._run, name="event-log-compactor", daemon=True)
+            self._thread.start()
+
+    def _folder(self, user_id):
+        return os.path.join(self.users_root, str(user_id))
+
+    def _user_lock(self, user_id):
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.Lock())
+
+    # --- writes ---
+    def append(self, user_id, ad_id, field, count=1):
+        """Record ``count`` events of ``field`` (impressions/clicks/dislikes).
+        Users without a folder are ignored, as before."""
+        if field not in FIELDS:
+            raise ValueError(f"unknown event field: {field}")
+        folder = self._folder(user_id)
+        if not os.path.isdir(folder):
+            return False
+        ts = datetime.utcnow().isoformat()
+        ad_id = str(ad_id)
+        with self._user_lock(user_id):
+            with open(os.path.join(folder, LOG_NAME), "a", encoding="utf-8") as f:
+                f.write(f"{ts}\t{ad_id}\t{field}\t{count}\n")
+            with self._lock:
+                totals = self._totals.get(user_id)
+                self._uncompacted[user_id] = self._uncompacted.get(user_id, 0) + 1
+            if totals is not None:
+                _fold(totals, ad_id, field, count, ts)
+        return True
+
+    # --- reads ---
+    def totals(self, user_id):
+        """``{ad_id: {'ad_id', 'impressions', 'clicks', 'dislikes', 'last_updated'}}``."""
+        with self._lock:
+            totals = self._totals.get(user_id)
+            if totals is not None:
+                self._totals.move_to_end(user_id)
+        if totals is None:
+            # Loaded under the user lock so no append can slip in between the
+            # read of the files and the cache insert.
+            with self._user_lock(user_id):
+                with self._lock:
+                    totals = self._totals.get(user_id)
+                if totals is None:
+                    totals, pending = self._load(user_id)
+                    with self._lock:
+                        self._totals[user_id] = totals
+                        self._uncompacted[user_id] = max(self._uncompacted.get(user_id, 0), pending)
+                        while len(self._totals) > self.max_users:
+                            self._totals.popitem(last=False)
+        return {ad_id: dict(zip(SUMMARY_HEADER, (ad_id, *v))) for ad_id, v in list(totals.items())}
+
+    def _load(self, user_id):
+        folder = self._folder(user_id)
+        totals = _read_summary(os.path.join(folder, SUMMARY_NAME))
+        pending = 0
+        for name in (COMPACTING_NAME, LOG_NAME):
+            for ts, ad_id, field, count in _read_log(os.path.join(folder, name)):
+                _fold(totals, ad_id, field, count, ts)
+                pending += 1
+        return totals, pending
+
+    # --- compaction ---
+    def compact(self, user_id):
+        """Fold the user's log into ads.csv. The log is swapped for a fresh one
+        first, so appends only wait for the two renames, not for the rewrite."""
+        folder = self._folder(user_id)
+        log_path = os.path.join(folder, LOG_NAME)
+        compacting = os.path.join(folder, COMPACTING_NAME)
+        summary = os.path.join(folder, SUMMARY_NAME)
+        with self._compact_lock:
+            with self._user_lock(user_id):
+                if not os.path.exists(compacting):
+                    if not os.path.exists(log_path):
+                        return False
+                    os.replace(log_path, compacting)
+                with self._lock:
+                    self._uncompacted[user_id] = 0
+            rows = _read_summary(summary)
+            for ts, ad_id, field, count in _read_log(compacting):
+                _fold(rows, ad_id, field, count, ts)
+            tmp = summary + ".tmp"
+            with open(tmp, "w", newline="", encoding="utf-8") as f:
+                w = csv.writer(f)
+                w.writerow(SUMMARY_HEADER)
+                for ad_id, v in rows.items():
+                    w.writerow([ad_id, *v])
+            with self._user_lock(user_id):
+                # A crash between these two steps replays the segment once more on load
+                os.replace(tmp, summary)
+                os.remove(compacting)
+        return True
+
+    def compact_due(self):
+        with self._lock:
+            due = [u for u, n in self._uncompacted.items() if n >= self.compact_min_events]
+        for user_id in due:
+            self.compact(user_id)
+        return due
+
+    def _run(self):
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact_due()
+            except OSError:
+                pass  # retried on the next tick
+
+    def close(self):
+        self._stop.set()
+
+
+def _fold(totals, ad_id, field, count, ts):
+    v = totals.get(ad_id)
+    if v is None:
+        v = totals[ad_id] = [0, 0, 0, ""]
+    v[FIELDS.index(field)] += count
+    v[3] = ts
+
+
+def _read_summary(path):
+    rows = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for r in csv.DictReader(f):
+                rows[r["ad_id"]] = [int(r.get("impressions") or 0), int(r.get("clicks") or 0),
+                                    int(r.get("dislikes") or 0), r.get("last_updated") or ""]
+    return rows
+
+
+def _read_log(path):
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != 4 or parts[2] not in FIELDS:
+                continue  # torn last line after a crash
+            try:
+                yield parts[0], parts[1], parts[2], int(parts[3])
+            except ValueError:
+                continue
@@ -0,0 +1,172 @@
+"""
+Content-addressed uploads and resized WebP derivatives.
+
+Uploads are stored once per content hash under ``static/media/`` (uploading
+the same bytes twice, by anyone, reuses the first file). A background worker
+renders fixed-size WebP derivatives for every local image the catalog serves:
+
+    static/derived/<hash>-card-320.webp   card thumbnail, 2:1 crop
+    static/derived/<hash>-card-640.webp   same, for 2x screens
+    static/derived/<hash>-modal-1024.webp fits 1024x768, not cropped
+
+Derivatives are named by the source's content hash, so identical images share
+them and they can be cached forever. ``urls(image_url)`` returns the
+``srcset``-ready URLs once they exist and queues the work otherwise; until then
+callers keep serving the original.
+
+Pillow is optional: without it uploads are still deduplicated, but no
+derivatives are produced.
+"""
+import hashlib
+import os
+import queue
+import threading
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+# name, width, height, crop to exactly width x height (else fit inside)
+VARIANTS = (
+    ("card", 320, 160, True),
+    ("card", 640, 320, True),
+    ("modal", 1024, 768, False),
+)
+WEBP_QUALITY = 80
+HASH_CHARS = 24
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_CHARS]
+
+
+class ImagePipeline:
+    def __init__(self, static_root, static_url="/static", media_dir="media", derived_dir="derived"):
+        self.static_root = Path(static_root)
+        self.static_url = static_url.rstrip("/")
+        self.media_dir = media_dir
+        self.derived_dir = derived_dir
+        self._lock = threading.Lock()
+        self._hashes = {}     # image_url -> content hash, or None if it can't be processed
+        self._ready = set()   # hashes whose derivatives all exist
+        self._queued = set()  # image_urls waiting for the worker
+        self._queue = queue.Queue()
+        self._worker = None
+        self.rendered = 0
+        self.version = 0      # bumped whenever more derivatives become available
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    # --- uploads ---
+    def store_upload(self, data, ext):
+        """Store ``data`` content-addressed (once) and return its web path."""
+        h = content_hash(data)
+        rel = f"{self.media_dir}/{h[:2]}/{h}{ext.lower()}"
+        path = self.static_root / rel
+        if not path.exists():
+            os.makedirs(path.parent, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        url = f"{self.static_url}/{rel}"
+        with self._lock:
+            self._hashes[url] = h
+        self._enqueue(url)
+        return url
+
+    # --- derivatives ---
+    def _derived_rel(self, h, name, width):
+        return f"{self.derived_dir}/{h}-{name}-{width}.webp"
+
+    def urls(self, image_url):
+        """``{"image_card", "image_srcset", "image_modal"}`` for ``image_url``, or ``{}``
+        while its derivatives aren't ready (the work is queued on first ask)."""
+        with self._lock:
+            known = image_url in self._hashes
+            h = self._hashes.get(image_url)
+            ready = h is not None and h in self._ready
+        if not ready:
+            if not known:
+                self._enqueue(image_url)
+            return {}
+        base = f"{self.static_url}/"
+        cards = [(w, base + self._derived_rel(h, name, w)) for name, w, _, _ in VARIANTS if name == "card"]
+        modal = next(base + self._derived_rel(h, name, w) for name, w, _, _ in VARIANTS if name == "modal")
+        return {
+            "image_card": cards[0][1],
+            "image_srcset": ", ".join(f"{url} {w}w" for w, url in cards),
+            "image_modal": modal,
+        }
+
+    def _local_path(self, image_url):
+        if not image_url or not image_url.startswith(self.static_url + "/"):
+            return None  # external or empty
+        path = (self.static_root / image_url[len(self.static_url) + 1:]).resolve()
+        if self.static_root.resolve() not in path.parents:
+            return None
+        return path
+
+    def _enqueue(self, image_url):
+        if not self.enabled:
+            return
+        with self._lock:
+            if image_url in self._queued:
+                return
+            self._queued.add(image_url)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="image-derivatives", daemon=True)
+                self._worker.start()
+        self._queue.put(image_url)
+
+    def _run(self):
+        while True:
+            image_url = self._queue.get()
+            try:
+                h = self.process(image_url)
+            except (OSError, ValueError, Image.DecompressionBombError):
+                h = None
+            with self._lock:
+                self._hashes[image_url] = h
+                if h is not None and h not in self._ready:
+                    self._ready.add(h)
+                    self.version += 1
+                self._queued.discard(image_url)
+            self._queue.task_done()
+
+    def process(self, image_url):
+        """Render any missing derivatives of ``image_url``; returns its content hash."""
+        path = self._local_path(image_url)
+        if path is None or not path.is_file():
+            return None
+        data = path.read_bytes()
+        h = content_hash(data)
+        missing = [(name, w, hgt, crop) for name, w, hgt, crop in VARIANTS
+                   if not (self.static_root / self._derived_rel(h, name, w)).exists()]
+        if not missing:
+            return h
+        with Image.open(path) as src:
+            src.seek(0)  # first frame of animations
+            img = ImageOps.exif_transpose(src)
+            img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+        for name, w, hgt, crop in missing:
+            if crop:
+                out = ImageOps.fit(img, (w, hgt), Image.LANCZOS)
+            else:
+                out = img.copy()
+                out.thumbnail((w, hgt), Image.LANCZOS)
+            dest = self.static_root / self._derived_rel(h, name, w)
+            os.makedirs(dest.parent, exist_ok=True)
+            tmp = dest.with_name(f"{dest.name}.tmp")
+            out.save(tmp, "WEBP", quality=WEBP_QUALITY, method=4)
+            os.replace(tmp, dest)
+            self.rendered += 1
+        return h
+
+    def wait(self):
+        """Block until everything queued so far is processed (tests, benchmarks)."""
+        self._queue.join()
@@ -0,0 +1,118 @@
+"""
+Batched engagement ingestion for ``POST /events``.
+
+The frontend sends arrays of typed events::
+
+    [{"type": "impression", "ad_id": 3}, {"type": "like", "ad_id": 5}, ...]
+
+``validate_events`` checks a whole array at once and returns the accepted
+``(type, ad_id)`` pairs plus per-index errors. Accepted events go onto an
+``EventQueue``; its worker thread drains everything queued so far (across
+requests and users) and hands it to ``apply_batch`` in one call, which applies
+it in a single transaction. Requests return as soon as the events are queued.
+"""
+import atexit
+import threading
+import time
+from collections import deque
+
+EVENT_TYPES = ("impression", "click", "like", "dislike")
+LOGIN_REQUIRED = frozenset({"like", "dislike"})
+MAX_EVENTS = 500  # per request
+
+
+def validate_events(payload, known_ad, logged_in):
+    """``(events, errors)``: valid ``(type, ad_id)`` pairs in order, and
+    ``{"index": i, "error": msg}`` for every rejected entry."""
+    events, errors = [], []
+    for i, ev in enumerate(payload):
+        if not isinstance(ev, dict):
+            errors.append({"index": i, "error": "event must be an object"})
+            continue
+        kind = ev.get("type")
+        if kind not in EVENT_TYPES:
+            errors.append({"index": i, "error": f"unknown type {kind!r}"})
+            continue
+        ad_id = ev.get("ad_id")
+        if isinstance(ad_id, str) and ad_id.isdigit():
+            ad_id = int(ad_id)
+        if not isinstance(ad_id, int) or isinstance(ad_id, bool):
+            errors.append({"index": i, "error": "ad_id must be an integer"})
+            continue
+        if not known_ad(ad_id):
+            errors.append({"index": i, "error": f"unknown ad {ad_id}"})
+            continue
+        if kind in LOGIN_REQUIRED and not logged_in:
+            errors.append({"index": i, "error": f"{kind} requires login"})
+            continue
+        events.append((kind, ad_id))
+    return events, errors
+
+
+class EventQueue:
+    """Background queue of ``(username, type, ad_id, ts)``; ``apply_batch(list)`` is
+    called from the worker thread with everything queued since the last call."""
+
+    def __init__(self, apply_batch, max_batch=5000, flush_interval=0.25):
+        self.apply_batch = apply_batch
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._apply_lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._pending = deque()
+        self._closed = False
+        self.applied = 0
+        self.failed_batches = 0
+        self._worker = threading.Thread(target=self._run, name="event-queue", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, username, events):
+        ts = time.time()
+        with self._lock:
+            self._pending.extend((username, kind, ad_id, ts) for kind, ad_id in events)
+            if len(self._pending) >= self.max_batch:
+                self._wake.notify()
+
+    def flush(self):
+        """Apply everything queued so far (blocking)."""
+        while True:
+            with self._apply_lock:
+                with self._lock:
+                    n = min(len(self._pending), self.max_batch)
+                    batch = [self._pending.popleft() for _ in range(n)]
+                if not batch:
+                    return
+                try:
+                    self.apply_batch(batch)
+                except Exception:
+                    with self._lock:  # keep the batch, in order, for the next attempt
+                        self._pending.extendleft(reversed(batch))
+                    self.failed_batches += 1
+                    raise
+                self.applied += len(batch)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._closed:
+                    self._wake.wait(self.flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception:
+                time.sleep(1.0)  # retried on the next loop
+            if closed:
+                return
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self._worker.join(timeout=5.0)
+        self.flush()
+        atexit.unregister(self.close)
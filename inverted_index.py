@@ -0,0 +1,139 @@
+"""
+Inverted index for candidate generation.
+
+Maps normalized tokens from an ad's ``keywords``, ``category`` and
+``target_page`` to posting lists of ad keys, so a request only scores ads that
+share at least one token with it, plus a small global "top CTR" fallback set.
+Ads are added, replaced and removed one at a time as the catalog changes.
+
+``containing`` narrows substring rules (e.g. "the ad's keywords contain
+'run'") to the keys whose tokens could satisfy them, so callers that score
+substrings can generate candidates by the same rule they score with.
+"""
+import heapq
+import re
+import threading
+
+import numpy as np
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(*texts):
+    """Lower-cased alphanumeric tokens of all ``texts``."""
+    tokens = set()
+    for text in texts:
+        if text:
+            tokens.update(_TOKEN.findall(str(text).lower()))
+    return tokens
+
+
+class InvertedIndex:
+    def __init__(self, fallback_size=50):
+        self.fallback_size = fallback_size
+        self._lock = threading.Lock()
+        self._postings = {}   # token -> set of keys
+        self._arrays = {}     # token -> posting as an int64 array, built on first lookup
+        self._tokens = {}     # key -> frozenset of its tokens
+        self._ctr = {}        # key -> ctr, for the fallback set
+        self._top = None      # cached fallback keys, rebuilt lazily after changes
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def build(self, keys, keywords, categories, target_pages, ctr):
+        with self._lock:
+            self._postings, self._arrays, self._tokens, self._ctr, self._top = {}, {}, {}, {}, None
+            for key, kw, cat, page, c in zip(keys, keywords, categories, target_pages, ctr):
+                self._add(key, kw, cat, page, c)
+
+    def add(self, key, keywords, category, target_page, ctr=0.0):
+        """Index ``key`` (replacing its previous entry, if any)."""
+        with self._lock:
+            self._remove(key)
+            self._add(key, keywords, category, target_page, ctr)
+            self._top = None
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+            self._top = None
+
+    def _add(self, key, keywords, category, target_page, ctr):
+        tokens = frozenset(tokenize(keywords, category, target_page))
+        self._tokens[key] = tokens
+        self._ctr[key] = float(ctr or 0.0)
+        for tok in tokens:
+            self._postings.setdefault(tok, set()).add(key)
+            self._arrays.pop(tok, None)
+
+    def _remove(self, key):
+        tokens = self._tokens.pop(key, None)
+        self._ctr.pop(key, None)
+        for tok in tokens or ():
+            self._arrays.pop(tok, None)
+            posting = self._postings.get(tok)
+            if posting is not None:
+                posting.discard(key)
+                if not posting:
+                    del self._postings[tok]
+
+    def top_ctr(self):
+        """The ``fallback_size`` keys with the highest CTR."""
+        top = self._top
+        if top is None:
+            with self._lock:
+                top = self._top = frozenset(heapq.nlargest(self.fallback_size, self._ctr, key=self._ctr.__getitem__))
+        return top
+
+    def matching(self, tokens):
+        """Keys sharing at least one of ``tokens``."""
+        out = set()
+        with self._lock:
+            for tok in tokens:
+                posting = self._postings.get(tok)
+                if posting:
+                    out.update(posting)
+        return out
+
+    def matching_array(self, tokens):
+        """``matching`` as a sorted int64 array (keys must be non-negative integers)."""
+        parts = []
+        with self._lock:
+            for tok in tokens:
+                arr = self._arrays.get(tok)
+                if arr is None:
+                    posting = self._postings.get(tok)
+                    if not posting:
+                        continue
+                    arr = self._arrays[tok] = np.sort(np.fromiter(posting, dtype=np.int64, count=len(posting)))
+                parts.append(arr)
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        top = max(int(arr[-1]) for arr in parts)
+        if top > 4 * sum(len(arr) for arr in parts):  # sparse keys: a mask would be mostly empty
+            return np.unique(np.concatenate(parts))
+        # scattering into a mask is much cheaper than sorting the concatenated postings
+        seen = np.zeros(top + 1, dtype=bool)
+        for arr in parts:
+            seen[arr] = True
+        return np.flatnonzero(seen)
+
+    def containing(self, text):
+        """Sorted int64 array of the keys whose indexed text may contain ``text``
+        as a substring: every token of ``text`` occurs inside one of the key's
+        tokens. This is a superset, so callers still check the exact match.
+        ``None`` when ``text`` has no tokens and only a full scan can tell."""
+        out = None
+        for tok in tokenize(text):
+            with self._lock:
+                vocab = [v for v in self._postings if tok in v]
+            keys = self.matching_array(vocab)
+            out = keys if out is None else np.intersect1d(out, keys, assume_unique=True)
+        return out
+
+    def candidates(self, tokens, fallback=True):
+        out = self.matching(tokens)
+        if fallback:
+            out.update(self.top_ctr())
+        return out
@@ -0,0 +1,122 @@
+"""
+In-process metrics with a Prometheus text exposition.
+
+Timings are recorded with ``span(stage)`` into a fixed-bucket histogram
+(``ads_stage_seconds{stage=...}``); request latency per endpoint goes to
+``ads_request_seconds``. Values owned by other modules (DB statement counts,
+cache hit/miss counters, queue sizes) are pulled when ``/metrics`` is scraped
+through collectors registered with ``register_collector``, so the hot paths
+never touch this module's locks for them.
+"""
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _fmt_labels(labels):
+    if not labels:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+    return "{" + body + "}"
+
+
+def _fmt_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Histogram:
+    """Cumulative-bucket histogram family, one series per label set."""
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            s[idx] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for key, s in sorted(series.items()):
+            running = 0
+            for bound, n in zip(self.buckets + (float("inf"),), s):
+                running += n
+                lines.append(f"{self.name}_bucket{_fmt_labels(key + (('le', _fmt_value(bound)),))} {running}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {s[-2]!r}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {s[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("ads_stage_seconds", "Time spent in one stage of a request.")
+REQUEST_SECONDS = Histogram("ads_request_seconds", "Request latency per endpoint.")
+
+_collectors_lock = threading.Lock()
+_collectors = []  # (name, type, help, fn returning {labels tuple: value})
+
+
+class span:
+    """``with span("get_ads.score"):`` records the block's wall time."""
+
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STAGE_SECONDS.observe(time.perf_counter() - self.t0, stage=self.stage)
+        return False
+
+
+def register_collector(name, type, help, fn):
+    """Expose ``fn()`` (``{((label, value), ...): number}``) as metric ``name``."""
+    with _collectors_lock:
+        _collectors.append((name, type, help, fn))
+
+
+def register_cache(cache, fn):
+    """Expose hit/miss counters and the hit ratio of a cache; ``fn() -> (hits, misses)``."""
+    labels = (("cache", cache),)
+    register_collector("ads_cache_hits_total", "counter", "Cache hits.", lambda: {labels: fn()[0]})
+    register_collector("ads_cache_misses_total", "counter", "Cache misses.", lambda: {labels: fn()[1]})
+
+    def ratio():
+        hits, misses = fn()
+        return {labels: hits / (hits + misses) if hits + misses else 0.0}
+    register_collector("ads_cache_hit_ratio", "gauge", "Hits / (hits + misses) since start.", ratio)
+
+
+def render():
+    """The full exposition in Prometheus text format (version 0.0.4)."""
+    lines = STAGE_SECONDS.render() + REQUEST_SECONDS.render()
+    families = {}
+    with _collectors_lock:
+        collectors = list(_collectors)
+    for name, type, help, fn in collectors:
+        family = families.setdefault(name, (type, help, {}))
+        family[2].update(fn())
+    for name, (type, help, values) in families.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for key, v in sorted(values.items()):
+            lines.append(f"{name}{_fmt_labels(key)} {_fmt_value(v)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,129 @@
+"""
+Versioned schema migrations, tracked in ``PRAGMA user_version``.
+
+A database's ``user_version`` is the number of migrations already applied to
+it. ``migrate(conn, steps)`` runs only the steps past that number, each in its
+own transaction together with the ``user_version`` bump, so every step runs
+exactly once per database and a failed step leaves nothing half-applied.
+Startup on an up-to-date database is a single ``PRAGMA`` read.
+
+Steps are append-only: never edit or reorder a released step, add a new one.
+They must also tolerate databases created before versioning existed
+(``user_version`` 0 but some columns already present), hence the
+``add_column`` helper.
+"""
+import os
+from csv import DictReader
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+def columns(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def add_column(conn, table, name, decl):
+    if name not in columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, steps):
+    """Apply the pending ``steps`` (callables taking ``conn``); returns the names applied."""
+    current = version(conn)
+    if current > len(steps):
+        raise MigrationError(f"database is at version {current}, newer than this code ({len(steps)})")
+    applied = []
+    for n, step in enumerate(steps[current:], start=current + 1):
+        try:
+            if conn.in_transaction:
+                conn.commit()
+            with conn:
+                conn.execute("BEGIN")  # sqlite3 doesn't open one implicitly for DDL
+                step(conn)
+                conn.execute(f"PRAGMA user_version={n}")
+        except Exception as e:
+            raise MigrationError(f"migration {n} ({step.__name__}) failed: {e}") from e
+        applied.append(step.__name__)
+    return applied
+
+
+# --- ads.db ---
+def create_ads(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS ads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT,
+        category TEXT,
+        keywords TEXT,
+        target_page TEXT,
+        image_url TEXT,
+        ctr REAL DEFAULT 0,
+        clicks INTEGER DEFAULT 0,
+        impressions INTEGER DEFAULT 0,
+        details TEXT
+    )""")
+
+
+def add_link_column(conn):
+    add_column(conn, "ads", "link", "TEXT")
+
+
+def add_publish_columns(conn):
+    add_column(conn, "ads", "owner", "TEXT")
+    add_column(conn, "ads", "is_active", "INTEGER DEFAULT 1")
+    add_column(conn, "ads", "start_date", "TEXT")
+    add_column(conn, "ads", "end_date", "TEXT")
+    add_column(conn, "ads", "created_at", "TEXT")
+
+
+def add_ads_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ads_owner ON ads(owner)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ads_category ON ads(category)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ads_active_end ON ads(is_active, end_date)")
+    # normalized title key: look ups must use exactly ``lower(trim(title))``
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ads_title_key ON ads(lower(trim(title)))")
+
+
+def backfill_links(csv_path):
+    """Step filling empty ``ads.link`` from the CSV catalog, matched on the title key."""
+    def backfill_links_from_csv(conn):
+        if not os.path.exists(csv_path):
+            return
+        by_title = {}
+        with open(csv_path, "r", encoding="utf-8") as f:
+            for row in DictReader(f):
+                t = (row.get("title") or "").strip().lower()
+                if t:
+                    by_title[t] = (row.get("link") or "").strip()
+        conn.executemany("""UPDATE ads SET link=?
+                            WHERE lower(trim(title))=? AND (link IS NULL OR trim(link)='')""",
+                         [(link, t) for t, link in by_title.items() if link])
+    return backfill_links_from_csv
+
+
+def ads_steps(csv_path):
+    return [
+        create_ads,
+        add_link_column,
+        add_publish_columns,
+        add_ads_indexes,
+        backfill_links(csv_path),
+    ]
+
+
+# --- users.db ---
+def create_users(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE,
+        password TEXT,
+        role TEXT DEFAULT 'user'
+    )""")
+
+
+USERS_STEPS = [create_users]
@@ -1,20 +1,128 @@
-import pandas as pd, sqlite3, os, time, csv
+import numpy as np, os, time, csv, json, hashlib
+import db
+from metrics import span
+from contextlib import contextmanager
 from datetime import datetime
+from content_index import ContentIndex, ad_document
+from counters import CounterBuffer
+from event_log import UserEventLog
+from inverted_index import InvertedIndex
+
+CONTENT_WEIGHT = 2.0
+FULL_SCAN_MAX = 200  # catalogs up to this size skip candidate generation
+RECS_MAX_AGE = 15 * 60  # seconds a precomputed list (see batch_recs.py) may be served
+
+# one precomputed recommendation, best first, packed into user_recs.recs
+REC_DTYPE = np.dtype([('row', '<i4'), ('score', '<f4'), ('ctr', '<f4'), ('dislikes', '<i4'), ('user_dislikes', '<i4')])
+
+
+def read_preferences_likes(users_root, user_id):
+    path = os.path.join(users_root, str(user_id), 'preferences.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('likes', [])
+    except (OSError, ValueError):
+        return []
+
+
+def expand_candidates(rows, ctr, content_index, query, k):
+    """``rows`` plus the top ``k`` rows by CTR and by content similarity, ascending."""
+    k = min(k, len(ctr))
+    rows.update(np.argpartition(-ctr, k - 1)[:k].tolist())
+    rows.update(key for key, _ in content_index.top_k(query, k))
+    return np.array(sorted(rows), dtype=np.int64)
+
+
+def contains(values, key):
+    """Match rule shared by scoring and candidate generation: non-empty
+    ``values`` that contain ``key`` as a substring."""
+    return (values != '') & (np.char.find(values, key) >= 0)
+
+
+def final_scores(n, cand, score, ctr, dislikes, user_dislikes):
+    """Full-length score array: ``score`` plus the CTR term minus dislike penalties at ``cand``."""
+    penalty = dislikes[cand] * 0.5 + user_dislikes[cand] * 2.0
+    final_score = np.zeros(n, dtype=np.float64)
+    final_score[cand] = score + (ctr[cand] / 10.0) - penalty
+    return final_score
+
+
+def select_winners(final_score, cand, user_dislikes, k):
+    """Top ``k`` of ``cand`` by score, ties broken by catalog order (same as a stable
+    sort); ads the user disliked twice or more are never shown."""
+    candidates = cand[user_dislikes[cand] < 2]
+    k = min(k, len(candidates))
+    if k <= 0:
+        return candidates[:0]
+    cand_scores = final_score[candidates]
+    if k < len(candidates):
+        kth = cand_scores[np.argpartition(-cand_scores, k - 1)[:k]].min()
+        keep = cand_scores >= kth
+        candidates, cand_scores = candidates[keep], cand_scores[keep]
+    return candidates[np.lexsort((candidates, -cand_scores))][:k]
+
+
+def read_catalog(path):
+    """The ad CSV as ``{column: [values]}``. Cells are strings ('' when missing),
+    except ``ad_id``, which becomes ints when every value is one (as pandas would)."""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        rows = list(reader)
+    cols = {name: [(r[j] if j < len(r) else '') for r in rows] for j, name in enumerate(header)}
+    if 'ad_id' not in cols:
+        cols['ad_id'] = ['ad_' + str(i) for i in range(len(rows))]
+    else:
+        try:
+            cols['ad_id'] = [int(v) for v in cols['ad_id']]
+        except ValueError:
+            pass
+    cols.setdefault('details', [''] * len(rows))
+    return cols
+
 
 class AdRecommender:
-    def __init__(self, ad_data_path, db_path, users_root):
+    def __init__(self, ad_data_path, db_path, users_root, flush_interval=2.0, journal_path=None,
+                 recs_max_age=RECS_MAX_AGE):
         self.db_path = db_path
         self.ad_data_path = ad_data_path
         self.users_root = users_root
-        self.ads = pd.read_csv(ad_data_path).fillna('')
-        if 'ad_id' not in self.ads.columns:
-            self.ads['ad_id'] = ['ad_' + str(i) for i in range(len(self.ads))]
-        if 'details' not in self.ads.columns:
-            self.ads['details'] = ''
-        self.initialize_database()
+        self.recs_max_age = recs_max_age
+        self.precomputed_served = 0
+        self.startup_timings = {}  # phase -> seconds, for the last construction
+        self._ads_frame = None
+        with self._startup_phase('read_catalog'):
+            self.columns = read_catalog(ad_data_path)
+        with self._startup_phase('build_columns'):
+            self._build_columns()
+        with self._startup_phase('initialize_database'):
+            self.initialize_database()
+        # impressions/clicks/dislikes are buffered and upserted in batches
+        with self._startup_phase('counters'):
+            self.counters = CounterBuffer(db_path, flush_interval=flush_interval, journal_path=journal_path)
+        # per-user history: append-only users/<user>/events.log, compacted into ads.csv
+        self.events = UserEventLog(users_root)
+
+    @contextmanager
+    def _startup_phase(self, name):
+        t0 = time.perf_counter()
+        with span('startup.' + name):
+            yield
+        self.startup_timings[name] = time.perf_counter() - t0
+
+    def __len__(self):
+        return len(self._ad_ids)
+
+    @property
+    def ads(self):
+        """The catalog as a pandas DataFrame, built (and pandas imported) on first use."""
+        if self._ads_frame is None:
+            import pandas as pd
+            self._ads_frame = pd.DataFrame(self.columns)
+        return self._ads_frame
 
     def initialize_database(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = db.connect(self.db_path)
         c = conn.cursor()
         c.execute('''CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -40,23 +148,36 @@ class AdRecommender:
             last_updated INTEGER,
             UNIQUE(user_id, ad_id)
         )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS catalog_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )''')
+        # written by batch_recs.py: REC_DTYPE records over catalog rows, best first
+        c.execute('''CREATE TABLE IF NOT EXISTS user_recs (
+            user_id TEXT PRIMARY KEY,
+            catalog TEXT,
+            computed_at REAL,
+            depth INTEGER,
+            recs BLOB
+        )''')
         conn.commit()
-        for ad in self.ads['ad_id'].tolist():
-            c.execute('INSERT OR IGNORE INTO ad_metrics(ad_id, impressions, clicks, dislikes, last_updated) VALUES (?,?,?,?,?)', (ad,0,0,0,int(time.time())))
-        conn.commit()
-        conn.close()
+        # ad_metrics only needs seeding when the set of ad ids has changed
+        fingerprint = hashlib.sha1('\n'.join(map(str, self._ad_ids)).encode()).hexdigest()
+        self.catalog_fingerprint = fingerprint
+        seeded = c.execute("SELECT value FROM catalog_state WHERE key='seeded_ids'").fetchone()
+        if seeded and seeded[0] == fingerprint:
+            return
+        now = int(time.time())
+        with conn:
+            c.executemany('INSERT OR IGNORE INTO ad_metrics(ad_id, impressions, clicks, dislikes, last_updated) VALUES (?,?,?,?,?)',
+                          ((ad, 0, 0, 0, now) for ad in self._ad_ids))
+            c.execute("INSERT OR REPLACE INTO catalog_state(key, value) VALUES ('seeded_ids', ?)", (fingerprint,))
 
     def _exec(self, query, params=(), commit=False):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute(query, params)
         if commit:
-            conn.commit()
-            conn.close()
+            db.execute(self.db_path, query, params)
             return None
-        rows = c.fetchall()
-        conn.close()
-        return rows
+        return db.query(self.db_path, query, params)
 
     # --- user management ---
     def register_user(self, username, password):
@@ -88,147 +209,213 @@ class AdRecommender:
         return bool(rows)
 
     # --- recommendation and metrics ---
+    def _build_columns(self):
+        """Cache the columns used by ``recommend`` as arrays aligned to ad index."""
+        ads = self.columns
+        n = len(ads['ad_id'])
+        def text(name):
+            if name not in ads:
+                return np.full(n, '', dtype=str)
+            return np.array([str(v or '') for v in ads[name]], dtype=str)
+        self._pages = text('target_page')
+        self._cats = text('category')
+        self._keywords_lc = np.char.lower(text('keywords'))
+        self._ad_ids = ads['ad_id']
+        self._rows_by_id = {}  # keyed by str(ad_id), like the TEXT ad_id column in ad_metrics
+        for i, ad_id in enumerate(self._ad_ids):
+            self._rows_by_id.setdefault(str(ad_id), []).append(i)
+        self._out_cols = {name: ads.get(name)
+                          for name in ('title', 'description', 'image_url', 'target_page', 'category', 'details')}
+        # TF-IDF rows keyed by ad index, so similarities() lines up with the arrays above
+        self.content_index = ContentIndex()
+        title, category, details = (self._out_cols[k] or [''] * n for k in ('title', 'category', 'details'))
+        keywords = ads.get('keywords') or [''] * n
+        docs = [ad_document(title[i], keywords[i], category[i], details[i]) for i in range(n)]
+        self.content_index.fit(range(n), docs)
+        # token -> rows, for candidate generation on large catalogs
+        self.token_index = InvertedIndex()
+        self.token_index.build(range(n), keywords, category, self._pages.tolist(), [0.0] * n)
+
+    def _liked_rows(self, user_id):
+        likes = read_preferences_likes(self.users_root, user_id)
+        return [i for ad_id in likes for i in self._rows_by_id.get(str(ad_id), ())]
+
+    def _metric_arrays(self, rows, pending):
+        """Scatter (ad_id, impressions, clicks, dislikes) rows plus the not yet
+        flushed deltas into arrays aligned to ad index."""
+        n = len(self._ad_ids)
+        out = np.zeros((3, n), dtype=np.int64)
+        for ad_id, impressions, clicks, dislikes in rows:
+            for i in self._rows_by_id.get(str(ad_id), ()):
+                out[:, i] = (impressions or 0, clicks or 0, dislikes or 0)
+        for ad_id, delta in pending.items():
+            for i in self._rows_by_id.get(ad_id, ()):
+                out[:, i] += delta
+        return out
+
+    def _match_rules(self, current_page, interests):
+        """``(weight, column, key)`` for every page/category/interest rule: rows
+        whose ``column`` contains ``key`` score ``weight``."""
+        rules = []
+        if current_page:
+            rules.append((2.0, self._pages, current_page.split('?')[0]))
+            rules.append((1.0, self._cats, current_page.split('/')[0]))
+        if interests:
+            for tok in str(interests).split(','):
+                tok = tok.strip().lower()
+                if tok:
+                    rules.append((0.5, self._keywords_lc, tok))
+        return rules
+
+    def _candidate_rows(self, rules, ctr, query):
+        """Rows matched by any of ``rules``, plus the top rows by live CTR and by
+        content similarity. Small catalogs are scanned in full."""
+        n = len(self._ad_ids)
+        if n <= FULL_SCAN_MAX:
+            return np.arange(n)
+        rows = set()
+        for _, column, key in rules:
+            pre = self.token_index.containing(key)
+            if pre is None:
+                pre = np.arange(n)
+            rows.update(pre[contains(column[pre], key)].tolist())
+        return expand_candidates(rows, ctr, self.content_index, query, self.token_index.fallback_size)
+
+    def global_metrics(self):
+        """``(ctr percent, dislikes)`` per ad index, including unflushed counters."""
+        impressions, clicks, dislikes = self._metric_arrays(
+            self._exec('SELECT ad_id, impressions, clicks, dislikes FROM ad_metrics'),
+            self.counters.pending_ads())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ctr = np.where(impressions > 0, clicks / np.maximum(impressions, 1) * 100, 0.0)
+        return ctr, dislikes
+
+    def _precomputed(self, user_id, max_results):
+        """The batch-computed list for a context-free request, or ``None`` when it is
+        missing or stale (other catalog, too old, preferences or dislikes since)."""
+        row = self._exec('SELECT catalog, computed_at, depth, recs FROM user_recs WHERE user_id=?', (str(user_id),))
+        if not row:
+            return None
+        catalog, computed_at, depth, blob = row[0]
+        if (catalog != self.catalog_fingerprint or depth < max_results
+                or time.time() - computed_at > self.recs_max_age
+                or self._disliked_since(user_id, computed_at)):
+            return None
+        try:
+            if os.stat(os.path.join(self.users_root, str(user_id), 'preferences.json')).st_mtime > computed_at:
+                return None
+        except OSError:
+            pass
+        return np.frombuffer(blob, dtype=REC_DTYPE)[:max_results]
+
+    def _disliked_since(self, user_id, since):
+        """Whether ``user_id`` disliked an ad after ``since``: a ``user_metrics`` row
+        written since then by any process, or a dislike this process has not
+        flushed yet. ``last_updated`` has whole seconds, so ties count as newer."""
+        if any(d for _, _, d in self.counters.pending_user(user_id).values()):
+            return True
+        return bool(self._exec('SELECT 1 FROM user_metrics WHERE user_id=? AND dislikes > 0 AND last_updated >= ? LIMIT 1',
+                               (str(user_id), int(since))))
+
     def recommend(self, user_id, current_page, interests, max_results=5):
-        ads = self.ads.copy()
-        def score_row(row):
-            s = 0.0
-            page = str(row.get('target_page','') or '')
-            cat = str(row.get('category','') or '')
-            if current_page and page and current_page.split('?')[0] in page:
-                s += 2.0
-            if current_page and cat and current_page.split('/')[0] in cat:
-                s += 1.0
-            if interests:
-                for tok in str(interests).split(','):
-                    if tok.strip() and tok.strip().lower() in str(row.get('keywords','') or '').lower():
-                        s += 0.5
-            return s
-        ads['score'] = ads.apply(score_row, axis=1)
-        rows = self._exec('SELECT ad_id, impressions, clicks, dislikes FROM ad_metrics')
-        metrics = {r[0]: {'impressions': r[1], 'clicks': r[2], 'dislikes': r[3]} for r in rows}
-        user_rows = self._exec('SELECT ad_id, impressions, clicks, dislikes FROM user_metrics WHERE user_id=?', (user_id,))
-        user_metrics = {r[0]: {'impressions': r[1], 'clicks': r[2], 'dislikes': r[3]} for r in user_rows} if user_rows else {}
-        final = []
-        for _, row in ads.iterrows():
-            ad = row.to_dict()
-            ad_id = ad.get('ad_id')
-            m = metrics.get(ad_id, {'impressions':0,'clicks':0,'dislikes':0})
-            um = user_metrics.get(ad_id, {'impressions':0,'clicks':0,'dislikes':0})
-            ctr = (m['clicks'] / m['impressions'] * 100) if m['impressions'] > 0 else 0.0
-            penalty = m.get('dislikes',0)*0.5 + um.get('dislikes',0)*2.0
-            final_score = ad.get('score',0) + (ctr/10.0) - penalty
-            
-            if um.get('dislikes',0) >= 2:
-                continue
-            ad_out = {
-                'ad_id': ad_id,
-                'title': ad.get('title',''),
-                'description': ad.get('description',''),
-                'image_url': ad.get('image_url',''),
-                'target_page': ad.get('target_page',''),
-                'category': ad.get('category',''),
-                'details': ad.get('details',''),
-                'score': final_score,
-                'ctr': round(ctr,2),
-                'global_dislikes': m.get('dislikes',0),
-                'user_dislikes': um.get('dislikes',0)
-            }
-            final.append(ad_out)
-        final_sorted = sorted(final, key=lambda x: x['score'], reverse=True)
-        results = final_sorted[:max_results]
-
-        for ad in results:
-            aid = ad['ad_id']
-            self._exec('UPDATE ad_metrics SET impressions = impressions + 1, last_updated = ? WHERE ad_id = ?', (int(time.time()), aid), commit=True)
-            self._exec('INSERT OR IGNORE INTO user_metrics(user_id, ad_id, impressions, clicks, dislikes, last_updated) VALUES (?,?,?,?,?,?)', (user_id, aid, 0,0,0,int(time.time())), commit=True)
-            self._exec('UPDATE user_metrics SET impressions = impressions + 1, last_updated = ? WHERE user_id=? AND ad_id=?', (int(time.time()), user_id, aid), commit=True)
-            user_folder = os.path.join(self.users_root, user_id)
-            if os.path.exists(user_folder):
-                csv_path = os.path.join(user_folder, 'ads.csv')
-                rows = {}
-                if os.path.exists(csv_path):
-                    with open(csv_path, 'r', encoding='utf-8') as f:
-                        reader = csv.DictReader(f)
-                        for r in reader:
-                            rows[r['ad_id']] = r
-                r = rows.get(aid, {'ad_id':aid,'impressions':'0','clicks':'0','dislikes':'0','last_updated':''})
-                r['impressions'] = str(int(r.get('impressions',0)) + 1)
-                r['last_updated'] = datetime.utcnow().isoformat()
-                rows[aid] = r
-                with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-                    w = csv.writer(f)
-                    w.writerow(['ad_id','impressions','clicks','dislikes','last_updated'])
-                    for v in rows.values():
-                        w.writerow([v['ad_id'], v['impressions'], v['clicks'], v['dislikes'], v['last_updated']])
+        if not current_page and not interests:
+            with span('recommend.precomputed'):
+                recs = self._precomputed(user_id, max_results)
+            if recs is not None:
+                self.precomputed_served += 1
+                results = [self._result(int(r['row']), float(r['score']), float(r['ctr']), int(r['dislikes']),
+                                        int(r['user_dislikes'])) for r in recs]
+                self._record_impressions(user_id, results)
+                return results
+
+        with span('recommend.metrics'):
+            ctr, dislikes = self.global_metrics()
+            user_dislikes = self._metric_arrays(
+                self._exec('SELECT ad_id, impressions, clicks, dislikes FROM user_metrics WHERE user_id=?', (str(user_id),)),
+                self.counters.pending_user(user_id))[2]
+
+        with span('recommend.candidates'):
+            # Content-based similarity to the interests, or to the ads the user liked
+            query = self.content_index.query_from_text(str(interests)) if interests else None
+            if query is None:
+                query = self.content_index.query_from_ads(self._liked_rows(user_id))
+
+            # Only candidate rows (ascending, so ties still fall back to catalog order) are scored
+            rules = self._match_rules(current_page, interests)
+            cand = self._candidate_rows(rules, ctr, query)
+        with span('recommend.score'):
+            score = np.zeros(len(cand), dtype=np.float64)
+            for weight, column, key in rules:
+                score += weight * contains(column[cand], key)
+            if query is not None:
+                score += CONTENT_WEIGHT * self.content_index.similarities(query, cand)
+
+            final_score = final_scores(len(self._ad_ids), cand, score, ctr, dislikes, user_dislikes)
+            winners = select_winners(final_score, cand, user_dislikes, max_results)
+
+        results = [self._result(i, float(final_score[i]), float(ctr[i]), int(dislikes[i]), int(user_dislikes[i]))
+                   for i in winners.tolist()]
+        self._record_impressions(user_id, results)
         return results
 
+    def _result(self, i, score, ctr, dislikes, user_dislikes):
+        cols = self._out_cols
+        return {
+            'ad_id': self._ad_ids[i],
+            'title': cols['title'][i] if cols['title'] is not None else '',
+            'description': cols['description'][i] if cols['description'] is not None else '',
+            'image_url': cols['image_url'][i] if cols['image_url'] is not None else '',
+            'target_page': cols['target_page'][i] if cols['target_page'] is not None else '',
+            'category': cols['category'][i] if cols['category'] is not None else '',
+            'details': cols['details'][i] if cols['details'] is not None else '',
+            'score': score,
+            'ctr': round(ctr, 2),
+            'global_dislikes': dislikes,
+            'user_dislikes': user_dislikes
+        }
+
+    def _record_impressions(self, user_id, results):
+        with span('recommend.record'):
+            for ad in results:
+                aid = ad['ad_id']
+                self.counters.add(aid, user_id, impressions=1)
+                self.events.append(user_id, aid, 'impressions')
+
     def record_click(self, ad_id, user_id=None):
-        self._exec('UPDATE ad_metrics SET clicks = clicks + 1, last_updated = ? WHERE ad_id = ?', (int(time.time()), ad_id), commit=True)
-        self._exec('INSERT OR IGNORE INTO user_metrics(user_id, ad_id, impressions, clicks, dislikes, last_updated) VALUES (?,?,?,?,?,?)', (user_id, ad_id, 0,0,0,int(time.time())), commit=True)
-        self._exec('UPDATE user_metrics SET clicks = clicks + 1, last_updated = ? WHERE user_id=? AND ad_id=?', (int(time.time()), user_id, ad_id), commit=True)
-        user_folder = os.path.join(self.users_root, user_id)
-        if os.path.exists(user_folder):
-            csv_path = os.path.join(user_folder, 'ads.csv')
-            rows = {}
-            if os.path.exists(csv_path):
-                with open(csv_path, 'r', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
-                    for r in reader:
-                        rows[r['ad_id']] = r
-            r = rows.get(ad_id, {'ad_id':ad_id,'impressions':'0','clicks':'0','dislikes':'0','last_updated':''})
-            r['clicks'] = str(int(r.get('clicks',0)) + 1)
-            r['last_updated'] = datetime.utcnow().isoformat()
-            rows[ad_id] = r
-            with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-                w = csv.writer(f)
-                w.writerow(['ad_id','impressions','clicks','dislikes','last_updated'])
-                for v in rows.values():
-                    w.writerow([v['ad_id'], v['impressions'], v['clicks'], v['dislikes'], v['last_updated']])
+        self.counters.add(ad_id, user_id, clicks=1)
+        if user_id is not None:
+            self.events.append(user_id, ad_id, 'clicks')
 
     def record_dislike(self, ad_id, user_id=None):
-        self._exec('UPDATE ad_metrics SET dislikes = dislikes + 1, last_updated = ? WHERE ad_id = ?', (int(time.time()), ad_id), commit=True)
-        self._exec('INSERT OR IGNORE INTO user_metrics(user_id, ad_id, impressions, clicks, dislikes, last_updated) VALUES (?,?,?,?,?,?)', (user_id, ad_id, 0,0,0,int(time.time())), commit=True)
-        self._exec('UPDATE user_metrics SET dislikes = dislikes + 1, last_updated = ? WHERE user_id=? AND ad_id=?', (int(time.time()), user_id, ad_id), commit=True)
-        
-        user_folder = os.path.join(self.users_root, user_id)
-        if os.path.exists(user_folder):
-            csv_path = os.path.join(user_folder, 'ads.csv')
-            rows = {}
-            if os.path.exists(csv_path):
-                with open(csv_path, 'r', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
-                    for r in reader:
-                        rows[r['ad_id']] = r
-            r = rows.get(ad_id, {'ad_id':ad_id,'impressions':'0','clicks':'0','dislikes':'0','last_updated':''})
-            r['dislikes'] = str(int(r.get('dislikes',0)) + 1)
-            r['last_updated'] = datetime.utcnow().isoformat()
-            rows[ad_id] = r
-            with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-                w = csv.writer(f)
-                w.writerow(['ad_id','impressions','clicks','dislikes','last_updated'])
-                for v in rows.values():
-                    w.writerow([v['ad_id'], v['impressions'], v['clicks'], v['dislikes'], v['last_updated']])
+        self.counters.add(ad_id, user_id, dislikes=1)
+        if user_id is not None:
+            self.events.append(user_id, ad_id, 'dislikes')
+
+    def get_user_ad_history(self, user_id):
+        """Per-ad impression/click/dislike totals for one user (summary + recent log)."""
+        return self.events.totals(user_id)
 
     def get_ads_with_metrics(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT ad_id, impressions, clicks, dislikes FROM ad_metrics')
-        rows = c.fetchall()
-        conn.close()
-        metrics = {r[0]: {'impressions': r[1], 'clicks': r[2], 'dislikes': r[3]} for r in rows}
+        rows = self._exec('SELECT ad_id, impressions, clicks, dislikes FROM ad_metrics')
+        metrics = {str(r[0]): {'impressions': r[1], 'clicks': r[2], 'dislikes': r[3]} for r in rows}
+        for ad_id, (imp, clk, dis) in self.counters.pending_ads().items():
+            m = metrics.setdefault(ad_id, {'impressions':0,'clicks':0,'dislikes':0})
+            m['impressions'] += imp; m['clicks'] += clk; m['dislikes'] += dis
         out = []
-        for _, row in self.ads.iterrows():
-            ad = row.to_dict()
-            m = metrics.get(ad['ad_id'], {'impressions':0,'clicks':0,'dislikes':0})
+        cols = self._out_cols
+        def col(name, i):
+            return cols[name][i] if cols[name] is not None else ''
+        for i, ad_id in enumerate(self._ad_ids):
+            m = metrics.get(str(ad_id), {'impressions':0,'clicks':0,'dislikes':0})
             ctr = (m['clicks'] / m['impressions'] * 100) if m['impressions'] > 0 else 0.0
             ad_out = {
-                'ad_id': ad.get('ad_id'),
-                'title': ad.get('title',''),
-                'description': ad.get('description',''),
-                'image_url': ad.get('image_url',''),
-                'target_page': ad.get('target_page',''),
-                'category': ad.get('category',''),
-                'details': ad.get('details',''),
+                'ad_id': ad_id,
+                'title': col('title', i),
+                'description': col('description', i),
+                'image_url': col('image_url', i),
+                'target_page': col('target_page', i),
+                'category': col('category', i),
+                'details': col('details', i),
                 'impressions': m['impressions'],
                 'clicks': m['clicks'],
                 'dislikes': m['dislikes'],
@@ -237,24 +424,27 @@ class AdRecommender:
             out.append(ad_out)
         return out
 
-    def get_admin_metrics(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT ad_id, impressions, clicks, dislikes, last_updated FROM ad_metrics')
+    def get_admin_metrics(self, after_ad=None, after_user=None, limit=100):
+        """One keyset page of per-ad metrics and of per-user summaries, plus totals.
+        Everything is aggregated in SQL; pass ``next_ad`` / ``next_user`` back as
+        ``after_ad`` / ``after_user`` for the following page."""
+        self.counters.flush()
+        c = db.connect(self.db_path).cursor()
+        c.execute('SELECT ad_id, impressions, clicks, dislikes, last_updated FROM ad_metrics '
+                  'WHERE ad_id > ? ORDER BY ad_id LIMIT ?', (after_ad or '', limit))
         ads = [{'ad_id': r[0], 'impressions': r[1], 'clicks': r[2], 'dislikes': r[3], 'last_updated': r[4]} for r in c.fetchall()]
-        c.execute('SELECT user_id, ad_id, impressions, clicks, dislikes, last_updated FROM user_metrics')
-        users = [{'user_id': r[0], 'ad_id': r[1], 'impressions': r[2], 'clicks': r[3], 'dislikes': r[4], 'last_updated': r[5]} for r in c.fetchall()]
-        
-        c.execute('SELECT username, password FROM users')
-        urows = [{'username': r[0], 'password': r[1]} for r in c.fetchall()]
-        conn.close()
-        
-        folders = []
-        try:
-            for fn in os.listdir(self.users_root):
-                path = os.path.join(self.users_root, fn)
-                if os.path.isdir(path):
-                    folders.append(fn)
-        except Exception:
-            folders = []
-        return {'ads': ads, 'users_metrics': users, 'users_db': urows, 'user_folders': folders}
+        c.execute('''SELECT user_id, COUNT(*), SUM(impressions), SUM(clicks), SUM(dislikes), MAX(last_updated)
+                     FROM user_metrics WHERE user_id > ? GROUP BY user_id ORDER BY user_id LIMIT ?''',
+                  (after_user or '', limit))
+        users = [{'user_id': r[0], 'ads_seen': r[1], 'impressions': r[2], 'clicks': r[3], 'dislikes': r[4],
+                  'last_updated': r[5], 'has_folder': os.path.isdir(os.path.join(self.users_root, str(r[0])))}
+                 for r in c.fetchall()]
+        c.execute('SELECT COUNT(*), SUM(impressions), SUM(clicks), SUM(dislikes) FROM ad_metrics')
+        n_ads, impressions, clicks, dislikes = c.fetchone()
+        c.execute('SELECT COUNT(*) FROM users')
+        n_users = c.fetchone()[0]
+        totals = {'ads': n_ads, 'users': n_users, 'impressions': impressions or 0, 'clicks': clicks or 0,
+                  'dislikes': dislikes or 0}
+        return {'ads': ads, 'users_metrics': users, 'totals': totals,
+                'next_ad': ads[-1]['ad_id'] if len(ads) == limit else None,
+                'next_user': users[-1]['user_id'] if len(users) == limit else None}
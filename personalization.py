@@ -0,0 +1,416 @@
+"""
+Per-user personalization terms for ``/get_ads``.
+
+Every ad is a sparse row over an append-only vocabulary of category and
+keyword features (``AdFeatures``), and every user keeps a float32 affinity
+vector over the same features (``AffinityVectors``). Likes and dislikes
+update a user's vector in place of re-deriving it from the preference lists,
+so the personalization term of all ads is a single sparse matrix-vector
+product per request.
+
+``RankedListCache`` keeps each user's finished top list, so repeat calls
+within a session skip ranking entirely.
+
+``session_jitter`` is the per-login ranking nudge: a keyed 64-bit integer
+hash (SplitMix64's finalizer) of each ad id, evaluated for a whole id array
+in a few NumPy ops.
+"""
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from scipy import sparse
+
+from inverted_index import tokenize
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix64(x):
+    """SplitMix64 finalizer over a uint64 array (wrapping arithmetic)."""
+    x = x ^ (x >> np.uint64(30))
+    x = x * _MIX1
+    x = x ^ (x >> np.uint64(27))
+    x = x * _MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+def session_jitter(seed, ad_ids, amplitude=3.0):
+    """Uniform-looking values in ``[-amplitude, amplitude)`` for ``ad_ids``: the
+    same for a given ``(seed, ad_id)`` and unrelated across seeds."""
+    key = _mix64(np.array([seed & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64))
+    x = _mix64(np.asarray(ad_ids, dtype=np.int64).astype(np.uint64) * _GOLDEN ^ key)
+    unit = (x >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))  # [0, 1)
+    return amplitude * (2.0 * unit - 1.0)
+
+
+def _feature_names(category, keywords):
+    """``(names, values)`` of one ad: ``c:<category>`` at 1.0 (uncategorized ads
+    have none) and ``k:<token>`` per keyword token at ``1 / #tokens``, so the
+    keyword part of a score is the mean over the ad's keywords."""
+    names, values = [], []
+    if category:
+        names.append("c:" + category)
+        values.append(1.0)
+    tokens = sorted(tokenize(keywords))
+    for token in tokens:
+        names.append("k:" + token)
+        values.append(1.0 / len(tokens))
+    return names, values
+
+
+FeatureMatrix = namedtuple("FeatureMatrix", "version snapshot_version ids categories keywords matrix")
+
+
+class AdFeatures:
+    """
+    Append-only feature vocabulary (``c:<category>``, ``k:<token>``) and the
+    sparse ``ads x features`` matrix of a catalog snapshot.
+
+    Feature indices never change once assigned, so user vectors built against
+    an older vocabulary stay valid and only need zero-padding. ``matrix(snap)``
+    is rebuilt only when the snapshot's ids, categories or keywords differ
+    from the last one (not for click/CTR swaps); ``version`` changes with it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vocab = {}                                   # name -> index
+        self._names = []
+        self._category = np.zeros(0, dtype=bool)            # index -> is a category feature
+        self._ads = {}                                      # ad id -> (category, keywords, hash, idx, values)
+        self._view = None
+        self.version = 0
+
+    def __len__(self):
+        return len(self._names)
+
+    def name(self, i):
+        return self._names[i]
+
+    def is_category(self, idx):
+        return self._category[idx]
+
+    def _index(self, name):
+        i = self._vocab.get(name)
+        if i is None:
+            i = len(self._names)
+            self._vocab[name] = i
+            self._names.append(name)
+            if i == len(self._category):
+                self._category = np.concatenate([self._category, np.zeros(max(64, i), dtype=bool)])
+            self._category[i] = name.startswith("c:")
+        return i
+
+    def indices(self, names):
+        with self._lock:
+            return np.array([self._index(n) for n in names], dtype=np.int64)
+
+    def _ad(self, ad_id, category, keywords):
+        entry = self._ads.get(ad_id)
+        if entry is None or entry[0] != category or entry[1] != keywords:
+            names, values = _feature_names(category, keywords)
+            ad_hash = zlib.crc32(f"{category}\x1f{keywords}".encode())
+            entry = (category, keywords, ad_hash,
+                     np.array([self._index(n) for n in names], dtype=np.int64), np.array(values, dtype=np.float32))
+            self._ads[ad_id] = entry
+        return entry
+
+    def of(self, snap, ad_id):
+        """``(hash, feature indices, values)`` of ``ad_id`` in ``snap``, or ``None``."""
+        i = snap.index.get(ad_id)
+        if i is None:
+            return None
+        with self._lock:
+            return self._ad(ad_id, snap.categories[i], snap.keywords[i])[2:]
+
+    def matrix(self, snap):
+        view = self._view
+        if view is not None and view.snapshot_version == snap.version:
+            return view
+        with self._lock:
+            view = self._view
+            if (view is not None and view.categories == snap.categories and view.keywords == snap.keywords
+                    and np.array_equal(view.ids, snap.ids)):
+                view = view._replace(snapshot_version=snap.version)  # e.g. only counters changed
+            else:
+                ads = [self._ad(ad_id, c, k) for ad_id, c, k in zip(snap.ids.tolist(), snap.categories, snap.keywords)]
+                self._ads = dict(zip(snap.ids.tolist(), ads))   # forget removed ads
+                indptr = np.zeros(len(ads) + 1, dtype=np.int64)
+                indptr[1:] = np.cumsum([len(a[3]) for a in ads])
+                matrix = sparse.csr_matrix(
+                    (np.concatenate([a[4] for a in ads]) if ads else np.zeros(0, dtype=np.float32),
+                     np.concatenate([a[3] for a in ads]) if ads else np.zeros(0, dtype=np.int64), indptr),
+                    shape=(len(ads), len(self._names)))
+                self.version += 1
+                view = FeatureMatrix(self.version, snap.version, snap.ids, snap.categories, snap.keywords, matrix)
+            self._view = view
+            return view
+
+
+class UserVector:
+    """One user's affinity state: per-feature counts of liked / disliked ads and
+    the float32 ``weights`` derived from them. Never mutated once published."""
+
+    __slots__ = ("prefs_version", "features_version", "signature", "liked", "disliked", "weights", "_tokens")
+
+    def __init__(self, prefs_version, features_version, signature, liked, disliked, weights):
+        self.prefs_version = prefs_version
+        self.features_version = features_version
+        self.signature = signature
+        self.liked = liked
+        self.disliked = disliked
+        self.weights = weights
+        self._tokens = None
+
+
+def _signature_term(kind, ad_id, ad_hash):
+    digest = hashlib.blake2b(f"{kind}:{ad_id}:{ad_hash}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class AffinityVectors:
+    """
+    Per-user float32 affinity vectors over ``AdFeatures``.
+
+    ``liked[f]`` / ``disliked[f]`` count the user's liked / disliked ads that
+    have feature ``f``. A category weighs ``+category_like`` when any liked ad
+    has it and ``-category_dislike`` when any disliked ad has it (both may
+    apply); keyword tokens likewise with the keyword weights. The
+    personalization term of every ad is then ``matrix @ weights``.
+
+    ``apply`` updates a user in O(features of the changed ads) and writes the
+    counts through ``UserStore`` (``affinity.json`` next to
+    ``preferences.json``). A vector carries a signature, the XOR of one hash
+    per (liked/disliked ad, that ad's category + keywords), which also
+    updates in O(1) per change. When the preferences or the feature matrix
+    moved under a cached or persisted vector, the signature is recomputed in
+    O(likes + dislikes), and only a mismatch (e.g. a liked ad was edited or
+    deleted) rebuilds the vector from the preferences.
+    """
+
+    def __init__(self, features, store, category_like, category_dislike, keyword_like, keyword_dislike,
+                 max_users=1024):
+        self.features = features
+        self.store = store
+        self.like_weights = (keyword_like, category_like)       # indexed by is_category
+        self.dislike_weights = (keyword_dislike, category_dislike)
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # username -> UserVector
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+
+    # --- lookups ---
+    def get(self, username, prefs, snap):
+        """The user's vector, valid for ``prefs`` and ``snap``."""
+        view = self.features.matrix(snap)
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                self._entries.move_to_end(username)
+                if entry.prefs_version == prefs.version and entry.features_version == view.version:
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+            return self._validate(username, entry, prefs, snap, view)
+
+    def scores(self, entry, snap):
+        """Personalization term of every row of ``snap`` (float64)."""
+        matrix = self.features.matrix(snap).matrix
+        weights = entry.weights
+        if len(weights) < matrix.shape[1]:
+            weights = np.concatenate([weights, np.zeros(matrix.shape[1] - len(weights), dtype=np.float32)])
+        return (matrix @ weights[:matrix.shape[1]]).astype(np.float64)
+
+    def tokens(self, entry):
+        """Keyword/category tokens of the user's liked ads (candidate generation)."""
+        if entry._tokens is None:
+            tokens = set()
+            for i in np.flatnonzero(entry.liked).tolist():
+                name = self.features.name(i)
+                tokens |= tokenize(name[2:]) if name.startswith("c:") else {name[2:]}
+            entry._tokens = frozenset(tokens)
+        return entry._tokens
+
+    # --- updates ---
+    def apply(self, username, before, after, ad_ids, snap):
+        """Move the user's vector from ``before`` to ``after`` preferences, which
+        differ only in ``ad_ids``, and persist it."""
+        view = self.features.matrix(snap)
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry.prefs_version != before.version or entry.features_version != view.version:
+                entry = self._validate(username, entry, before, snap, view)
+            changed = [(ad_id, self.features.of(snap, ad_id)) for ad_id in set(ad_ids)]
+            d = len(self.features)
+            liked, disliked = _padded(entry.liked, d), _padded(entry.disliked, d)
+            signature = entry.signature
+            touched = []
+            for ad_id, f in changed:
+                ad_hash = f[0] if f is not None else 0
+                for kind, counts, was, now in (("like", liked, before.likes, after.likes),
+                                               ("dislike", disliked, before.dislikes, after.dislikes)):
+                    delta = int(ad_id in now) - int(ad_id in was)
+                    if delta:
+                        signature ^= _signature_term(kind, ad_id, ad_hash)
+                        if f is not None:
+                            counts[f[1]] += delta
+                            touched.append(f[1])
+            weights = _padded(entry.weights, d)
+            if touched:
+                idx = np.unique(np.concatenate(touched))
+                weights[idx] = self._weights(idx, liked, disliked)
+            entry = UserVector(after.version, view.version, signature, liked, disliked, weights)
+            self._publish(username, entry)
+        self._persist(username, entry)
+        return entry
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    # --- internals (called with the lock held) ---
+    def _validate(self, username, entry, prefs, snap, view):
+        signature = self._signature(prefs, snap)
+        if entry is None:
+            entry = self._load(prefs, snap, view, signature, self.store.affinity(username))
+        if entry is None or entry.signature != signature:
+            entry = self._rebuild(prefs, snap, view, signature)
+            self._persist(username, entry)
+        else:
+            entry = UserVector(prefs.version, view.version, signature, entry.liked, entry.disliked, entry.weights)
+        self._publish(username, entry)
+        return entry
+
+    def _signature(self, prefs, snap):
+        signature = 0
+        for kind, ad_ids in (("like", prefs.likes), ("dislike", prefs.dislikes)):
+            for ad_id in ad_ids:
+                f = self.features.of(snap, ad_id)
+                signature ^= _signature_term(kind, ad_id, f[0] if f is not None else 0)
+        return signature
+
+    def _rebuild(self, prefs, snap, view, signature):
+        self.rebuilds += 1
+        found = [[self.features.of(snap, ad_id) for ad_id in ad_ids] for ad_ids in (prefs.likes, prefs.dislikes)]
+        d = len(self.features)
+        liked, disliked = np.zeros(d, dtype=np.float32), np.zeros(d, dtype=np.float32)
+        for counts, fs in zip((liked, disliked), found):
+            for f in fs:
+                if f is not None:
+                    counts[f[1]] += 1
+        return self._vector(prefs, view, signature, liked, disliked)
+
+    def _load(self, prefs, snap, view, signature, data):
+        if not data or data.get("signature") != format(signature, "x"):
+            return None
+        try:
+            counts = [(self.features.indices(list(data[k])), np.array(list(data[k].values()), dtype=np.float32))
+                      for k in ("likes", "dislikes")]
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+        d = len(self.features)
+        liked, disliked = np.zeros(d, dtype=np.float32), np.zeros(d, dtype=np.float32)
+        np.add.at(liked, counts[0][0], counts[0][1])
+        np.add.at(disliked, counts[1][0], counts[1][1])
+        return self._vector(prefs, view, signature, liked, disliked)
+
+    def _vector(self, prefs, view, signature, liked, disliked):
+        weights = np.zeros(len(liked), dtype=np.float32)
+        idx = np.flatnonzero((liked > 0) | (disliked > 0))
+        weights[idx] = self._weights(idx, liked, disliked)
+        return UserVector(prefs.version, view.version, signature, liked, disliked, weights)
+
+    def _weights(self, idx, liked, disliked):
+        is_category = self.features.is_category(idx)
+        like = np.where(is_category, self.like_weights[1], self.like_weights[0])
+        dislike = np.where(is_category, self.dislike_weights[1], self.dislike_weights[0])
+        return (like * (liked[idx] > 0) - dislike * (disliked[idx] > 0)).astype(np.float32)
+
+    def _publish(self, username, entry):
+        self._entries[username] = entry
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def _persist(self, username, entry):
+        payload = {"signature": format(entry.signature, "x")}
+        for key, counts in (("likes", entry.liked), ("dislikes", entry.disliked)):
+            idx = np.flatnonzero(counts).tolist()
+            payload[key] = {self.features.name(i): int(counts[i]) for i in idx}
+        self.store.save_affinity(username, payload)
+
+
+def _padded(arr, n):
+    """Copy of ``arr`` zero-padded to length ``n``."""
+    out = np.zeros(max(n, len(arr)), dtype=np.float32)
+    out[:len(arr)] = arr
+    return out
+
+
+class RankedListCache:
+    """
+    Bounded LRU of ranked lists (``((score, row), ...)``) keyed by
+    ``(username, ad_seed) + versions``; ``get_ads`` passes the catalog's
+    ranking version, the serving view version and the prefs version.
+    Entries expire ``ttl`` seconds after they were stored. ``invalidate(username)``
+    drops every entry of one user (all of their sessions) and nobody else's.
+    """
+
+    def __init__(self, max_entries=4096, ttl=300.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires at, ranked)
+        self._by_user = {}             # username -> set of keys
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username, ad_seed, versions):
+        key = (username, ad_seed) + tuple(versions)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, username, ad_seed, versions, ranked):
+        key = (username, ad_seed) + tuple(versions)
+        with self._lock:
+            # versions only move forward: older lists of this session are dead
+            for old in [k for k in self._by_user.get(username, ()) if k[1] == ad_seed and k != key]:
+                self._drop(old)
+            self._entries[key] = (self.clock() + self.ttl, tuple(ranked))
+            self._entries.move_to_end(key)
+            self._by_user.setdefault(username, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, username):
+        with self._lock:
+            for key in self._by_user.pop(username, ()):
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
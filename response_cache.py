@@ -0,0 +1,50 @@
+"""
+Small LRU of serialized responses, keyed by everything the response depends on.
+
+``/get_ads`` derives its key (and ETag) from the catalog version, the user's
+preferences version, the session's ``ad_seed`` and the image pipeline version.
+A repeat request with an unchanged key is answered with the cached bytes
+(or a 304 when the client already has them) without ranking anything.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# ETags must not repeat across restarts, when the version counters start over
+_BOOT = os.urandom(8).hex()
+
+
+def make_etag(*parts):
+    return hashlib.sha1(":".join(map(str, (_BOOT,) + parts)).encode()).hexdigest()[:20]
+
+
+def content_etag(body):
+    """ETag of a body itself: stable across restarts and catalog versions."""
+    return hashlib.sha1(body).hexdigest()[:20]
+
+
+class ResponseCache:
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key (usually the ETag) -> serialized body
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
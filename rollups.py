@@ -0,0 +1,140 @@
+"""
+Time-bucketed engagement rollups per ad.
+
+Events are counted into minute buckets of ``ad_rollups``. A maintenance pass
+folds minute buckets older than ``MINUTE_KEEP`` into hour buckets, hour
+buckets older than ``HOUR_KEEP`` into day buckets, and drops day buckets
+older than ``DAY_KEEP``. Every period is stored at exactly one granularity, so
+a windowed total is a plain ``SUM`` over the (at most a few hundred) buckets
+inside the window, whatever the event volume was.
+
+Windows are aligned to bucket starts: a bucket counts if it starts inside the
+window, so windows reaching into the hour/day tiers are rounded to those
+boundaries.
+"""
+import atexit
+import sqlite3
+import threading
+import time
+
+import db
+
+MINUTE, HOUR, DAY = 60, 3600, 86400
+MINUTE_KEEP = 2 * HOUR
+HOUR_KEEP = 3 * DAY
+DAY_KEEP = 90 * DAY
+
+SCHEMA = ("""
+CREATE TABLE IF NOT EXISTS ad_rollups (
+    ad_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,       -- bucket start, unix seconds
+    granularity INTEGER NOT NULL,  -- bucket length in seconds
+    impressions INTEGER NOT NULL DEFAULT 0,
+    clicks INTEGER NOT NULL DEFAULT 0,
+    dislikes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (ad_id, bucket, granularity)
+) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_ad_rollups_granularity_bucket ON ad_rollups(granularity, bucket)",
+)
+
+UPSERT = """
+INSERT INTO ad_rollups (ad_id, bucket, granularity, impressions, clicks, dislikes)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(ad_id, bucket, granularity) DO UPDATE SET
+    impressions = impressions + excluded.impressions,
+    clicks = clicks + excluded.clicks,
+    dislikes = dislikes + excluded.dislikes
+"""
+
+FOLD = """
+INSERT INTO ad_rollups (ad_id, bucket, granularity, impressions, clicks, dislikes)
+SELECT ad_id, bucket - bucket % :coarse, :coarse, SUM(impressions), SUM(clicks), SUM(dislikes)
+FROM ad_rollups WHERE granularity = :fine AND bucket < :cutoff
+GROUP BY ad_id, bucket - bucket % :coarse
+ON CONFLICT(ad_id, bucket, granularity) DO UPDATE SET
+    impressions = impressions + excluded.impressions,
+    clicks = clicks + excluded.clicks,
+    dislikes = dislikes + excluded.dislikes
+"""
+
+WINDOW_SELECT = """
+SELECT ad_id, SUM(impressions), SUM(clicks), SUM(dislikes) FROM ad_rollups
+WHERE granularity IN (60, 3600, 86400) AND bucket >= ?
+"""
+
+
+class RollupStore:
+    def __init__(self, db_path, maintain_interval=60.0):
+        self.db_path = db_path
+        self.maintain_interval = maintain_interval
+        self._ready = False  # table is created on first use, not at import
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rollups", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _ensure_schema(self, conn):
+        if not self._ready:
+            for stmt in SCHEMA:
+                conn.execute(stmt)
+            self._ready = True
+
+    def record(self, conn, events):
+        """Count ``(ad_id, ts, impressions, clicks, dislikes)`` into minute buckets
+        using ``conn`` (so it can share the caller's transaction)."""
+        self._ensure_schema(conn)
+        buckets = {}
+        for ad_id, ts, impressions, clicks, dislikes in events:
+            key = (ad_id, int(ts) - int(ts) % MINUTE)
+            cur = buckets.get(key)
+            buckets[key] = (impressions, clicks, dislikes) if cur is None else \
+                (cur[0] + impressions, cur[1] + clicks, cur[2] + dislikes)
+        conn.executemany(UPSERT, [(a, b, MINUTE, *v) for (a, b), v in buckets.items()])
+
+    def roll_up(self, now=None):
+        """Fold expired minute/hour buckets into the next tier and apply retention."""
+        now = int(now if now is not None else time.time())
+        with db.transaction(self.db_path) as conn:
+            self._ensure_schema(conn)
+            for fine, coarse, keep in ((MINUTE, HOUR, MINUTE_KEEP), (HOUR, DAY, HOUR_KEEP)):
+                cutoff = now - keep
+                cutoff -= cutoff % coarse  # never fold part of a coarse bucket
+                conn.execute(FOLD, {"fine": fine, "coarse": coarse, "cutoff": cutoff})
+                conn.execute("DELETE FROM ad_rollups WHERE granularity = ? AND bucket < ?", (fine, cutoff))
+            conn.execute("DELETE FROM ad_rollups WHERE granularity = ? AND bucket < ?", (DAY, now - DAY_KEEP))
+
+    def window(self, seconds, ad_ids=None, now=None):
+        """``{ad_id: (impressions, clicks, dislikes)}`` over the last ``seconds``."""
+        since = int(now if now is not None else time.time()) - int(seconds)
+        sql, params = WINDOW_SELECT, [since]
+        if ad_ids is not None:
+            ad_ids = list(ad_ids)
+            if not ad_ids:
+                return {}
+            sql += f" AND ad_id IN ({','.join('?' * len(ad_ids))})"
+            params += ad_ids
+        conn = db.connect(self.db_path)
+        self._ensure_schema(conn)
+        rows = conn.execute(sql + " GROUP BY ad_id", params).fetchall()
+        return {r[0]: (r[1], r[2], r[3]) for r in rows}
+
+    def ctr(self, seconds, ad_ids=None, now=None):
+        """``{ad_id: clicks / impressions}`` over the last ``seconds`` (ads with impressions only)."""
+        return {a: c / i for a, (i, c, _) in self.window(seconds, ad_ids, now).items() if i}
+
+    def remove_ad(self, conn, ad_id):
+        self._ensure_schema(conn)
+        conn.execute("DELETE FROM ad_rollups WHERE ad_id = ?", (ad_id,))
+
+    def _run(self):
+        while not self._stop.wait(self.maintain_interval):
+            try:
+                self.roll_up()
+            except sqlite3.Error:
+                pass  # retried on the next pass
+            finally:
+                db.release_thread()
+
+    def close(self):
+        self._stop.set()
+        atexit.unregister(self.close)
@@ -0,0 +1,269 @@
+"""
+Which ads are servable right now.
+
+An ad is servable when its ``is_active`` flag is on (NULL counts as on) and
+``start_date <= now < end_date`` (a missing bound is open). ``ActiveSchedule``
+keeps the set of servable ids in memory. Every future start or end time sits
+in a min-heap, so ``advance(now)`` is a peek when nothing is due and
+O(log n) per activation or expiry otherwise. Dates are parsed once, when an
+ad is (re)loaded, never per request.
+
+``version`` changes whenever the servable set does. ``serving(snap)`` is the
+snapshot's servable rows de-duplicated by title (highest CTR wins, then
+table order), each title placed where its first servable row is, like
+``CatalogSnapshot.dedupe_by_title``; it is kept up to date incrementally. Rows are grouped by title key
+once per catalog layout (the snapshot's ``ids`` array, shared by every
+counter-only swap). After that, a swap or an activation only re-elects the
+winner of the titles it touched; CTR changes elsewhere leave the view alone.
+``ServingView.version`` changes only when the served rows do.
+"""
+import heapq
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+
+from catalog import title_key
+
+
+def parse_time(value):
+    """Unix seconds for an ISO date/datetime (naive means UTC), else ``None``."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+ServingView = namedtuple("ServingView", "version rows pos")
+
+
+def _servable(flag, start, end, now):
+    return bool(flag) and (start is None or start <= now) and (end is None or now < end)
+
+
+class ActiveSchedule:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows = {}   # ad_id -> (generation, flag, start, end)
+        self._active = set()
+        self._active_ids = None  # sorted array of _active, rebuilt lazily
+        self._heap = []      # (time, ad_id, generation); stale generations are skipped
+        self._generation = 0
+        self.version = 0
+        # serving view, aligned to one catalog layout (see _reset_view)
+        self._layout = None      # the snapshot's ids array
+        self._index = None       # and its id -> row dict
+        self._key_names = ()     # title key per key code
+        self._codes = None       # row -> key code
+        self._order = None       # rows grouped by key code (table order within a group)
+        self._starts = None      # group c is _order[_starts[c]:_starts[c + 1]]
+        self._mask = None        # row -> servable
+        self._win = None         # key code -> served row, -1 if none
+        self._first = None       # key code -> its first servable row (its place in the view), -1 if none
+        self._head = None        # row -> is some key's first servable row
+        self._dirty = set()      # key codes whose winner must be re-elected
+        self._view = None        # ServingView
+        self._serving_version = 0
+        self._top = None         # (snapshot version, view version, k, rows)
+
+    def __contains__(self, ad_id):
+        return ad_id in self._active
+
+    def __len__(self):
+        return len(self._active)
+
+    # --- updates (from catalog swaps) ---
+    def rebuild(self, snap, now):
+        with self._lock:
+            self._windows.clear()
+            self._heap = []
+            active = set()
+            for i, ad_id in enumerate(snap.ids.tolist()):
+                if self._set(ad_id, snap.active_flags[i], snap.start_dates[i], snap.end_dates[i], now):
+                    active.add(ad_id)
+            heapq.heapify(self._heap)
+            if active != self._active:
+                self._active = active
+                self._active_ids = None
+                self.version += 1
+            self._reset_view(snap)
+
+    def update(self, snap, changed_ids, removed_ids, now):
+        with self._lock:
+            changed = False
+            for ad_id in changed_ids:
+                i = snap.index.get(ad_id)
+                if i is None:
+                    continue
+                on = self._set(ad_id, snap.active_flags[i], snap.start_dates[i], snap.end_dates[i], now, push=True)
+                changed |= self._mark(ad_id, on)
+            for ad_id in removed_ids:
+                self._windows.pop(ad_id, None)  # its heap entries become stale
+                changed |= self._mark(ad_id, False)
+            if changed:
+                self.version += 1
+            if snap.ids is not self._layout:
+                self._reset_view(snap)  # ads added or removed: regroup
+                return
+            for ad_id in changed_ids:
+                i = snap.index.get(ad_id)
+                if i is None:
+                    continue
+                code = self._codes[i]
+                if title_key(snap.titles[i], ad_id) != self._key_names[code]:
+                    self._reset_view(snap)  # retitled: regroup
+                    return
+                self._dirty.add(int(code))  # its CTR or servability may have changed the winner
+
+    def _set(self, ad_id, flag, start_date, end_date, now, push=False):
+        flag, start, end = bool(flag), parse_time(start_date), parse_time(end_date)
+        old = self._windows.get(ad_id)
+        if push and old is not None and old[1:] == (flag, start, end):
+            return _servable(flag, start, end, now)  # e.g. only its counters changed; heap entries still valid
+        self._generation += 1
+        gen = self._generation
+        self._windows[ad_id] = (gen, flag, start, end)
+        if flag:
+            for t in (start, end):
+                if t is not None and t > now:
+                    if push:
+                        heapq.heappush(self._heap, (t, ad_id, gen))
+                    else:
+                        self._heap.append((t, ad_id, gen))
+        return _servable(flag, start, end, now)
+
+    def _mark(self, ad_id, on):
+        if on == (ad_id in self._active):
+            return False
+        if on:
+            self._active.add(ad_id)
+        else:
+            self._active.discard(ad_id)
+        self._active_ids = None
+        i = self._index.get(ad_id) if self._index is not None else None
+        if i is not None and self._mask[i] != on:
+            self._mask[i] = on
+            self._dirty.add(int(self._codes[i]))
+        return True
+
+    # --- time ---
+    def advance(self, now):
+        """Apply every start/end time that has passed; returns the current version."""
+        heap = self._heap
+        if not heap or heap[0][0] > now:
+            return self.version
+        with self._lock:
+            changed = False
+            while self._heap and self._heap[0][0] <= now:
+                _, ad_id, gen = heapq.heappop(self._heap)
+                window = self._windows.get(ad_id)
+                if window is None or window[0] != gen:
+                    continue
+                _, flag, start, end = window
+                changed |= self._mark(ad_id, _servable(flag, start, end, now))
+            if changed:
+                self.version += 1
+            return self.version
+
+    # --- serving view ---
+    def active_ids(self):
+        """Sorted array of the servable ids."""
+        ids = self._active_ids
+        if ids is None:
+            ids = np.fromiter(self._active, dtype=np.int64, count=len(self._active))
+            ids.sort()
+            self._active_ids = ids
+        return ids
+
+    def _reset_view(self, snap):
+        """Group ``snap``'s rows by title key and elect every winner (O(n), once
+        per layout; called with the lock held)."""
+        names = {}
+        codes = np.fromiter((names.setdefault(title_key(t, a), len(names))
+                             for t, a in zip(snap.titles, snap.ids.tolist())), dtype=np.int64, count=len(snap))
+        self._layout, self._index = snap.ids, snap.index
+        self._key_names = tuple(names)
+        self._codes = codes
+        self._order = np.argsort(codes, kind="stable")
+        self._starts = np.searchsorted(codes[self._order], np.arange(len(names) + 1))
+        self._mask = np.isin(snap.ids, self.active_ids())
+        # winner per key: highest CTR among servable rows, first in table order on ties
+        servable = np.flatnonzero(self._mask)
+        cand = servable[np.lexsort((servable, -snap.ctr[servable], codes[servable]))]
+        first = np.ones(len(cand), dtype=bool)
+        first[1:] = codes[cand][1:] != codes[cand][:-1]
+        self._win = np.full(len(names), -1, dtype=np.int64)
+        self._win[codes[cand[first]]] = cand[first]
+        keys, at = np.unique(codes[servable], return_index=True)
+        self._first = np.full(len(names), -1, dtype=np.int64)
+        self._first[keys] = servable[at]
+        self._head = np.zeros(len(snap), dtype=bool)
+        self._head[servable[at]] = True
+        self._dirty.clear()
+        self._publish_view()
+
+    def _publish_view(self):
+        rows = self._win[self._codes[np.flatnonzero(self._head)]]
+        pos = np.full(len(self._head), -1, dtype=np.int64)
+        pos[rows] = np.arange(len(rows))
+        rows.flags.writeable = False
+        pos.flags.writeable = False
+        self._serving_version += 1
+        self._view = ServingView(self._serving_version, rows, pos)
+
+    def serving(self, snap):
+        """``ServingView(version, rows, pos)``: servable rows of ``snap``
+        de-duplicated by title, and each row's position in ``rows`` (-1 when
+        not served). ``version`` changes only when ``rows`` do."""
+        with self._lock:
+            if snap.ids is not self._layout:
+                # a snapshot from another layout (e.g. one taken before the last
+                # insert): compute it on its own, without touching the view
+                rows, pos = snap.dedupe_by_title(np.isin(snap.ids, self.active_ids()))
+                return ServingView(-snap.version, rows, pos)
+            if self._dirty:
+                changed = False
+                for code in self._dirty:
+                    group = self._order[self._starts[code]:self._starts[code + 1]]
+                    live = group[self._mask[group]]  # in table order
+                    winner = live[np.argmax(snap.ctr[live])] if len(live) else -1
+                    first = live[0] if len(live) else -1
+                    if winner != self._win[code] or first != self._first[code]:
+                        if self._first[code] >= 0:
+                            self._head[self._first[code]] = False
+                        if first >= 0:
+                            self._head[first] = True
+                        self._win[code], self._first[code] = winner, first
+                        changed = True
+                self._dirty.clear()
+                if changed:
+                    self._publish_view()
+            return self._view
+
+    def top_by_ctr(self, snap, k):
+        """The (at most) ``k`` rows of ``serving(snap)`` with the highest CTR,
+        best first; ties keep serving order."""
+        view = self.serving(snap)
+        top = self._top
+        if top is not None and top[:3] == (snap.version, view.version, k):
+            return top[3]
+        rows = view.rows
+        ctr = -snap.ctr[rows]
+        if len(rows) > k:
+            part = np.sort(np.argpartition(ctr, k - 1)[:k])  # serving order, for the stable sort
+            best = part[np.argsort(ctr[part], kind="stable")]
+            # argpartition breaks ties at the cut arbitrarily; take them in serving order
+            cut = ctr[best[-1]]
+            best = np.concatenate([best[ctr[best] < cut], np.flatnonzero(ctr == cut)])[:k]
+        else:
+            best = np.argsort(ctr, kind="stable")
+        top_rows = rows[best]
+        top_rows.flags.writeable = False
+        self._top = (snap.version, view.version, k, top_rows)
+        return top_rows
@@ -0,0 +1,185 @@
+"""
+Precomputed "similar ads" lists.
+
+For every ad, the ``k`` most similar other ads by cosine similarity of their
+TF-IDF rows in ``ContentIndex`` (title, keywords and category weighted above
+the free-text details). The table is two fixed-width arrays, int32 neighbor
+ids and float32 scores (``-1`` / ``0.0`` padded, best first), plus an
+``ad id -> row`` dict, so a lookup is one dict hit and a copy of ``k`` values.
+
+The full table is built by a background thread, blockwise (``block`` rows of
+the matrix against all of it at a time), whenever the content index is
+refitted. Between refits, changed ads are maintained incrementally. A changed
+ad's own row is recomputed with one sparse product against the catalog, and
+it is inserted into the rows of ads it now beats. Rows it was dropped from,
+or whose similarity to it fell, are recomputed. While a rebuild is pending,
+lookups fall back to computing the one requested row on the fly.
+"""
+import threading
+import time
+
+import numpy as np
+
+
+class SimilarAds:
+    def __init__(self, content_index, k=20, block=256):
+        self.content_index = content_index
+        self.k = k
+        self.block = block
+        self._lock = threading.Lock()
+        self._row = {}                                   # ad id -> row in the arrays
+        self._free = []                                  # rows of removed ads, for reuse
+        self._ids = np.full((0, k), -1, dtype=np.int32)
+        self._scores = np.zeros((0, k), dtype=np.float32)
+        self._generation = None                          # content index generation the table matches
+        self._wake = threading.Event()
+        self._worker = None
+        self.rebuilds = 0
+        self.updates = 0
+
+    @property
+    def ready(self):
+        return self._generation == self.content_index.generation
+
+    def __len__(self):
+        return len(self._row)
+
+    # --- full builds ---
+    def request_rebuild(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="similar-ads", daemon=True)
+                self._worker.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.rebuild()
+            except Exception:
+                time.sleep(1.0)
+                self._wake.set()  # retry
+
+    def rebuild(self):
+        """Recompute the whole table from the current content index."""
+        generation = self.content_index.generation
+        keys, nbr, sims = self.content_index.all_neighbors(self.k, self.block)
+        with self._lock:
+            self._row = {int(key): i for i, key in enumerate(keys.tolist())}
+            self._free = []
+            self._ids = nbr.astype(np.int32)
+            self._scores = sims
+            self._generation = generation
+            self.rebuilds += 1
+
+    # --- incremental maintenance ---
+    def update(self, changed_ids, removed_ids):
+        """Bring the table up to date after ``changed_ids`` were (re)indexed and
+        ``removed_ids`` dropped from the content index."""
+        if not self.ready:
+            self.request_rebuild()
+            return
+        for ad_id in removed_ids:
+            self._remove(int(ad_id))
+        for ad_id in changed_ids:
+            self._refresh(int(ad_id))
+
+    def _neighbors_of(self, ad_id):
+        """``(ids, scores)`` of ``ad_id``'s top ``k`` computed on the fly, plus the
+        similarity of every live ad to it (``keys``, ``sims``)."""
+        query = self.content_index.vector(ad_id)
+        keys, sims = self.content_index.similarities_by_key(query)
+        sims = np.where((keys == ad_id) | (sims <= 0), 0.0, sims).astype(np.float32)
+        k = min(self.k, len(keys))
+        ids = np.full(self.k, -1, dtype=np.int32)
+        scores = np.zeros(self.k, dtype=np.float32)
+        if k:
+            top = np.argpartition(-sims, k - 1)[:k]
+            top = top[np.argsort(-sims[top], kind="stable")]
+            top = top[sims[top] > 0]
+            ids[:len(top)] = keys[top]
+            scores[:len(top)] = sims[top]
+        return ids, scores, keys, sims
+
+    def _set_row(self, ad_id, ids, scores):
+        row = self._row.get(ad_id)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                row = len(self._ids)
+                grow = max(16, len(self._ids))
+                self._ids = np.vstack([self._ids, np.full((grow, self.k), -1, dtype=np.int32)])
+                self._scores = np.vstack([self._scores, np.zeros((grow, self.k), dtype=np.float32)])
+                self._free = list(range(len(self._ids) - 1, row, -1))
+            self._row[ad_id] = row
+        self._ids[row] = ids
+        self._scores[row] = scores
+
+    def _refresh(self, ad_id):
+        if self.content_index.vector(ad_id) is None:
+            self._remove(ad_id)
+            return
+        ids, scores, keys, sims = self._neighbors_of(ad_id)
+        with self._lock:
+            self._set_row(ad_id, ids, scores)
+            # everyone's similarity to ad_id, laid out by table row (0 for free rows)
+            rows = np.fromiter((self._row.get(key, -1) for key in keys.tolist()), dtype=np.int64, count=len(keys))
+            sim = np.zeros(len(self._ids), dtype=np.float32)
+            sim[rows[rows >= 0]] = sims[rows >= 0]
+            sim[self._row[ad_id]] = 0.0
+            held = self._ids == ad_id
+            has = held.any(axis=1)
+            slot = held.argmax(axis=1)
+            old = self._scores[np.arange(len(self._ids)), slot]
+            down = has & (sim < old)    # its score fell: the next best is unknown, recompute
+            up = has & ~down
+            enter = ~has & (sim > 0) & (sim > self._scores[:, -1])  # evicts the weakest (or padding)
+            self._scores[up, slot[up]] = sim[up]
+            self._ids[enter, -1] = ad_id
+            self._scores[enter, -1] = sim[enter]
+            touched = np.flatnonzero(up | enter)
+            if len(touched):
+                order = np.argsort(-self._scores[touched], axis=1, kind="stable")
+                self._ids[touched] = np.take_along_axis(self._ids[touched], order, axis=1)
+                self._scores[touched] = np.take_along_axis(self._scores[touched], order, axis=1)
+            by_row = {r: a for a, r in self._row.items()} if down.any() else {}
+            recompute = [by_row[r] for r in np.flatnonzero(down).tolist() if r in by_row]
+            self.updates += 1
+        for other in recompute:
+            self._recompute(other)
+
+    def _remove(self, ad_id):
+        with self._lock:
+            row = self._row.pop(ad_id, None)
+            if row is not None:
+                self._ids[row] = -1
+                self._scores[row] = 0.0
+                self._free.append(row)
+            holders = np.flatnonzero((self._ids == ad_id).any(axis=1))
+            by_row = {r: a for a, r in self._row.items()}
+            affected = [by_row[r] for r in holders.tolist() if r in by_row]
+        for other in affected:
+            self._recompute(other)
+
+    def _recompute(self, ad_id):
+        ids, scores, _, _ = self._neighbors_of(ad_id)
+        with self._lock:
+            if ad_id in self._row:
+                self._set_row(ad_id, ids, scores)
+
+    # --- lookups ---
+    def neighbors(self, ad_id):
+        """``[(ad_id, score), ...]`` most similar first (up to ``k``)."""
+        with self._lock:
+            row = self._row.get(ad_id) if self.ready else None
+            if row is not None:
+                ids, scores = self._ids[row].copy(), self._scores[row].copy()
+        if row is None:
+            if self.content_index.vector(ad_id) is None:
+                return []
+            ids, scores, _, _ = self._neighbors_of(ad_id)
+        n = int((ids >= 0).sum())
+        return list(zip(ids[:n].tolist(), scores[:n].tolist()))
@@ -0,0 +1,47 @@
+import csv
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CATEGORIES = ["Sports", "Food", "Electronics", "homepage", "Fashion", ""]
+WORDS = ["running", "shoes", "protein", "snack", "phone", "bike", "coffee", "yoga", "chair", "bag"]
+PAGES = ["homepage", "nutrition", "tech/phones", "", "sports?x=1", "blog"]
+NOW = 1_700_000_000.0  # 2023-11-14T22:13:20Z; pass as ``now`` when using ad_rows dates
+DATES = [None, None, "2023-01-01", "2023-11-14T22:00:00", "2023-11-15", "2024-06-01"]
+
+
+def ad_row(rng, ad_id):
+    """One ``catalog.AD_COLUMNS`` tuple; titles repeat so de-duplication has work."""
+    return (ad_id, f"Ad {rng.randrange(40)}", rng.choice(CATEGORIES), ", ".join(rng.sample(WORDS, 3)),
+            rng.choice(PAGES), f"/static/images/{ad_id}.webp", round(rng.random(), 3), rng.randrange(50),
+            rng.randrange(500), "details", "", rng.choice([1, 1, 1, 0, None]), rng.choice(DATES),
+            rng.choice(DATES))
+
+
+@pytest.fixture
+def catalog_csv(tmp_path):
+    """Write a seeded ad inventory CSV with ``n`` ads and return its path."""
+    def write(n, seed=1):
+        rng = random.Random(seed)
+        path = tmp_path / f"inventory-{n}-{seed}.csv"
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["ad_id", "title", "category", "keywords", "target_page", "image_url", "details"])
+            for i in range(n):
+                w.writerow([i + 1, f"Ad {i % 50}", rng.choice(CATEGORIES), ", ".join(rng.sample(WORDS, 3)),
+                            rng.choice(PAGES), "", " ".join(rng.sample(WORDS, 4))])
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def ad_rows():
+    """Seeded ``catalog.AD_COLUMNS`` tuples for ``n`` ads with ids ``1..n``."""
+    def make(n, seed=1):
+        rng = random.Random(seed)
+        return [ad_row(rng, i + 1) for i in range(n)]
+    return make
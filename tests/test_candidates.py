@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import models
+from models import AdRecommender, contains
+
+CASES = [
+    ("tech/phones", ""),
+    ("tech/ph", "run"),
+    ("Sports/y", "phone, yoga"),
+    ("nutrition?utm=1", "snack,cof"),
+    ("?x", ""),
+    ("/blog", "bike"),
+    ("", "hoe, protein"),
+]
+
+
+@pytest.fixture
+def make_recommender(catalog_csv, tmp_path):
+    inventory = catalog_csv(1500)
+
+    def make(name):
+        users = tmp_path / name / "users"
+        users.mkdir(parents=True)
+        return AdRecommender(inventory, str(tmp_path / name / "metrics.db"), str(users), flush_interval=60)
+    return make
+
+
+@pytest.mark.parametrize("page,interests", CASES)
+def test_candidates_cover_every_rule_match(make_recommender, page, interests):
+    r = make_recommender("r")
+    n = len(r)
+    rules = r._match_rules(page, interests)
+    matched = np.zeros(n, dtype=bool)
+    for _, column, key in rules:
+        matched |= contains(column, key)
+    cand = r._candidate_rows(rules, np.zeros(n), None)
+    assert set(np.flatnonzero(matched).tolist()) <= set(cand.tolist())
+
+
+def test_recommend_matches_full_scan(make_recommender, monkeypatch):
+    indexed, scanned = make_recommender("indexed"), make_recommender("scanned")
+    for page, interests in CASES:
+        expected = None
+        with monkeypatch.context() as m:
+            m.setattr(models, "FULL_SCAN_MAX", 10 ** 9)
+            expected = scanned.recommend("u1", page, interests, max_results=10)
+        assert indexed.recommend("u1", page, interests, max_results=10) == expected
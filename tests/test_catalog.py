@@ -0,0 +1,60 @@
+import random
+
+import numpy as np
+import pytest
+
+from catalog import _NUMERIC_COLUMNS, _TEXT_COLUMNS, RANKING_CTR_TOLERANCE, CatalogSnapshot
+from conftest import ad_row
+
+
+def assert_same_snapshot(patched, fresh):
+    for name, _, _ in _TEXT_COLUMNS:
+        assert getattr(patched, name) == getattr(fresh, name), name
+    for name, _, _, _ in _NUMERIC_COLUMNS:
+        np.testing.assert_array_equal(getattr(patched, name), getattr(fresh, name), err_msg=name)
+    np.testing.assert_array_equal(patched.ids, fresh.ids)
+    assert patched.index == fresh.index
+    decoded = [patched.category_names[c] for c in patched.category_codes]
+    assert decoded == list(fresh.categories)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_with_rows_matches_a_fresh_snapshot(ad_rows, seed):
+    rng = random.Random(seed)
+    rows = ad_rows(300, seed)
+    snap = CatalogSnapshot(1, rows)
+    for version in range(2, 12):
+        updates = {}
+        for i in rng.sample(range(len(rows)), rng.randint(1, 20)):
+            row = list(rows[i])
+            if rng.random() < 0.3:
+                row = list(ad_row(rng, row[0]))  # text edit, maybe a brand new category
+                if rng.random() < 0.2:
+                    row[2] = f"New category {version}"
+            row[6] = round(rng.random(), 3)
+            rows[i] = updates[i] = tuple(row)
+        patched = snap.with_rows(version, updates)
+        assert_same_snapshot(patched, CatalogSnapshot(version, rows))
+        assert all(getattr(snap, name).flags.writeable is False for name, _, _, _ in _NUMERIC_COLUMNS)
+        snap = patched
+
+
+def test_ranking_version_moves_only_beyond_the_tolerance(ad_rows):
+    rows = ad_rows(50)
+    snap = CatalogSnapshot(1, rows)
+    small = snap.with_rows(2, {3: rows[3][:6] + (rows[3][6] + RANKING_CTR_TOLERANCE / 2,) + rows[3][7:]})
+    assert small.ranking_version == 1
+    large = small.with_rows(3, {3: rows[3][:6] + (rows[3][6] + RANKING_CTR_TOLERANCE * 2,) + rows[3][7:]})
+    assert large.ranking_version == 3
+    retitled = large.with_rows(4, {5: (rows[5][0], "Renamed") + rows[5][2:]})
+    assert retitled.ranking_version == 4
+
+
+def test_rows_of_matches_the_index(ad_rows):
+    rows = ad_rows(200)
+    random.Random(3).shuffle(rows)
+    snap = CatalogSnapshot(1, rows)
+    ids = np.array(sorted(random.Random(4).sample(range(-5, 260), 120)), dtype=np.int64)
+    expected = [snap.index[a] for a in ids.tolist() if a in snap.index]
+    assert snap.rows_of(ids).tolist() == expected
+    assert CatalogSnapshot(1, []).rows_of(ids).tolist() == []
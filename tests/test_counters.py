@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+from models import AdRecommender
+
+
+@pytest.fixture
+def counters(catalog_csv, tmp_path):
+    (tmp_path / "users").mkdir()
+    r = AdRecommender(catalog_csv(20), str(tmp_path / "metrics.db"), str(tmp_path / "users"), flush_interval=60)
+    yield r.counters
+    r.counters.close()
+
+
+def committed(buf, ad_id):
+    with sqlite3.connect(buf.db_path) as conn:
+        row = conn.execute("SELECT impressions, clicks, dislikes FROM ad_metrics WHERE ad_id=?", (ad_id,)).fetchone()
+    return tuple(row) if row else (0, 0, 0)
+
+
+def test_batch_stays_pending_until_committed(counters, monkeypatch):
+    counters.add(3, "u1", impressions=5, clicks=2)
+    write, seen = counters._write, []
+
+    def observed_write(ads, users, batch=None):
+        seen.append((counters.pending_ads(), counters.pending_user("u1"), committed(counters, "3")))
+        write(ads, users, batch)
+    monkeypatch.setattr(counters, "_write", observed_write)
+
+    assert counters.flush() == 2
+    assert seen == [({"3": (5, 2, 0)}, {"3": (5, 2, 0)}, (0, 0, 0))]
+    assert counters.pending_ads() == {} and counters.pending_user("u1") == {}
+    assert committed(counters, "3") == (5, 2, 0)
+
+
+def test_failed_flush_keeps_deltas_pending(counters, monkeypatch):
+    counters.add(3, "u1", clicks=1)
+
+    def failing_write(ads, users, batch=None):
+        counters.add(3, "u1", clicks=1)  # arrives while the batch is in flight
+        assert counters.pending_ads() == {"3": (0, 2, 0)}
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(counters, "_write", failing_write)
+
+    with pytest.raises(sqlite3.OperationalError):
+        counters.flush()
+    assert counters.pending_ads() == {"3": (0, 2, 0)}
+    assert counters.pending_user("u1") == {"3": (0, 2, 0)}
@@ -0,0 +1,97 @@
+import random
+
+import numpy as np
+import pytest
+
+from catalog import CatalogSnapshot
+from conftest import ad_row
+from inverted_index import tokenize
+from personalization import AdFeatures, AffinityVectors, session_jitter
+from user_store import UserStore
+
+MASK = (1 << 64) - 1
+
+
+def mix64(x):
+    x ^= x >> 30
+    x = (x * 0xBF58476D1CE4E5B9) & MASK
+    x ^= x >> 27
+    x = (x * 0x94D049BB133111EB) & MASK
+    return x ^ (x >> 31)
+
+
+def baseline_jitter(seed, ad_id, amplitude):
+    """``session_jitter`` for one ad, in plain integer arithmetic."""
+    x = mix64(((ad_id & MASK) * 0x9E3779B97F4A7C15 & MASK) ^ mix64(seed & MASK))
+    return amplitude * (2.0 * ((x >> 11) / float(1 << 53)) - 1.0)
+
+
+def test_session_jitter_matches_scalar_hash():
+    rng = random.Random(21)
+    ad_ids = [rng.randrange(1, 10 ** 6) for _ in range(500)] + [0, 1, 2 ** 62]
+    for seed in (0, 1, 2 ** 31 - 1, 2 ** 63 + 5, rng.getrandbits(64)):
+        got = session_jitter(seed, np.array(ad_ids), 3.0)
+        assert got.tolist() == [baseline_jitter(seed, a, 3.0) for a in ad_ids]
+
+
+def test_session_jitter_range_and_spread():
+    ids = np.arange(1, 20001)
+    a, b = session_jitter(7, ids, 3.0), session_jitter(8, ids, 3.0)
+    assert a.min() >= -3.0 and a.max() < 3.0
+    assert abs(a.mean()) < 0.1 and abs(np.corrcoef(a, b)[0, 1]) < 0.05
+    np.testing.assert_array_equal(a, session_jitter(7, ids, 3.0))
+
+
+def baseline_affinity(snap, prefs, category_like=7.0, category_dislike=7.0, keyword_like=3.0, keyword_dislike=3.0):
+    """Personalization term of every row, derived from the preference lists."""
+    def features(ad_ids):
+        categories, tokens = set(), set()
+        for ad_id in ad_ids:
+            i = snap.index.get(ad_id)
+            if i is not None:
+                categories.add(snap.categories[i])
+                tokens |= tokenize(snap.keywords[i])
+        return categories, tokens
+    (liked_cats, liked_tokens), (disliked_cats, disliked_tokens) = features(prefs.likes), features(prefs.dislikes)
+    out = []
+    for category, keywords in zip(snap.categories, snap.keywords):
+        s = 0.0
+        if category:
+            s += category_like * (category in liked_cats) - category_dislike * (category in disliked_cats)
+        tokens = tokenize(keywords)
+        if tokens:
+            s += sum(keyword_like * (t in liked_tokens) - keyword_dislike * (t in disliked_tokens)
+                     for t in tokens) / len(tokens)
+        out.append(s)
+    return out
+
+
+def test_incremental_affinity_matches_preferences(ad_rows, tmp_path):
+    rng = random.Random(25)
+    rows = ad_rows(300)
+    snap = CatalogSnapshot(1, rows)
+    store = UserStore(tmp_path / "users")
+    affinity = AffinityVectors(AdFeatures(), store, 7.0, 7.0, 3.0, 3.0)
+    for step in range(120):
+        if step % 25 == 24:
+            # edit some ads (liked ones included): cached vectors must notice
+            updates = {}
+            for i in rng.sample(range(len(rows)), 10):
+                rows[i] = updates[i] = (rows[i][0],) + ad_row(rng, rows[i][0])[1:]
+            snap = snap.with_rows(step, updates)
+        else:
+            ad_id = rng.choice(rows)[0] if rng.random() < 0.9 else 10 ** 6  # unknown ids count too
+            before = store.preferences("u1")
+            after = (store.like if rng.random() < 0.6 else store.dislike)("u1", ad_id)
+            affinity.apply("u1", before, after, [ad_id], snap)
+        prefs = store.preferences("u1")
+        got = affinity.scores(affinity.get("u1", prefs, snap), snap)
+        assert got.tolist() == pytest.approx(baseline_affinity(snap, prefs), abs=1e-5)
+
+    # a fresh process loads the persisted vector instead of rebuilding it
+    store.flush()
+    reloaded = AffinityVectors(AdFeatures(), UserStore(tmp_path / "users"), 7.0, 7.0, 3.0, 3.0)
+    got = reloaded.scores(reloaded.get("u1", prefs, snap), snap)
+    assert reloaded.rebuilds == 0
+    assert got.tolist() == pytest.approx(baseline_affinity(snap, prefs), abs=1e-5)
+    store.close()
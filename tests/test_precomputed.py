@@ -0,0 +1,35 @@
+import pytest
+
+import batch_recs
+from models import AdRecommender
+
+
+@pytest.fixture
+def make_recommender(catalog_csv, tmp_path):
+    inventory = catalog_csv(300)
+    (tmp_path / "users").mkdir()
+
+    def make():
+        return AdRecommender(inventory, str(tmp_path / "metrics.db"), str(tmp_path / "users"), flush_interval=60)
+    return make
+
+
+def test_precomputed_until_disliked_in_this_process(make_recommender):
+    r = make_recommender()
+    batch_recs.precompute(r, users=["u1"], processes=1)
+    assert r._precomputed("u1", 5) is not None
+    r.record_dislike(r._ad_ids[0], "u1")
+    assert r._precomputed("u1", 5) is None  # not flushed yet
+    r.counters.flush()
+    assert r._precomputed("u1", 5) is None
+
+
+def test_precomputed_until_disliked_in_another_process(make_recommender):
+    r, other = make_recommender(), make_recommender()
+    batch_recs.precompute(r, users=["u1"], processes=1)
+    other.record_dislike(r._ad_ids[0], "u2")
+    other.counters.flush()
+    assert r._precomputed("u1", 5) is not None  # someone else's dislike
+    other.record_dislike(r._ad_ids[0], "u1")
+    other.counters.flush()
+    assert r._precomputed("u1", 5) is None
@@ -0,0 +1,72 @@
+import random
+import sqlite3
+
+import pytest
+
+from models import CONTENT_WEIGHT, AdRecommender
+
+CASES = [("homepage", ""), ("tech/phones", "phone, run"), ("Sports/y", "yoga"), ("nutrition?x=1", "snack,coffee"),
+         ("", "bike"), ("blog", "")]
+
+
+def baseline_recommend(r, user_id, current_page, interests, max_results):
+    """``[(ad_id, score)]`` the way the original per-row loop ranked ads, plus the
+    content-similarity term (scored against every ad, not just candidates)."""
+    def metrics(rows, pending):
+        out = {str(ad_id): [imp or 0, clk or 0, dis or 0] for ad_id, imp, clk, dis in rows}
+        for ad_id, delta in pending.items():
+            out[ad_id] = [a + b for a, b in zip(out.get(ad_id, [0, 0, 0]), delta)]
+        return out
+    with sqlite3.connect(r.db_path) as conn:
+        ads_m = metrics(conn.execute('SELECT ad_id, impressions, clicks, dislikes FROM ad_metrics'),
+                        r.counters.pending_ads())
+        user_m = metrics(conn.execute('SELECT ad_id, impressions, clicks, dislikes FROM user_metrics WHERE user_id=?',
+                                      (user_id,)), r.counters.pending_user(user_id))
+    query = r.content_index.query_from_text(interests) if interests else None
+    sims = r.content_index.similarities(query)
+    cols = r.columns
+    final = []
+    for i, ad_id in enumerate(cols['ad_id']):
+        s = 0.0
+        page, cat = cols['target_page'][i], cols['category'][i]
+        if current_page and page and current_page.split('?')[0] in page:
+            s += 2.0
+        if current_page and cat and current_page.split('/')[0] in cat:
+            s += 1.0
+        if interests:
+            for tok in interests.split(','):
+                if tok.strip() and tok.strip().lower() in cols['keywords'][i].lower():
+                    s += 0.5
+        s += CONTENT_WEIGHT * float(sims[i])
+        imp, clk, dis = ads_m.get(str(ad_id), (0, 0, 0))
+        user_dis = user_m.get(str(ad_id), (0, 0, 0))[2]
+        ctr = clk / imp * 100 if imp > 0 else 0.0
+        if user_dis >= 2:
+            continue
+        final.append((ad_id, s + ctr / 10.0 - (dis * 0.5 + user_dis * 2.0)))
+    return sorted(final, key=lambda x: x[1], reverse=True)[:max_results]
+
+
+@pytest.mark.parametrize("n", [150, 800])
+def test_recommend_matches_baseline_loop(catalog_csv, tmp_path, n):
+    (tmp_path / "users").mkdir()
+    r = AdRecommender(catalog_csv(n), str(tmp_path / "metrics.db"), str(tmp_path / "users"), flush_interval=60)
+    rng = random.Random(n)
+    for step in range(300):
+        ad_id = rng.randint(1, n)
+        user = rng.choice(["u1", "u2"])
+        kind = rng.random()
+        if kind < 0.5:
+            r.counters.add(ad_id, user, impressions=rng.randint(1, 5))
+        elif kind < 0.8:
+            r.record_click(ad_id, user)
+        else:
+            r.record_dislike(ad_id, user)
+        if step == 150:
+            r.counters.flush()  # half persisted, half still pending
+    for page, interests in CASES:
+        expected = baseline_recommend(r, "u1", page, interests, 8)
+        got = [(ad['ad_id'], ad['score']) for ad in r.recommend("u1", page, interests, max_results=8)]
+        assert [a for a, _ in got] == [a for a, _ in expected]
+        assert [s for _, s in got] == pytest.approx([s for _, s in expected])
+    r.counters.close()
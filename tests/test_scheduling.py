@@ -0,0 +1,69 @@
+import random
+
+import numpy as np
+import pytest
+
+from catalog import CatalogSnapshot
+from conftest import DATES, NOW, ad_row
+from scheduling import ActiveSchedule, _servable, parse_time
+
+
+def baseline_serving(snap, now):
+    """Servable rows de-duplicated by title the way the original dict-based
+    loop did it."""
+    mask = [_servable(f, parse_time(s), parse_time(e), now)
+            for f, s, e in zip(snap.active_flags.tolist(), snap.start_dates, snap.end_dates)]
+    return snap.dedupe_by_title(np.array(mask, dtype=bool))
+
+
+def assert_serving(schedule, snap, now):
+    view = schedule.serving(snap)
+    rows, pos = baseline_serving(snap, now)
+    assert view.rows.tolist() == rows.tolist()
+    assert view.pos.tolist() == pos.tolist()
+    for k in (1, 7, 40, 10 ** 6):
+        expected = rows[np.argsort(-snap.ctr[rows], kind="stable")[:k]]
+        assert schedule.top_by_ctr(snap, k).tolist() == expected.tolist()
+
+
+def edit(rng, row):
+    row = list(row)
+    what = rng.random()
+    if what < 0.5:
+        row[6] = rng.choice([row[6], 0.5, round(rng.random(), 1)])  # CTR, often tied
+    elif what < 0.7:
+        row[11] = rng.choice([0, 1, None])
+    elif what < 0.85:
+        row[12], row[13] = rng.choice(DATES), rng.choice(DATES)
+    else:
+        row[1] = f"Ad {rng.randrange(40)}"  # retitle into another group
+    return tuple(row)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_incremental_serving_matches_baseline(ad_rows, seed):
+    rng = random.Random(seed)
+    rows = [r[:6] + (round(r[6], 1),) + r[7:] for r in ad_rows(400, seed)]
+    snap = CatalogSnapshot(1, rows)
+    schedule = ActiveSchedule()
+    now = NOW
+    schedule.rebuild(snap, now)
+    assert_serving(schedule, snap, now)
+    for version in range(2, 40):
+        if version % 10 == 0:
+            # insert and delete: a new layout
+            rows = [r for r in rows if rng.random() > 0.02] + [ad_row(rng, 1000 + version)]
+            changed = [rows[-1][0]]
+            removed = sorted(set(snap.ids.tolist()) - {r[0] for r in rows})
+            snap = CatalogSnapshot(version, rows)
+        else:
+            updates = {i: edit(rng, rows[i]) for i in rng.sample(range(len(rows)), rng.randint(1, 8))}
+            for i, row in updates.items():
+                rows[i] = row
+            changed, removed = [rows[i][0] for i in updates], []
+            snap = snap.with_rows(version, updates)
+        schedule.update(snap, changed, removed, now)
+        if version % 7 == 0:
+            now += 43200.0  # half a day: some start/end dates come due
+            schedule.advance(now)
+        assert_serving(schedule, snap, now)
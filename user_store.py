@@ -0,0 +1,235 @@
+"""
+Cached per-user preference and profile store.
+
+``users/<name>/preferences.json``, ``profile.json`` and ``affinity.json``
+(the user's feature affinity counts, see ``personalization``) are read once
+and kept in an LRU-bounded in-memory cache. Likes and dislikes are held as
+frozensets, so per-ad membership tests during scoring are O(1). Changes are
+applied to the cache immediately and written through to disk by a
+background writer (atomic tmp-file + rename, coalesced per file).
+
+A cached entry is reloaded when its file changed on disk (mtime/size), but the
+check runs at most once per ``recheck_interval`` seconds per user, so the hot
+path does no file I/O for active users.
+"""
+import atexit
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PREFS_NAME = "preferences.json"
+PROFILE_NAME = "profile.json"
+AFFINITY_NAME = "affinity.json"
+
+_versions = itertools.count(1)
+
+
+class Preferences:
+    """Immutable likes/dislikes for one user. ``version`` changes on every update
+    (process-wide unique), so it can be used as a cache key."""
+
+    __slots__ = ("likes", "dislikes", "version")
+
+    def __init__(self, likes=(), dislikes=()):
+        self.likes = frozenset(int(a) for a in likes)
+        self.dislikes = frozenset(int(a) for a in dislikes)
+        self.version = next(_versions)
+
+    def to_json(self):
+        return {"likes": sorted(self.likes), "dislikes": sorted(self.dislikes)}
+
+
+class _Entry:
+    __slots__ = ("value", "stat", "checked_at")
+
+    def __init__(self, value, stat):
+        self.value = value
+        self.stat = stat
+        self.checked_at = time.monotonic()
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _read_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+class UserStore:
+    def __init__(self, users_folder, max_users=1024, recheck_interval=2.0):
+        self.users_folder = str(users_folder)
+        self.max_users = max_users
+        self.recheck_interval = recheck_interval
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self._cache = OrderedDict()   # (kind, username) -> _Entry
+        self._dirty = {}              # path -> (cache key, payload, json kwargs)
+        self._wake = threading.Condition(self._lock)
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self._writer = threading.Thread(target=self._run, name="user-store-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _path(self, username, name):
+        return os.path.join(self.users_folder, username, name)
+
+    # --- cache plumbing ---
+    def _get(self, kind, username, name, parse):
+        key = (kind, username)
+        path = self._path(username, name)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                if path in self._dirty or time.monotonic() - entry.checked_at < self.recheck_interval:
+                    self.hits += 1
+                    return entry.value
+        # Miss or periodic re-check: compare the file's mtime/size with what we cached
+        stat = _stat(path)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and (entry.stat == stat or path in self._dirty):
+                entry.checked_at = time.monotonic()
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+            value = parse(_read_json(path, None) if stat else None)
+            self._cache[key] = _Entry(value, stat)
+            while len(self._cache) > self.max_users:
+                self._cache.popitem(last=False)
+            return value
+
+    def _put(self, kind, username, name, value, payload, **dump_kwargs):
+        key = (kind, username)
+        path = self._path(username, name)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self._cache[key] = entry = _Entry(value, None)
+            entry.value = value
+            self._cache.move_to_end(key)
+            self._dirty[path] = (key, payload, dump_kwargs)
+            self._wake.notify()
+        return value
+
+    # --- preferences ---
+    def preferences(self, username):
+        return self._get("prefs", username, PREFS_NAME, _parse_prefs)
+
+    def set_preferences(self, username, likes, dislikes):
+        prefs = Preferences(likes, dislikes)
+        return self._put("prefs", username, PREFS_NAME, prefs, prefs.to_json())
+
+    def like(self, username, ad_id):
+        """Add ``ad_id`` to likes (and drop it from dislikes)."""
+        with self._lock:
+            cur = self.preferences(username)
+            if ad_id in cur.likes and ad_id not in cur.dislikes:
+                return cur
+            return self.set_preferences(username, cur.likes | {ad_id}, cur.dislikes - {ad_id})
+
+    def dislike(self, username, ad_id):
+        """Add ``ad_id`` to dislikes (and drop it from likes)."""
+        with self._lock:
+            cur = self.preferences(username)
+            if ad_id in cur.dislikes and ad_id not in cur.likes:
+                return cur
+            return self.set_preferences(username, cur.likes - {ad_id}, cur.dislikes | {ad_id})
+
+    def apply_feedback(self, username, feedback):
+        """Apply ``(ad_id, "like" | "dislike")`` pairs in order as one update."""
+        with self._lock:
+            cur = self.preferences(username)
+            likes, dislikes = set(cur.likes), set(cur.dislikes)
+            for ad_id, kind in feedback:
+                if kind == "like":
+                    likes.add(ad_id); dislikes.discard(ad_id)
+                else:
+                    dislikes.add(ad_id); likes.discard(ad_id)
+            if likes == cur.likes and dislikes == cur.dislikes:
+                return cur
+            return self.set_preferences(username, likes, dislikes)
+
+    # --- profile ---
+    def profile(self, username):
+        return dict(self._get("profile", username, PROFILE_NAME, lambda data: data if isinstance(data, dict) else {}))
+
+    def save_profile(self, username, data):
+        data = dict(data)
+        self._put("profile", username, PROFILE_NAME, data, data, ensure_ascii=False, indent=2)
+
+    # --- affinity counts ---
+    def affinity(self, username):
+        """The last saved affinity payload (a dict), or ``None``."""
+        return self._get("affinity", username, AFFINITY_NAME, lambda data: data if isinstance(data, dict) else None)
+
+    def save_affinity(self, username, data):
+        self._put("affinity", username, AFFINITY_NAME, data, data)
+
+    # --- write-behind ---
+    def flush(self):
+        """Write every pending change to disk now (blocking)."""
+        with self._io_lock:  # keeps an older payload from landing after a newer one
+            with self._lock:
+                items = list(self._dirty.items())
+            for path, item in items:
+                key, payload, dump_kwargs = item
+                self._write(path, payload, dump_kwargs)
+                stat = _stat(path)
+                with self._lock:
+                    # Entries stay dirty until written, so a re-check never reloads
+                    # a file that is older than the cache.
+                    if self._dirty.get(path) is item:
+                        del self._dirty[path]
+                        entry = self._cache.get(key)
+                        if entry is not None:
+                            entry.stat = stat
+
+    def _write(self, path, payload, dump_kwargs):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(payload, f, **dump_kwargs)
+        os.replace(tmp, path)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._dirty and not self._closed:
+                    self._wake.wait()
+                if self._closed and not self._dirty:
+                    return
+            try:
+                self.flush()
+            except OSError:
+                time.sleep(1.0)  # retried on the next loop
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self.flush()
+        atexit.unregister(self.close)
+
+
+def _parse_prefs(data):
+    if not isinstance(data, dict):
+        return Preferences()
+    try:
+        return Preferences(data.get("likes", []), data.get("dislikes", []))
+    except (TypeError, ValueError):
+        return Preferences()